@@ -75,13 +75,22 @@ class Burst(RoutesMixin, AppEventsMixin):
                         self.debug)
             self.master_class(self).run()
         else:
-            burst_env = json.loads(str_burst_env)
-            if burst_env['type'] == constants.PROC_TYPE_PROXY:
-                # proxy
-                self.proxy_class(self, self.config['HOST'], self.config['PORT']).run()
-            else:
-                # worker
-                self.worker_class(self, burst_env['group_id']).run()
+            self.run_child(json.loads(str_burst_env))
+
+    def run_child(self, proc_env):
+        """
+        运行子进程，master通过环境变量或者fork后直接调用
+        :param proc_env:
+        :return:
+        """
+        if proc_env['type'] == constants.PROC_TYPE_PROXY:
+            # proxy
+            self.proxy_class(self, self.config['HOST'], self.config['PORT']).run()
+        else:
+            # worker
+            worker = self.worker_class(self, proc_env['group_id'])
+            worker.stat_slot = proc_env.get('stat_slot')
+            worker.run()
 
     def make_proc_name(self, subtitle):
         """
@@ -120,6 +129,18 @@ class Burst(RoutesMixin, AppEventsMixin):
 
         return True
 
+    def get_endpoints(self):
+        """
+        所有的endpoint，包括blueprint中的
+        :return:
+        """
+        endpoints = set(rule['endpoint'] for rule in self.rule_map.values())
+
+        for bp in self.blueprints:
+            endpoints.update('%s.%s' % (bp.name, rule['endpoint']) for rule in bp.rule_map.values())
+
+        return sorted(endpoints)
+
     def _validate_cmds(self):
         """
         确保 cmd 没有重复
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+
+class Autoscaler(object):
+    """
+    根据proxy上报的分组负载，计算各分组应有的worker数量
+    只处理GROUP_CONFIG中配置了max_count的分组
+    """
+
+    app = None
+
+    # 分组上次调整的时间
+    last_scale_time_dict = None
+
+    def __init__(self, app):
+        self.app = app
+        self.last_scale_time_dict = dict()
+
+    def decide(self, group_load_dict):
+        """
+        计算需要调整的分组
+        :param group_load_dict: {group_id: dict(pending=, busy=, idle=)}
+        :return: {group_id: count}
+        """
+        now = time.time()
+        result = dict()
+
+        for group_id, group_load in group_load_dict.items():
+            group_info = self.app.config['GROUP_CONFIG'].get(group_id)
+            if not group_info or not group_info.get('max_count'):
+                continue
+
+            last_scale_time = self.last_scale_time_dict.get(group_id)
+            if last_scale_time is not None and now - last_scale_time < self.app.config['AUTOSCALE_COOLDOWN']:
+                continue
+
+            count = self._calc_count(group_info, group_load)
+            if count != group_info['count']:
+                result[group_id] = count
+                self.last_scale_time_dict[group_id] = now
+
+        return result
+
+    def _calc_count(self, group_info, group_load):
+        """
+        计算分组应有的worker数量
+        :param group_info:
+        :param group_load:
+        :return:
+        """
+        count = group_info['count']
+        # 至少保留一个worker
+        min_count = max(group_info.get('min_count', 1), 1)
+        max_count = max(group_info['max_count'], min_count)
+
+        workers = group_load['busy'] + group_load['idle']
+        if workers != count:
+            # 还有worker没有连上或者还没有退休完，数据不准
+            return count
+
+        busy_ratio = float(group_load['busy']) / workers if workers else 1.0
+
+        if group_load['pending'] > 0 and busy_ratio >= self.app.config['AUTOSCALE_UP_BUSY_RATIO']:
+            # 每次最多翻倍，但没必要超过排队的任务数
+            count += max(1, min(group_load['pending'], count))
+        elif group_load['pending'] == 0 and busy_ratio <= self.app.config['AUTOSCALE_DOWN_BUSY_RATIO']:
+            count -= 1
+
+        return min(max(count, min_count), max_count)
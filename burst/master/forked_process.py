@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+
+def status_to_returncode(status):
+    """
+    把 waitpid 返回的status转为与 subprocess.Popen 一致的退出码
+    :param status:
+    :return: 被信号终止时为负的信号值
+    """
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    else:
+        return os.WEXITSTATUS(status)
+
+
+class ForkedProcess(object):
+    """
+    通过fork创建的子进程
+    提供与 subprocess.Popen 一致的 pid/returncode/send_signal 接口，master不需要区分
+    回收由master统一waitpid完成
+    """
+
+    pid = None
+    returncode = None
+    proc_env = None
+
+    def __init__(self, pid, proc_env):
+        self.pid = pid
+        self.proc_env = proc_env
+
+    def send_signal(self, signum):
+        if self.returncode is None:
+            os.kill(self.pid, signum)
+
+    def __repr__(self):
+        return '<%s pid: %s, returncode: %s>' % (
+            type(self).__name__, self.pid, self.returncode
+        )
@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
 
 import os
-import copy
+import errno
+import fcntl
+import select
 import json
 import sys
+import random
+import logging
+from collections import deque
 import subprocess
 import time
 import signal
@@ -14,7 +19,11 @@ import thread
 
 from ..share.log import logger
 from ..share.utils import safe_call
+from ..share.shared_stat import SharedStat, calc_slot_count
+from ..share import profiler
 from ..share import constants
+from .forked_process import ForkedProcess, status_to_returncode
+from .autoscaler import Autoscaler
 
 
 class Master(object):
@@ -41,17 +50,55 @@ class Master(object):
     # 准备好worker进程列表，HUP的时候，用来替换现役workers
     ready_worker_processes = None
 
+    # 所有子进程 {pid: process}，用来在回收时找到对应的进程
+    child_processes = None
+
+    # 唤醒主循环的管道，信号和其他线程都通过它通知主循环
+    _wakeup_rfd = None
+    _wakeup_wfd = None
+
+    # 其他线程要求在主循环中执行的调用
+    _main_loop_calls = None
+
+    # 与proxy的连接
+    proxy_client = None
+
+    # 自动伸缩
+    autoscaler = None
+
+    # reload中收到的分组修改，reload结束后再执行 {group_id: count}
+    pending_group_changes = None
+
+    # 滚动reload中，还没有开始替换的老workers {group_id: deque}
+    rolling_old_processes = None
+    # 滚动reload中，正在退休的老workers
+    rolling_retiring_processes = None
+
+    # worker统计使用的共享内存
+    shared_stat = None
+    # 空闲的统计slot
+    free_stat_slots = None
+
     def __init__(self, app):
         """
         构造函数
         :return:
         """
         self.app = app
+        self.child_processes = dict()
+        self._main_loop_calls = deque()
+        self.pending_group_changes = dict()
+        self.rolling_old_processes = dict()
+        self.rolling_retiring_processes = list()
+        self.free_stat_slots = deque()
+        self.autoscaler = Autoscaler(self.app)
 
     def run(self):
         setproctitle.setproctitle(self.app.make_proc_name(self.type))
 
+        self._init_wakeup_fd()
         self._handle_proc_signals()
+        self._init_shared_stat()
 
         self.proxy_process = self._spawn_proxy()
 
@@ -66,6 +113,61 @@ class Master(object):
 
         self._monitor_child_processes()
 
+    def _init_shared_stat(self):
+        """
+        创建worker统计使用的共享内存，要在启动proxy之前
+        :return:
+        """
+        if not self.app.config['WORKER_STAT_SHM']:
+            return
+
+        ipc_directory = self.app.config['IPC_ADDRESS_DIRECTORY']
+        if not os.path.exists(ipc_directory):
+            os.makedirs(ipc_directory)
+
+        slot_count = self.app.config['WORKER_STAT_SLOTS']
+        if slot_count is None:
+            slot_count = calc_slot_count(self.app.config['GROUP_CONFIG'])
+
+        try:
+            self.shared_stat = SharedStat.create(
+                os.path.join(ipc_directory, self.app.config['WORKER_STAT_SHM']),
+                slot_count,
+                self.app.get_endpoints(),
+                self.app.config['WORKER_STAT_COUNTERS'],
+            )
+        except:
+            logger.error('create shared stat fail. master: %s', self, exc_info=True)
+            return
+
+        self.free_stat_slots.extend(xrange(slot_count))
+
+    def _alloc_stat_slot(self, proc_env):
+        """
+        给worker分配统计slot
+        :param proc_env:
+        :return: 新的proc_env
+        """
+        if proc_env['type'] != constants.PROC_TYPE_WORKER or not self.shared_stat:
+            return proc_env
+
+        if not self.free_stat_slots:
+            logger.error('no free stat slot. master: %s, proc_env: %s', self, proc_env)
+            return dict(proc_env, stat_slot=None)
+
+        # 进程被重新拉起时会复用proc_env，所以要复制一份
+        return dict(proc_env, stat_slot=self.free_stat_slots.popleft())
+
+    def _free_stat_slot(self, p):
+        """
+        worker退出后回收slot，不清零，这样汇总的计数不会变小
+        :param p:
+        :return:
+        """
+        stat_slot = p.proc_env.get('stat_slot')
+        if stat_slot is not None:
+            self.free_stat_slots.append(stat_slot)
+
     def _wait_proxy(self):
         """
         尝试连接proxy，如果连接成功，说明proxy启动起来了
@@ -100,7 +202,7 @@ class Master(object):
             self.app.config['IPC_ADDRESS_DIRECTORY'],
             self.app.config['MASTER_ADDRESS']
         )
-        client = TcpClient(Box, address=address)
+        client = self.proxy_client = TcpClient(Box, address=address)
 
         while self.enable:
             try:
@@ -133,22 +235,31 @@ class Master(object):
 
         if box.cmd == constants.CMD_ADMIN_CHANGE:
             jdata = json.loads(box.body)
-            if not self.app.change_group_config(jdata['payload']['group_id'], jdata['payload']['count']):
-                logger.error('change group config fail. master: %s, data: %s', self, box.body)
-                return
-
-            self._reload_workers()
+            self._call_in_main_loop(self._change_group, jdata['payload']['group_id'], jdata['payload']['count'])
 
         elif box.cmd == constants.CMD_ADMIN_RELOAD:
-            self._reload_workers()
+            self._call_in_main_loop(self._reload_workers)
         elif box.cmd == constants.CMD_ADMIN_STOP:
             self._stop_by_signal(signal.SIGTERM)
         elif box.cmd == constants.CMD_MASTER_REPLACE_WORKERS:
             # 要替换workers
             self.reload_status = constants.RELOAD_STATUS_WORKERS_DONE
+            self._wakeup()
+        elif box.cmd == constants.CMD_MASTER_GROUP_LOAD:
+            group_load_dict = dict([(int(group_id), group_load) for group_id, group_load in
+                                    json.loads(box.body).items()])
+            self._call_in_main_loop(self._autoscale, group_load_dict)
+        elif box.cmd == constants.CMD_ADMIN_PROFILE:
+            jdata = json.loads(box.body)
+            self._call_in_main_loop(self._start_profile, jdata['payload'])
 
     def _start_child_process(self, proc_env):
-        worker_env = copy.deepcopy(os.environ)
+        proc_env = self._alloc_stat_slot(proc_env)
+
+        if self.app.config['PRELOAD_APP']:
+            return self._fork_child_process(proc_env)
+
+        worker_env = dict(os.environ)
         worker_env.update({
             self.app.config['CHILD_PROCESS_ENV_KEY']: json.dumps(proc_env)
         })
@@ -156,8 +267,68 @@ class Master(object):
         args = [sys.executable] + sys.argv
         inner_p = subprocess.Popen(args, env=worker_env)
         inner_p.proc_env = proc_env
+        self.child_processes[inner_p.pid] = inner_p
         return inner_p
 
+    def _fork_child_process(self, proc_env):
+        """
+        直接fork出子进程，子进程复用master已经加载好的app
+        :param proc_env:
+        :return:
+        """
+        pid = self._fork()
+        if pid > 0:
+            inner_p = ForkedProcess(pid, proc_env)
+            self.child_processes[pid] = inner_p
+            return inner_p
+
+        # 子进程
+        exit_code = 0
+        try:
+            # 与启动新进程时保持一致
+            os.environ[self.app.config['CHILD_PROCESS_ENV_KEY']] = json.dumps(proc_env)
+            # master与proxy的连接，子进程不能占着。只关闭fd，不影响master
+            if self.proxy_client:
+                self.proxy_client.close()
+            # 恢复master设置的信号处理，子进程会自己设置
+            signal.set_wakeup_fd(-1)
+            os.close(self._wakeup_rfd)
+            os.close(self._wakeup_wfd)
+            for signum in (signal.SIGINT, signal.SIGQUIT, signal.SIGTERM, signal.SIGHUP, signal.SIGCHLD):
+                signal.signal(signum, signal.SIG_DFL)
+            # 否则所有子进程的随机数序列都一样
+            random.seed()
+
+            self.app.run_child(proc_env)
+        except Exception:
+            logger.error('exc occur. master: %s, proc_env: %s', self, proc_env, exc_info=True)
+            exit_code = 1
+        finally:
+            # 不能回到master的代码里继续执行
+            logging.shutdown()
+            os._exit(exit_code)
+
+    def _fork(self):
+        """
+        fork时其他线程(连接proxy、收集profile、延迟kill)可能正持有logging的锁，
+        子进程中没有线程会释放它，第一次打日志就会死锁。
+        所以先拿到所有logging的锁再fork，之后在父子进程中分别释放
+        :return: os.fork 的返回值
+        """
+        handlers = [handler_ref() for handler_ref in logging._handlerList]
+        handlers = [handler for handler in handlers if handler is not None]
+
+        logging._acquireLock()
+        for handler in handlers:
+            handler.acquire()
+
+        try:
+            return os.fork()
+        finally:
+            for handler in reversed(handlers):
+                handler.release()
+            logging._releaseLock()
+
     def _spawn_proxy(self):
         proc_env = dict(
             type=constants.PROC_TYPE_PROXY
@@ -182,27 +353,12 @@ class Master(object):
 
     def _monitor_child_processes(self):
         while 1:
-            if self.proxy_process and self.proxy_process.poll() is not None:
-                proc_env = self.proxy_process.proc_env
-                if self.enable:
-                    self.proxy_process = self._start_child_process(proc_env)
-
-            for idx, p in enumerate(self.worker_processes):
+            for p in self._reap_child_processes():
+                self._on_child_process_exit(p)
 
-                if self.reload_status != constants.RELOAD_STATUS_STOPPED:
-                    # 如果是处于reload中，那么就不要检测worker状态
-                    # 否则会导致worker重连，而proxy那边重新分配任务
-                    continue
-
-                if p and p.poll() is not None:
-                    # 说明退出了
-                    proc_env = p.proc_env
-                    self.worker_processes[idx] = None
-
-                    if self.enable:
-                        # 如果还要继续服务
-                        p = self._start_child_process(proc_env)
-                        self.worker_processes[idx] = p
+            while self._main_loop_calls:
+                func, args = self._main_loop_calls.popleft()
+                safe_call(func, *args)
 
             if not filter(lambda x: x, self.worker_processes):
                 # 没活着的了worker了
@@ -215,12 +371,370 @@ class Master(object):
                 self.worker_processes = self.ready_worker_processes
                 self.ready_worker_processes = list()
 
-                # 结束reload
-                self.reload_status = constants.RELOAD_STATUS_STOPPED
+                self._on_reload_over()
+
+            # 等到有子进程退出或者其他事件发生
+            self._wait_wakeup()
+
+    def _reap_child_processes(self):
+        """
+        回收所有已经退出的子进程
+        :return: 退出的进程列表
+        """
+        exited_processes = []
+
+        while 1:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                # ECHILD，已经没有子进程了
+                break
+
+            if not pid:
+                # 有子进程，但都还在运行
+                break
+
+            p = self.child_processes.pop(pid, None)
+            if p is None:
+                continue
+
+            p.returncode = status_to_returncode(status)
+            self._free_stat_slot(p)
+            exited_processes.append(p)
+
+        return exited_processes
+
+    def _on_child_process_exit(self, p):
+        """
+        子进程退出
+        :param p:
+        :return:
+        """
+        if p is self.proxy_process:
+            if self.enable:
+                self.proxy_process = self._start_child_process(p.proc_env)
+            return
+
+        if p in self.rolling_retiring_processes:
+            # 滚动reload中，老worker退休完成，继续替换下一个
+            self.rolling_retiring_processes.remove(p)
+            self._rolling_reload_step()
+            return
+
+        if p in self.worker_processes:
+            idx = self.worker_processes.index(p)
+            self.worker_processes[idx] = None
+
+            if self.reload_status in (constants.RELOAD_STATUS_PREPARING, constants.RELOAD_STATUS_WORKERS_DONE):
+                # 如果是处于reload中，那么就不要重新拉起worker
+                # 否则会导致worker重连，而proxy那边重新分配任务
+                return
+
+            if self.enable:
+                # 如果还要继续服务
+                self.worker_processes[idx] = self._start_child_process(p.proc_env)
+
+    def _start_profile(self, params):
+        """
+        让分组内的workers开始采样，采样结束后在其他线程收集结果
+        :param params: dict(profile_id=, group_id=, seconds=, interval=)
+        :return:
+        """
+        ipc_directory = self.app.config['IPC_ADDRESS_DIRECTORY']
+
+        pids = []
+        for p in self.worker_processes:
+            if not p or p.proc_env['group_id'] != params['group_id']:
+                continue
+
+            profiler.write_json_file(profiler.request_path(ipc_directory, p.pid), dict(
+                profile_id=params['profile_id'],
+                seconds=params['seconds'],
+                interval=params['interval'],
+            ))
+            p.send_signal(signal.SIGUSR2)
+            pids.append(p.pid)
+
+        logger.info('profile start. master: %s, params: %s, pids: %s', self, params, pids)
+
+        thread.start_new_thread(self._collect_profile, (params, pids))
+
+    def _collect_profile(self, params, pids):
+        """
+        等待采样结束，合并各个worker的结果发给proxy
+        :param params:
+        :param pids:
+        :return:
+        """
+        ipc_directory = self.app.config['IPC_ADDRESS_DIRECTORY']
+
+        if pids:
+            time.sleep(params['seconds'])
+
+        results = dict()
+        deadline = time.time() + self.app.config['PROFILE_COLLECT_TIMEOUT']
+        while 1:
+            for pid in pids:
+                if pid not in results:
+                    result = safe_call(profiler.read_json_file,
+                                       profiler.result_path(ipc_directory, pid, params['profile_id']))
+                    if isinstance(result, dict):
+                        results[pid] = result
+
+            if len(results) == len(pids) or time.time() >= deadline:
+                break
 
-            # 时间短点，退出的快一些
             time.sleep(0.1)
 
+        stacks = dict()
+        for result in results.values():
+            for stack, count in result['stacks'].items():
+                stacks[stack] = stacks.get(stack, 0) + count
+
+        for pid in pids:
+            # 没有收到信号的worker，比如已经退出了，请求文件要清理掉
+            if pid not in results:
+                safe_call(profiler.read_json_file, profiler.request_path(ipc_directory, pid))
+
+        logger.info('profile done. master: %s, params: %s, workers: %s/%s',
+                    self, params, len(results), len(pids))
+
+        # proxy_client只在主循环中写，防止和其他消息交错
+        self._call_in_main_loop(self._send_profile_result, dict(
+            profile_id=params['profile_id'],
+            workers=len(pids),
+            profiled_workers=len(results),
+            samples=sum(result['samples'] for result in results.values()),
+            stacks=stacks,
+        ))
+
+    def _send_profile_result(self, result):
+        """
+        把profile结果发给proxy
+        :param result:
+        :return:
+        """
+        if not self.proxy_client or self.proxy_client.closed():
+            logger.error('proxy not connected. master: %s, profile_id: %s', self, result['profile_id'])
+            return False
+
+        box = Box(dict(
+            cmd=constants.CMD_MASTER_PROFILE_RESULT,
+            body=json.dumps(result),
+        ))
+        return self.proxy_client.write(box)
+
+    def _call_in_main_loop(self, func, *args):
+        """
+        在主循环中执行，避免和主循环同时修改进程列表
+        :param func:
+        :param args:
+        :return:
+        """
+        self._main_loop_calls.append((func, args))
+        self._wakeup()
+
+    def _on_reload_over(self):
+        """
+        reload结束
+        :return:
+        """
+        self.reload_status = constants.RELOAD_STATUS_STOPPED
+
+        # 执行reload过程中收到的分组修改
+        for group_id, count in self.pending_group_changes.items():
+            self._resize_group(group_id, count)
+        self.pending_group_changes.clear()
+
+    def _start_rolling_reload(self):
+        """
+        开始滚动reload
+        :return:
+        """
+        self.rolling_old_processes.clear()
+
+        for p in self.worker_processes:
+            if p:
+                self.rolling_old_processes.setdefault(p.proc_env['group_id'], deque()).append(p)
+
+        self._rolling_reload_step()
+
+    def _rolling_reload_step(self):
+        """
+        每个分组最多同时替换 RELOAD_ROLLING_BATCH_SIZE 个worker
+        先启动新worker，再让老worker退休
+        :return:
+        """
+        batch_size = max(self.app.config['RELOAD_ROLLING_BATCH_SIZE'], 1)
+        # 本次开始退休的workers
+        retiring_processes = []
+
+        for group_id, old_processes in self.rolling_old_processes.items():
+            retiring_count = len([p for p in self.rolling_retiring_processes
+                                  if p.proc_env['group_id'] == group_id])
+
+            while old_processes and retiring_count < batch_size:
+                p = old_processes.popleft()
+                if p not in self.worker_processes:
+                    # 已经退出并且被重新拉起过了，本来就是新的
+                    continue
+
+                if self.enable:
+                    self.worker_processes[self.worker_processes.index(p)] = self._start_child_process(p.proc_env)
+                else:
+                    self.worker_processes.remove(p)
+
+                self.rolling_retiring_processes.append(p)
+                retiring_processes.append(p)
+                p.send_signal(signal.SIGUSR1)
+                retiring_count += 1
+
+            if not old_processes:
+                self.rolling_old_processes.pop(group_id)
+
+        if retiring_processes and self.app.config['STOP_TIMEOUT'] is not None:
+            # 卡住的老worker不能一直阻塞reload
+            self._kill_processes_later(retiring_processes, self.app.config['STOP_TIMEOUT'])
+
+        if not self.rolling_old_processes and not self.rolling_retiring_processes:
+            logger.info('rolling reload over. master: %s', self)
+            self._on_reload_over()
+
+    def _change_group(self, group_id, count):
+        """
+        修改分组的worker数量
+        :param group_id:
+        :param count:
+        :return:
+        """
+        if self.reload_status != constants.RELOAD_STATUS_STOPPED:
+            # reload中proxy在等待预备役workers达到配置的数量，此时不能修改
+            self.pending_group_changes[group_id] = count
+            return True
+
+        if not self._resize_group(group_id, count):
+            logger.error('change group config fail. master: %s, group_id: %s, count: %s', self, group_id, count)
+            return False
+
+        return True
+
+    def _autoscale(self, group_load_dict):
+        """
+        根据proxy上报的负载自动伸缩
+        :param group_load_dict:
+        :return:
+        """
+        if not self.enable or self.reload_status != constants.RELOAD_STATUS_STOPPED:
+            return
+
+        for group_id, count in self.autoscaler.decide(group_load_dict).items():
+            logger.info('autoscale. master: %s, group_id: %s, count: %s -> %s, load: %s',
+                        self, group_id, self.app.config['GROUP_CONFIG'][group_id]['count'], count,
+                        group_load_dict[group_id])
+            self._resize_group(group_id, count)
+
+    def _resize_group(self, group_id, count):
+        """
+        只增加或者减少某个分组的worker，不影响其他worker
+        减少的worker会先处理完手上的任务再退出
+        :param group_id:
+        :param count:
+        :return:
+        """
+        if not self.app.change_group_config(group_id, count):
+            return False
+
+        # proxy也要同步，否则之后reload时proxy等待的worker数量不对
+        self._notify_proxy_group_change(group_id, count)
+
+        group_processes = [p for p in self.worker_processes
+                           if p and p.proc_env['group_id'] == group_id]
+
+        if count > len(group_processes):
+            proc_env = dict(
+                type=constants.PROC_TYPE_WORKER,
+                group_id=group_id,
+            )
+            for it in xrange(0, count - len(group_processes)):
+                self.worker_processes.append(self._start_child_process(proc_env))
+
+        elif count < len(group_processes):
+            # 优先退休新启动的
+            retiring_processes = group_processes[count:]
+            for p in retiring_processes:
+                self.worker_processes.remove(p)
+                p.send_signal(signal.SIGUSR1)
+
+            if self.app.config['STOP_TIMEOUT'] is not None:
+                # 卡在处理函数中的worker不能一直占着进程和统计slot
+                self._kill_processes_later(retiring_processes, self.app.config['STOP_TIMEOUT'])
+
+        return True
+
+    def _notify_proxy_group_change(self, group_id, count):
+        """
+        通知proxy分组的worker数量
+        :param group_id:
+        :param count:
+        :return:
+        """
+        if not self.proxy_client or self.proxy_client.closed():
+            logger.error('proxy not connected. master: %s, group_id: %s, count: %s', self, group_id, count)
+            return False
+
+        box = Box(dict(
+            cmd=constants.CMD_MASTER_CHANGE_GROUP,
+            body=json.dumps(dict(
+                group_id=group_id,
+                count=count,
+            ))
+        ))
+        return self.proxy_client.write(box)
+
+    def _init_wakeup_fd(self):
+        """
+        信号到来时，会往管道里写入数据，从而唤醒主循环
+        :return:
+        """
+        self._wakeup_rfd, self._wakeup_wfd = os.pipe()
+
+        for fd in (self._wakeup_rfd, self._wakeup_wfd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+        signal.set_wakeup_fd(self._wakeup_wfd)
+
+    def _wakeup(self):
+        """
+        唤醒主循环，其他线程修改了状态后调用
+        :return:
+        """
+        try:
+            os.write(self._wakeup_wfd, '\0')
+        except OSError:
+            # 管道满了说明主循环已经会被唤醒
+            pass
+
+    def _wait_wakeup(self):
+        """
+        阻塞等待，直到被唤醒
+        :return:
+        """
+        try:
+            select.select([self._wakeup_rfd], [], [])
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+
+        # 把数据都读掉
+        try:
+            while os.read(self._wakeup_rfd, 4096):
+                pass
+        except OSError:
+            pass
+
     def _kill_processes_later(self, processes, timeout):
         """
         等待一段时间后杀死所有进程
@@ -233,7 +747,8 @@ class Master(object):
             time.sleep(timeout)
 
             for p in processes:
-                if p and p.poll() is None:
+                # 不能调用poll，否则会和主循环抢着回收进程
+                if p and p.returncode is None:
                     # 说明进程还活着
                     p.send_signal(signal.SIGKILL)
 
@@ -242,11 +757,19 @@ class Master(object):
     def _reload_workers(self):
         """
         reload是热更新，全部都准备好了之后，再将worker挨个换掉
+        RELOAD_MODE_ROLLING 时，每个分组逐批替换
+        只能在主循环中调用
         :return:
         """
         if self.reload_status != constants.RELOAD_STATUS_STOPPED:
             return False
 
+        if self.app.config['RELOAD_MODE'] == constants.RELOAD_MODE_ROLLING:
+            # 滚动替换，不需要通知proxy
+            self.reload_status = constants.RELOAD_STATUS_ROLLING
+            self._start_rolling_reload()
+            return True
+
         # 正在进行reloading
         self.reload_status = constants.RELOAD_STATUS_PREPARING
 
@@ -303,8 +826,9 @@ class Master(object):
         def safe_reload_handler(signum, frame):
             """
             让所有子进程重新加载
+            启动进程会修改进程列表，所以放到主循环中执行
             """
-            self._reload_workers()
+            self._call_in_main_loop(self._reload_workers)
 
         # INT, QUIT为强制结束
         signal.signal(signal.SIGINT, stop_handler)
@@ -313,6 +837,12 @@ class Master(object):
         signal.signal(signal.SIGTERM, stop_handler)
         # HUP为热更新
         signal.signal(signal.SIGHUP, safe_reload_handler)
+        # 子进程退出时，通过wakeup fd唤醒主循环
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        # 防止其他线程的系统调用被打断
+        signal.siginterrupt(signal.SIGCHLD, False)
+        # 子进程会继承忽略的设置，防止worker在设置好处理函数之前收到profile信号被杀掉
+        signal.signal(signal.SIGUSR2, signal.SIG_IGN)
 
     def __repr__(self):
         return '<%s name: %s>' % (
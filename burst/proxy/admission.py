@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+"""
+proxy端的准入控制
+客户端的请求在放入分组队列之前先检查，被拒绝的请求由proxy直接回应 RET_PROXY_REJECTED，不会占用worker
+"""
+
+import time
+from collections import OrderedDict
+
+from ..share import constants
+
+
+class TokenBucket(object):
+    """
+    令牌桶
+    """
+
+    # 每秒补充的令牌数
+    rate = None
+    # 最多积攒的令牌数，即允许的突发请求数
+    capacity = None
+
+    tokens = None
+    # 上次补充令牌的时间
+    last_time = None
+
+    def __init__(self, rate, capacity, now=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_time = now if now is not None else time.time()
+
+    def acquire(self, now=None):
+        """
+        取一个令牌
+        :param now:
+        :return: 是否成功
+        """
+        self._refill(now if now is not None else time.time())
+
+        if self.tokens < 1:
+            return False
+
+        self.tokens -= 1
+        return True
+
+    def _refill(self, now):
+        if now > self.last_time:
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_time) * self.rate)
+        self.last_time = now
+
+
+class RateLimiter(object):
+    """
+    按key限流，每个key一个令牌桶
+    """
+
+    # 桶的个数超过这个值时，淘汰最久没有使用的桶。key来自客户端，不能无限增长
+    max_buckets = 65536
+
+    # {key: (rate, capacity)}，没有配置的key不限流
+    limit_dict = None
+    # 所有key默认的限制，None 代表不限流
+    default_limit = None
+
+    # 按最近使用的顺序排列，最久没有使用的在最前面
+    bucket_dict = None
+
+    def __init__(self, default_limit=None, limit_dict=None):
+        """
+        :param default_limit: (rate, capacity)
+        :param limit_dict: {key: (rate, capacity)}
+        """
+        self.default_limit = default_limit
+        self.limit_dict = dict(limit_dict or {})
+        self.bucket_dict = OrderedDict()
+
+    def acquire(self, key, now=None):
+        """
+        :param key:
+        :param now:
+        :return: 是否允许
+        """
+        bucket = self.bucket_dict.pop(key, None)
+        if bucket is None:
+            limit = self.limit_dict.get(key, self.default_limit)
+            if limit is None:
+                return True
+
+            if len(self.bucket_dict) >= self.max_buckets:
+                # 被淘汰的key再来时会拿到一个新的桶，最久没有使用的桶大概率也已经补满了
+                self.bucket_dict.popitem(last=False)
+
+            bucket = TokenBucket(limit[0], limit[1], now)
+
+        # 重新插入，移到最后
+        self.bucket_dict[key] = bucket
+        return bucket.acquire(now)
+
+
+class AdmissionController(object):
+    """
+    准入控制: 按客户端IP和cmd限流，分组排队时间过长时拒绝新的请求
+    """
+
+    # 排队时间平滑系数
+    queue_time_alpha = 0.2
+
+    proxy = None
+
+    ip_rate_limiter = None
+    cmd_rate_limiter = None
+
+    # 各分组最近的排队时间，指数平滑 {group_id: seconds}
+    queue_time_dict = None
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+        self.queue_time_dict = dict()
+
+        config = self.proxy.app.config
+        if config['PROXY_IP_RATE_LIMIT']:
+            self.ip_rate_limiter = RateLimiter(config['PROXY_IP_RATE_LIMIT'])
+        if config['PROXY_CMD_RATE_LIMIT']:
+            self.cmd_rate_limiter = RateLimiter(limit_dict=config['PROXY_CMD_RATE_LIMIT'])
+
+    def check(self, group_id, client_ip_num, cmd):
+        """
+        检查是否允许请求进入分组队列
+        :param group_id:
+        :param client_ip_num:
+        :param cmd:
+        :return: 允许时返回None，否则返回拒绝原因
+        """
+        if self.ip_rate_limiter and not self.ip_rate_limiter.acquire(client_ip_num):
+            return constants.REJECT_REASON_IP_RATE
+
+        if self.cmd_rate_limiter and cmd is not None and not self.cmd_rate_limiter.acquire(cmd):
+            return constants.REJECT_REASON_CMD_RATE
+
+        max_queue_time = self.get_max_queue_time(group_id)
+        if max_queue_time is not None and self.queue_time_dict.get(group_id, 0) > max_queue_time \
+                and not self.proxy.task_dispatcher.group_queue.empty(group_id):
+            # 队列排空之后一定会放行，新的排队时间会把平滑值降下来
+            return constants.REJECT_REASON_QUEUE_TIME
+
+        return None
+
+    def get_max_queue_time(self, group_id):
+        """
+        分组排队时间的上限
+        :param group_id:
+        :return: None 代表不限制
+        """
+        group_info = self.proxy.app.config['GROUP_CONFIG'].get(group_id) or {}
+        return group_info.get('admission_queue_time', self.proxy.app.config['PROXY_ADMISSION_QUEUE_TIME'])
+
+    def add_queue_time(self, group_id, queue_time):
+        """
+        记录任务分配给worker时的排队时间
+        :param group_id:
+        :param queue_time: 秒
+        :return:
+        """
+        last_queue_time = self.queue_time_dict.get(group_id)
+        if last_queue_time is None:
+            self.queue_time_dict[group_id] = queue_time
+        else:
+            self.queue_time_dict[group_id] = last_queue_time + self.queue_time_alpha * (queue_time - last_queue_time)
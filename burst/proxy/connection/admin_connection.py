@@ -1,13 +1,17 @@
 # -*- coding: utf-8 -*-
 
 import json
+from collections import defaultdict
 
-from twisted.internet.protocol import Protocol, Factory
+from twisted.internet.protocol import Protocol, Factory, connectionDone
+from twisted.internet.task import LoopingCall
 from netkit.box import Box
 
-from ...share.utils import safe_call
+from ...share.utils import safe_call, safe_func, diff_dict, cached_call
 from ...share.log import logger
 from ...share import constants
+from ...share.shared_stat import calc_slot_count
+from ..read_buffer import ReadBuffer
 
 
 class AdminConnectionFactory(Factory):
@@ -22,13 +26,33 @@ class AdminConnectionFactory(Factory):
 class AdminConnection(Protocol):
     _read_buffer = None
 
+    # 统计订阅的定时器
+    _stat_subscribe_loop = None
+    # 订阅请求
+    _stat_subscribe_box = None
+    # 上次推送的统计
+    _last_stat_body = None
+    # 推送时是否包含直方图快照
+    _stat_subscribe_hist = False
+    # 订阅时缓存的直方图计算结果，没有新记录的直方图不用重新计算 {name: cache}
+    _stat_cache_dict = None
+
     # 客户端IP的数字
     _client_ip_num = None
 
     def __init__(self, factory, address):
         self.factory = factory
         self.address = address
-        self._read_buffer = ''
+        self._read_buffer = ReadBuffer()
+
+    def connectionLost(self, reason=connectionDone):
+        self._stop_stat_subscribe()
+
+        # 还没有结束的profile，结果不需要再回应了
+        profile_requests = self.factory.proxy.profile_requests
+        for profile_id, (admin_conn, box) in profile_requests.items():
+            if admin_conn is self:
+                profile_requests.pop(profile_id)
 
     def dataReceived(self, data):
         """
@@ -36,25 +60,25 @@ class AdminConnection(Protocol):
         :param data:
         :return:
         """
-        self._read_buffer += data
+        self._read_buffer.append(data)
 
         while self._read_buffer:
             # 因为box后面还是要用的
             box = Box()
-            ret = box.unpack(self._read_buffer)
+            ret = box.unpack(self._read_buffer.view())
             if ret == 0:
                 # 说明要继续收
                 return
             elif ret > 0:
                 # 收好了
-                self._read_buffer = self._read_buffer[ret:]
+                self._read_buffer.skip(ret)
                 safe_call(self._on_read_complete, box)
                 continue
             else:
                 # 数据已经混乱了，全部丢弃
                 logger.error('buffer invalid. proxy: %s, ret: %d, read_buffer: %r',
                              self.factory.proxy, ret, self._read_buffer)
-                self._read_buffer = ''
+                self._read_buffer.clear()
                 return
 
     def _auth_user(self, username, password):
@@ -70,6 +94,225 @@ class AdminConnection(Protocol):
             username or '', password or ''
         )
 
+    def _validate_group_change(self, group_id, count):
+        """
+        校验分组配置修改
+        proxy只监听了启动时配置的分组，所以不能新增分组
+        :param group_id:
+        :param count:
+        :return:
+        """
+        # 至少保留一个worker，否则master会认为worker都退出了而停止
+        if not isinstance(group_id, int) or not isinstance(count, int) or count < 1:
+            return False
+
+        group_config = self.factory.proxy.app.config['GROUP_CONFIG']
+        if group_id not in group_config:
+            return False
+
+        shared_stat = self.factory.proxy.stat_counter.shared_stat
+        if shared_stat and count > group_config[group_id]['count']:
+            # 共享内存的slot在启动时就分配好了，不够的话新worker没有统计
+            new_group_config = dict(group_config)
+            new_group_config[group_id] = dict(group_config[group_id], count=count)
+            if calc_slot_count(new_group_config) > shared_stat.slot_count:
+                return False
+
+        return True
+
+    def _start_profile(self, box, payload):
+        """
+        校验参数后转发给master
+        :param box:
+        :param payload: dict(group_id=, seconds=, interval=)
+        :return: 需要立即回应时返回rsp
+        """
+        proxy = self.factory.proxy
+        config = proxy.app.config
+
+        group_id = payload.get('group_id')
+        seconds = payload.get('seconds')
+        interval = payload.get('interval')
+
+        if group_id not in config['GROUP_CONFIG'] \
+                or not isinstance(seconds, (int, float)) or not 0 < seconds <= config['PROFILE_MAX_SECONDS'] \
+                or not isinstance(interval, (int, float)) or interval < config['PROFILE_MIN_INTERVAL']:
+            logger.error('invalid profile params. proxy: %s, payload: %s', proxy, payload)
+            return box.map(dict(
+                ret=constants.RET_ADMIN_INVALID_PARAMS
+            ))
+
+        if not proxy.master_conn or not proxy.master_conn.transport:
+            return box.map(dict(
+                ret=constants.RET_MASTER_NOT_CONNECTED
+            ))
+
+        proxy.last_profile_id += 1
+        proxy.profile_requests[proxy.last_profile_id] = (self, box)
+
+        proxy.master_conn.transport.write(box.map(dict(
+            body=json.dumps(dict(
+                payload=dict(
+                    profile_id=proxy.last_profile_id,
+                    group_id=group_id,
+                    seconds=seconds,
+                    interval=interval,
+                ),
+            )),
+        )).pack())
+
+        return None
+
+    def _stat_cache(self, name):
+        """
+        :param name:
+        :return: 订阅中返回name对应的cache，否则为None
+        """
+        if self._stat_cache_dict is None:
+            return None
+
+        return self._stat_cache_dict.setdefault(name, dict())
+
+    def _make_stat_body(self, with_hist=True):
+        """
+        生成统计数据
+        不会引用统计中会变化的对象，订阅时可以直接保存下来用于比较
+        订阅时没有新记录的直方图沿用上次的结果，diff_dict 遇到同一个对象直接跳过
+        :param with_hist: 是否包含直方图快照，快照很大，只在需要跨机器合并或者计算差值时使用
+        :return:
+        """
+        stat_counter = self.factory.proxy.stat_counter
+        task_dispatcher = self.factory.proxy.task_dispatcher
+
+        workers = dict([(group_id, group_info['count']) for group_id, group_info in
+                        self.factory.proxy.app.config['GROUP_CONFIG'].items()])
+        idle_workers = dict([(group_id, len(_workers)) for group_id, _workers in
+                             task_dispatcher.idle_workers_dict.items()])
+        busy_workers = dict([(group_id, len(_workers)) for group_id, _workers in
+                             task_dispatcher.busy_workers_dict.items()])
+
+        # 排队中的tasks，包括等待固定worker的
+        pending_tasks = defaultdict(int)
+        # 各个优先级通道排队中的tasks
+        lane_pending = dict((lane, 0) for lane in task_dispatcher.group_queue.lane_names)
+        for (group_id, index), count in task_dispatcher.get_lane_pending().items():
+            pending_tasks[group_id] += count
+            lane_pending[task_dispatcher.group_queue.lane_names[index]] += count
+        pending_tasks = dict(pending_tasks)
+        # 公平队列中有任务在排队的客户端个数
+        pending_flows = dict([(group_id, queue.flow_count()) for group_id, queue in
+                              task_dispatcher.group_queue.queue_dict.items()])
+
+        # 等待固定worker的tasks
+        affinity_pending = defaultdict(int)
+        for (group_id, index), count in task_dispatcher.affinity_pending_dict.items():
+            affinity_pending[group_id] += count
+        affinity_pending = dict(affinity_pending)
+
+        worker_stat = stat_counter.worker_stat()
+        endpoint_time_hist = worker_stat['endpoint_time_hist']
+        endpoint_quantiles_cache = self._stat_cache('endpoint_time_quantiles')
+
+        body = dict(
+            clients=stat_counter.clients,
+            client_req=stat_counter.client_req,
+            client_rsp=stat_counter.client_rsp,
+            worker_req=dict(stat_counter.worker_req_counter),
+            worker_rsp=dict(stat_counter.worker_rsp_counter),
+            workers=workers,
+            idle_workers=idle_workers,
+            busy_workers=busy_workers,
+            pending_tasks=pending_tasks,
+            pending_flows=pending_flows,
+            expired_tasks=dict(stat_counter.expired_tasks_counter),
+            disconnected_tasks=dict(stat_counter.disconnected_tasks_counter),
+            spillover_out=dict(stat_counter.spillover_out_counter),
+            spillover_in=dict(stat_counter.spillover_in_counter),
+            affinity_hit=dict(stat_counter.affinity_hit_counter),
+            affinity_miss=dict(stat_counter.affinity_miss_counter),
+            affinity_pending=affinity_pending,
+            rejected_tasks=dict((reason, dict(counter))
+                                for reason, counter in stat_counter.rejected_tasks_counter.items()),
+            lane_req=dict(stat_counter.lane_req_counter),
+            lane_rejected=dict(stat_counter.lane_rejected_counter),
+            lane_pending=lane_pending,
+            lane_queue_time_quantiles=stat_counter.lane_queue_time_quantiles(
+                self._stat_cache('lane_queue_time_quantiles')),
+            tasks_time=stat_counter.tasks_time_counter,
+            tasks_time_quantiles=stat_counter.tasks_time_quantiles(self._stat_cache('tasks_time_quantiles')),
+            cmd_time_quantiles=stat_counter.cmd_time_quantiles(self._stat_cache('cmd_time_quantiles')),
+            cmd_req=dict(stat_counter.cmd_req_counter),
+            cmd_rsp=dict(stat_counter.cmd_rsp_counter),
+            endpoint_req=worker_stat['endpoint_req'],
+            endpoint_exc=worker_stat['endpoint_exc'],
+            endpoint_time_quantiles=dict(
+                (endpoint, cached_call(endpoint_quantiles_cache, endpoint, histogram.total_count,
+                                       histogram.quantiles, scale=1000))
+                for endpoint, histogram in endpoint_time_hist.items()),
+            worker_counters=worker_stat['counters'],
+        )
+
+        if with_hist:
+            endpoint_hist_cache = self._stat_cache('endpoint_time_hist')
+            body.update(
+                lane_queue_time_hist=stat_counter.lane_queue_time_snapshots(self._stat_cache('lane_queue_time_hist')),
+                tasks_time_hist=stat_counter.tasks_time_snapshots(self._stat_cache('tasks_time_hist')),
+                cmd_time_hist=stat_counter.cmd_time_snapshots(self._stat_cache('cmd_time_hist')),
+                endpoint_time_hist=dict(
+                    (endpoint, cached_call(endpoint_hist_cache, endpoint, histogram.total_count, histogram.to_dict))
+                    for endpoint, histogram in endpoint_time_hist.items()),
+            )
+
+        return body
+
+    def _start_stat_subscribe(self, box, interval, with_hist=False):
+        """
+        开始定时推送统计
+        :param box: 订阅请求，推送时沿用
+        :param interval: 推送间隔(秒)
+        :param with_hist: 是否推送直方图快照
+        :return:
+        """
+        self._stop_stat_subscribe()
+
+        min_interval = self.factory.proxy.app.config['ADMIN_STAT_MIN_INTERVAL']
+        interval = max(interval or 1, min_interval)
+
+        self._stat_subscribe_box = box
+        self._stat_subscribe_hist = with_hist
+        self._last_stat_body = dict()
+        self._stat_cache_dict = dict()
+        self._stat_subscribe_loop = LoopingCall(safe_func(self._push_stat))
+        self._stat_subscribe_loop.start(interval, now=True)
+
+    def _stop_stat_subscribe(self):
+        if self._stat_subscribe_loop:
+            if self._stat_subscribe_loop.running:
+                self._stat_subscribe_loop.stop()
+            self._stat_subscribe_loop = None
+
+        self._stat_subscribe_box = None
+        self._last_stat_body = None
+        self._stat_cache_dict = None
+
+    def _push_stat(self):
+        """
+        推送和上次相比变化了的部分，第一次推送的是全量
+        没有变化时也会推送，客户端可以据此按时刷新
+        :return:
+        """
+        if not self.transport or not self.connected:
+            self._stop_stat_subscribe()
+            return
+
+        stat_body = self._make_stat_body(self._stat_subscribe_hist)
+        delta = diff_dict(self._last_stat_body, stat_body)
+        self._last_stat_body = stat_body
+
+        self.transport.write(self._stat_subscribe_box.map(dict(
+            body=json.dumps(delta)
+        )).pack())
+
     def _on_read_complete(self, box):
         """
         完整数据接收完成
@@ -88,34 +331,15 @@ class AdminConnection(Protocol):
             ))
         else:
             if box.cmd == constants.CMD_ADMIN_SERVER_STAT:
-                workers = dict([(group_id, group_info['count']) for group_id, group_info in
-                                self.factory.proxy.app.config['GROUP_CONFIG'].items()])
-                idle_workers = dict([(group_id, len(_workers)) for group_id, _workers in
-                                     self.factory.proxy.task_dispatcher.idle_workers_dict.items()])
-                busy_workers = dict([(group_id, len(_workers)) for group_id, _workers in
-                                     self.factory.proxy.task_dispatcher.busy_workers_dict.items()])
-
-                # 正在处理的tasks
-                pending_tasks = dict([(group_id, queue.qsize()) for group_id, queue in
-                                     self.factory.proxy.task_dispatcher.group_queue.queue_dict.items()])
-
-                rsp_body = dict(
-                    clients=self.factory.proxy.stat_counter.clients,
-                    client_req=self.factory.proxy.stat_counter.client_req,
-                    client_rsp=self.factory.proxy.stat_counter.client_rsp,
-                    worker_req=self.factory.proxy.stat_counter.worker_req_counter,
-                    worker_rsp=self.factory.proxy.stat_counter.worker_rsp_counter,
-                    workers=workers,
-                    idle_workers=idle_workers,
-                    busy_workers=busy_workers,
-                    pending_tasks=pending_tasks,
-                    tasks_time=self.factory.proxy.stat_counter.tasks_time_counter,
-                )
-
                 rsp = box.map(dict(
-                    body=json.dumps(rsp_body)
+                    body=json.dumps(self._make_stat_body())
                 ))
 
+            elif box.cmd == constants.CMD_ADMIN_STAT_SUBSCRIBE:
+                # 之后定时推送，不单独回应
+                payload = req_body.get('payload') or dict()
+                self._start_stat_subscribe(box, payload.get('interval'), bool(payload.get('hist')))
+
             elif box.cmd == constants.CMD_ADMIN_CLEAR:
                 jdata = json.loads(box.body)
                 if jdata['payload']['all_groups']:
@@ -128,6 +352,10 @@ class AdminConnection(Protocol):
                     ret=0
                 ))
 
+            elif box.cmd == constants.CMD_ADMIN_PROFILE:
+                # 采样结束后，master_connection收到结果再回应
+                rsp = self._start_profile(box, req_body.get('payload') or dict())
+
             elif box.cmd in (
                     constants.CMD_ADMIN_CHANGE,
                     constants.CMD_ADMIN_RELOAD,
@@ -135,9 +363,9 @@ class AdminConnection(Protocol):
             ):
 
                 if box.cmd == constants.CMD_ADMIN_CHANGE:
-                    # 修改配置，要把proxy里面的也修改了，否则reload workers会永远结束不了
+                    # 这里只做校验，master调整完worker之后会通知proxy修改配置
                     jdata = json.loads(box.body)
-                    if not self.factory.proxy.app.change_group_config(jdata['payload']['group_id'], jdata['payload']['count']):
+                    if not self._validate_group_change(jdata['payload']['group_id'], jdata['payload']['count']):
                         logger.error('change group config fail. proxy: %s, data: %s',
                                      self.factory.proxy, box.body)
                         return
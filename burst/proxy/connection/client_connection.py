@@ -6,15 +6,56 @@ from twisted.internet import reactor
 from ...share.utils import safe_call, ip_str_to_int
 from ...share.log import logger
 from ..task_container import TaskContainer
+from ..read_buffer import ReadBuffer
+from ..header_parser import HeaderParser
 from ...share.task import Task
 from ...share import constants
 
 
 class ClientConnectionFactory(Factory):
 
+    # 只解析包头时使用
+    header_parser = None
+
+    # 优先级通道的名字对应的下标
+    lane_index_dict = None
+
     def __init__(self, proxy):
         self.proxy = proxy
 
+        self.lane_index_dict = dict((lane_config.get('name'), index) for index, lane_config in
+                                    enumerate(self.proxy.app.config['PRIORITY_LANES']))
+
+        if self.proxy.app.config['PROXY_ROUTE_BY_HEADER'] and not self._box_body_required():
+            self.header_parser = HeaderParser(self.proxy.app.box_class)
+
+    def _box_body_required(self):
+        """
+        GROUP_PRIORITY、GROUP_AFFINITY 是函数时可能会用到body，这时只解析包头是不够的
+        :return:
+        """
+        config = self.proxy.app.config
+        if config['GROUP_PRIORITY'] and len(self.lane_index_dict) > 1:
+            return True
+
+        if config['GROUP_AFFINITY'] and \
+                config['GROUP_AFFINITY'] not in (constants.AFFINITY_BY_CONNECTION, constants.AFFINITY_BY_IP):
+            return True
+
+        return False
+
+    def get_lane(self, box):
+        """
+        获取box所在的优先级通道
+        :param box:
+        :return: PRIORITY_LANES 中的下标，找不到时为最后一个通道
+        """
+        group_priority = self.proxy.app.config['GROUP_PRIORITY']
+        if not group_priority or len(self.lane_index_dict) <= 1:
+            return 0
+
+        return self.lane_index_dict.get(group_priority(box), len(self.lane_index_dict) - 1)
+
     def buildProtocol(self, addr):
         return ClientConnection(self, addr)
 
@@ -28,10 +69,17 @@ class ClientConnection(Protocol):
     # 过期timer
     _expire_timer = None
 
+    # 还在分组队列中排队的任务
+    queued_tasks = None
+
+    # 公平队列中所属的flow
+    _flow = None
+
     def __init__(self, factory, address):
         self.factory = factory
         self.address = address
-        self._read_buffer = ''
+        self._read_buffer = ReadBuffer()
+        self.queued_tasks = set()
 
     def connectionMade(self):
 
@@ -40,11 +88,22 @@ class ClientConnection(Protocol):
         # 转换string为int
         self._client_ip_num = ip_str_to_int(self.transport.client[0])
 
+        if self.factory.proxy.app.config['PROXY_FAIR_QUEUE'] == constants.FAIR_QUEUE_BY_IP:
+            self._flow = self._client_ip_num
+        else:
+            # 连接断开后排队的任务都会取消，所以id被复用也没关系
+            self._flow = id(self)
+
         self._set_expire_callback()
 
     def connectionLost(self, reason=connectionDone):
         self._clear_expire_callback()
 
+        # 排队中的任务不需要再处理了，直接从队列中取消
+        if self.queued_tasks:
+            self.factory.proxy.task_dispatcher.cancel_tasks(self.queued_tasks)
+            self.queued_tasks.clear()
+
         self.factory.proxy.stat_counter.clients -= 1
 
     def dataReceived(self, data):
@@ -53,27 +112,30 @@ class ClientConnection(Protocol):
         :param data:
         :return:
         """
-        self._read_buffer += data
+        self._read_buffer.append(data)
 
         while self._read_buffer:
-            # 因为box后面还是要用的
-            box = self.factory.proxy.app.box_class()
-            ret = box.unpack(self._read_buffer)
+            if self.factory.header_parser:
+                # 只解析包头，包体由worker解析
+                ret, box = self.factory.header_parser.parse(self._read_buffer.view())
+            else:
+                # 因为box后面还是要用的
+                box = self.factory.proxy.app.box_class()
+                ret = box.unpack(self._read_buffer.view())
             if ret == 0:
                 # 说明要继续收
                 return
             elif ret > 0:
                 # 收好了
                 # 不能使用双下划线，会导致别的地方取的时候变为 _Gateway__raw_data，很奇怪
-                box._raw_data = self._read_buffer[:ret]
-                self._read_buffer = self._read_buffer[ret:]
+                box._raw_data = self._read_buffer.read(ret)
                 safe_call(self._on_read_complete, box)
                 continue
             else:
                 # 数据已经混乱了，全部丢弃
                 logger.error('buffer invalid. proxy: %s, ret: %d, read_buffer: %r',
                              self.factory.proxy, ret, self._read_buffer)
-                self._read_buffer = ''
+                self._read_buffer.clear()
                 return
 
     def _on_read_complete(self, box):
@@ -85,18 +147,65 @@ class ClientConnection(Protocol):
         self.factory.proxy.stat_counter.client_req += 1
         self._set_expire_callback()
 
+        cmd = getattr(box, 'cmd', None)
+        self.factory.proxy.stat_counter.add_cmd_req(cmd)
+
         # 获取映射的group_id
         group_id = self.factory.proxy.app.config['GROUP_ROUTER'](box)
 
+        reason = self.factory.proxy.admission.check(group_id, self._client_ip_num, cmd)
+        if reason is not None:
+            self.reject(box, group_id, reason)
+            return
+
         # 打包成内部通信的task
         task = Task(dict(
             cmd=constants.CMD_WORKER_TASK_ASSIGN,
             client_ip_num=self._client_ip_num,
+            group_id=group_id,
             body=box._raw_data,
         ))
 
-        task_container = TaskContainer(task, self)
-        self.factory.proxy.task_dispatcher.add_task(group_id, task_container)
+        task_container = TaskContainer(task, self, cmd)
+        task_container.lane = self.factory.get_lane(box)
+        task_container.flow = self._flow
+        task_container.sn = getattr(box, 'sn', None)
+        task_container.affinity_key = self._get_affinity_key(box)
+        if not self.factory.proxy.task_dispatcher.add_task(group_id, task_container):
+            self.reject(box, group_id, constants.REJECT_REASON_QUEUE_FULL)
+
+    def reject(self, box, group_id, reason):
+        """
+        直接回应拒绝，不交给worker
+        :param box: 请求的box，只用到cmd和sn
+        :param group_id:
+        :param reason:
+        :return:
+        """
+        self.factory.proxy.stat_counter.add_rejected_task(group_id, reason)
+
+        if self.transport and self.connected:
+            self.transport.write(box.map(dict(
+                ret=constants.RET_PROXY_REJECTED,
+            )).pack())
+            self.factory.proxy.stat_counter.client_rsp += 1
+
+    def _get_affinity_key(self, box):
+        """
+        获取任务要固定分配到哪个worker的key
+        :param box:
+        :return: None 代表不固定
+        """
+        group_affinity = self.factory.proxy.app.config['GROUP_AFFINITY']
+        if not group_affinity:
+            return None
+
+        if group_affinity == constants.AFFINITY_BY_CONNECTION:
+            return id(self)
+        elif group_affinity == constants.AFFINITY_BY_IP:
+            return self._client_ip_num
+        else:
+            return group_affinity(box)
 
     def _set_expire_callback(self):
         """
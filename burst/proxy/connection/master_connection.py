@@ -1,6 +1,14 @@
 # -*- coding: utf-8 -*-
 
+import json
+
 from twisted.internet.protocol import Protocol, Factory, connectionDone
+from netkit.box import Box
+
+from ...share.utils import safe_call
+from ...share.log import logger
+from ...share import constants
+from ..read_buffer import ReadBuffer
 
 
 class MasterConnectionFactory(Factory):
@@ -13,10 +21,12 @@ class MasterConnectionFactory(Factory):
 
 
 class MasterConnection(Protocol):
+    _read_buffer = None
 
     def __init__(self, factory, address):
         self.factory = factory
         self.address = address
+        self._read_buffer = ReadBuffer()
 
     def connectionMade(self):
         self.factory.proxy.master_conn = self
@@ -27,8 +37,61 @@ class MasterConnection(Protocol):
 
     def dataReceived(self, data):
         """
-        当数据接受到时，暂时不用处理
+        当数据接受到时
         :param data:
         :return:
         """
-        pass
+        self._read_buffer.append(data)
+
+        while self._read_buffer:
+            box = Box()
+            ret = box.unpack(self._read_buffer.view())
+            if ret == 0:
+                # 说明要继续收
+                return
+            elif ret > 0:
+                # 收好了
+                self._read_buffer.skip(ret)
+                safe_call(self._on_read_complete, box)
+                continue
+            else:
+                # 数据已经混乱了，全部丢弃
+                logger.error('buffer invalid. proxy: %s, ret: %d, read_buffer: %r',
+                             self.factory.proxy, ret, self._read_buffer)
+                self._read_buffer.clear()
+                return
+
+    def _on_read_complete(self, box):
+        """
+        完整数据接收完成
+        :param box: 解析之后的box
+        :return:
+        """
+        if box.cmd == constants.CMD_MASTER_CHANGE_GROUP:
+            # master调整了worker数量，proxy也要同步，否则reload workers会永远结束不了
+            jdata = json.loads(box.body)
+            if not self.factory.proxy.app.change_group_config(jdata['group_id'], jdata['count']):
+                logger.error('change group config fail. proxy: %s, data: %s',
+                             self.factory.proxy, box.body)
+
+        elif box.cmd == constants.CMD_MASTER_PROFILE_RESULT:
+            self._on_profile_result(json.loads(box.body))
+
+    def _on_profile_result(self, result):
+        """
+        把master收集好的profile结果回应给发起请求的admin连接
+        :param result:
+        :return:
+        """
+        request = self.factory.proxy.profile_requests.pop(result.pop('profile_id'), None)
+        if not request:
+            return
+
+        admin_conn, box = request
+        if not admin_conn.connected:
+            # 已经断开了，不用回应
+            return
+
+        admin_conn.transport.write(box.map(dict(
+            body=json.dumps(result),
+        )).pack())
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+
+"""
+以OpenMetrics文本格式输出proxy的统计，供Prometheus抓取
+输出是分批生成的，每生成一批就让出reactor，不会因为cmd很多而卡住转发
+"""
+
+from collections import defaultdict
+
+from twisted.web.resource import Resource
+from twisted.web.server import Site, NOT_DONE_YET
+from twisted.internet.task import cooperate, TaskStopped
+
+from ...share import constants
+from ...share.log import logger
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+
+def escape_label_value(value):
+    """
+    转义label的值
+    :param value:
+    :return:
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    """
+    :param labels: [(name, value), ...]
+    :return: {name="value",...}
+    """
+    if not labels:
+        return ''
+
+    return '{%s}' % ','.join('%s="%s"' % (name, escape_label_value(value)) for name, value in labels)
+
+
+class MetricsConnectionFactory(Site):
+
+    def __init__(self, proxy):
+        Site.__init__(self, MetricsResource(proxy))
+        self.proxy = proxy
+
+
+class MetricsResource(Resource):
+    isLeaf = True
+
+    # 攒够这么多行之后才写一次
+    write_lines_count = 200
+    # 每读取这么多个worker的共享内存统计就让出一次reactor
+    worker_stat_slots_step = 8
+
+    def __init__(self, proxy):
+        Resource.__init__(self)
+        self.proxy = proxy
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', CONTENT_TYPE)
+
+        task = cooperate(self._write_metrics(request))
+
+        def on_request_lost(failure):
+            # 客户端提前断开了，不用再生成了
+            try:
+                task.stop()
+            except Exception:
+                pass
+
+        def on_task_done(result):
+            request.finish()
+
+        def on_task_fail(failure):
+            if failure.check(TaskStopped):
+                return
+            logger.error('render metrics fail. proxy: %s, failure: %s', self.proxy, failure.getTraceback())
+            request.finish()
+
+        request.notifyFinish().addErrback(on_request_lost)
+        task.whenDone().addCallbacks(on_task_done, on_task_fail)
+
+        return NOT_DONE_YET
+
+    def _write_metrics(self, request):
+        """
+        逐批写入，每次yield都会让出reactor
+        :param request:
+        :return:
+        """
+        lines = []
+        for metric_lines in self._iter_metrics():
+            lines.extend(metric_lines)
+            if len(lines) >= self.write_lines_count:
+                request.write('\n'.join(lines) + '\n')
+                lines = []
+            yield
+
+        lines.append('# EOF')
+        request.write('\n'.join(lines) + '\n')
+
+    def _iter_metrics(self):
+        """
+        每次返回一组指标的文本行
+        :return:
+        """
+        stat_counter = self.proxy.stat_counter
+        for _ in stat_counter.iter_update_worker_stat(self.worker_stat_slots_step):
+            yield []
+        worker_stat = stat_counter.worker_stat(update=False)
+        task_dispatcher = self.proxy.task_dispatcher
+        group_config = self.proxy.app.config['GROUP_CONFIG']
+
+        yield self._family_lines('burst_clients', 'gauge', 'Client connections.',
+                                 [((), stat_counter.clients)])
+        yield self._family_lines('burst_client_requests', 'counter', 'Requests received from clients.',
+                                 [((), stat_counter.client_req)])
+        yield self._family_lines('burst_client_responses', 'counter', 'Responses sent to clients.',
+                                 [((), stat_counter.client_rsp)])
+
+        yield self._family_lines('burst_worker_requests', 'counter', 'Tasks assigned to workers.', [
+            ((('group', group_id),), count) for group_id, count in stat_counter.worker_req_counter.items()
+        ])
+        yield self._family_lines('burst_worker_responses', 'counter', 'Tasks finished by workers.', [
+            ((('group', group_id),), count) for group_id, count in stat_counter.worker_rsp_counter.items()
+        ])
+
+        yield self._family_lines('burst_workers', 'gauge', 'Configured workers.', [
+            ((('group', group_id),), group_info['count']) for group_id, group_info in group_config.items()
+        ])
+        yield self._family_lines('burst_idle_workers', 'gauge', 'Idle workers.', [
+            ((('group', group_id),), len(workers)) for group_id, workers in task_dispatcher.idle_workers_dict.items()
+        ])
+        yield self._family_lines('burst_busy_workers', 'gauge', 'Busy workers.', [
+            ((('group', group_id),), len(workers)) for group_id, workers in task_dispatcher.busy_workers_dict.items()
+        ])
+        # 包括等待固定worker的任务
+        lane_pending = task_dispatcher.get_lane_pending()
+        group_pending = defaultdict(int)
+        for (group_id, lane), count in lane_pending.items():
+            group_pending[group_id] += count
+        yield self._family_lines('burst_pending_tasks', 'gauge', 'Tasks waiting in the group queue.', [
+            ((('group', group_id),), count) for group_id, count in group_pending.items()
+        ])
+        yield self._family_lines('burst_pending_flows', 'gauge', 'Clients with tasks waiting in the fair queue.', [
+            ((('group', group_id),), queue.flow_count())
+            for group_id, queue in task_dispatcher.group_queue.queue_dict.items()
+        ])
+        yield self._family_lines('burst_expired_tasks', 'counter', 'Tasks dropped after waiting too long in queue.', [
+            ((('group', group_id),), count) for group_id, count in stat_counter.expired_tasks_counter.items()
+        ])
+        yield self._family_lines('burst_disconnected_tasks', 'counter', 'Tasks dropped after the client left.', [
+            ((('group', group_id),), count) for group_id, count in stat_counter.disconnected_tasks_counter.items()
+        ])
+
+        lane_names = task_dispatcher.group_queue.lane_names
+        yield self._family_lines('burst_lane_requests', 'counter', 'Requests received by priority lane.', [
+            ((('lane', lane),), count) for lane, count in stat_counter.lane_req_counter.items()
+        ])
+        yield self._family_lines('burst_lane_rejected', 'counter', 'Requests rejected because the lane was full.', [
+            ((('lane', lane),), count) for lane, count in stat_counter.lane_rejected_counter.items()
+        ])
+        yield self._family_lines('burst_lane_pending_tasks', 'gauge', 'Tasks waiting in the group queue by lane.', [
+            ((('group', group_id), ('lane', lane_names[lane])), count)
+            for (group_id, lane), count in lane_pending.items()
+        ])
+
+        yield self._family_lines('burst_spillover_out', 'counter', 'Tasks served by workers borrowed from other groups.', [
+            ((('group', group_id),), count) for group_id, count in stat_counter.spillover_out_counter.items()
+        ])
+        yield self._family_lines('burst_spillover_in', 'counter', 'Tasks served for other groups by idle workers.', [
+            ((('group', group_id),), count) for group_id, count in stat_counter.spillover_in_counter.items()
+        ])
+        yield self._family_lines('burst_affinity_hits', 'counter', 'Tasks handled by their affinity worker.', [
+            ((('group', group_id),), count) for group_id, count in stat_counter.affinity_hit_counter.items()
+        ])
+        yield self._family_lines('burst_affinity_misses', 'counter', 'Tasks moved off their busy affinity worker.', [
+            ((('group', group_id),), count) for group_id, count in stat_counter.affinity_miss_counter.items()
+        ])
+        yield self._family_lines('burst_rejected_tasks', 'counter', 'Requests rejected by the proxy.', [
+            ((('group', group_id), ('reason', reason)), count)
+            for reason, counter in stat_counter.rejected_tasks_counter.items()
+            for group_id, count in counter.items()
+        ])
+
+        yield self._family_lines('burst_cmd_requests', 'counter', 'Requests received from clients by cmd.', [
+            ((('cmd', cmd),), count) for cmd, count in stat_counter.cmd_req_counter.items()
+        ])
+        yield self._family_lines('burst_cmd_responses', 'counter', 'Tasks finished by workers by cmd.', [
+            ((('cmd', cmd),), count) for cmd, count in stat_counter.cmd_rsp_counter.items()
+        ])
+        yield self._family_lines('burst_endpoint_requests', 'counter', 'Requests handled by workers by endpoint.', [
+            ((('endpoint', endpoint),), count) for endpoint, count in worker_stat['endpoint_req'].items()
+        ])
+        yield self._family_lines('burst_endpoint_exceptions', 'counter', 'Exceptions raised by view functions.', [
+            ((('endpoint', endpoint),), count) for endpoint, count in worker_stat['endpoint_exc'].items()
+        ])
+        yield self._family_lines('burst_worker_counter', 'counter', 'Custom counters incremented by workers.', [
+            ((('name', name),), value) for name, value in worker_stat['counters'].items()
+        ])
+
+        # 直方图比较大，每个单独输出
+        buckets = [int(value * 1000000) for value in sorted(self.proxy.app.config['METRICS_BUCKETS'])]
+
+        yield self._family_lines('burst_task_seconds', 'histogram', 'Task time by group.')
+        for kind in constants.TASK_TIME_KINDS:
+            for group_id, histogram in stat_counter.tasks_time_hist_dict[kind].items():
+                yield self._histogram_lines('burst_task_seconds', (('group', group_id), ('kind', kind)),
+                                            histogram, buckets)
+
+        yield self._family_lines('burst_cmd_task_seconds', 'histogram', 'Task time by cmd.')
+        for kind in constants.TASK_TIME_KINDS:
+            for cmd, histogram in stat_counter.cmd_time_hist_dict[kind].items():
+                yield self._histogram_lines('burst_cmd_task_seconds', (('cmd', cmd), ('kind', kind)),
+                                            histogram, buckets)
+
+        yield self._family_lines('burst_lane_queue_seconds', 'histogram', 'Queue time by priority lane.')
+        for lane, histogram in stat_counter.lane_queue_time_hist_dict.items():
+            yield self._histogram_lines('burst_lane_queue_seconds', (('lane', lane),), histogram, buckets)
+
+        yield self._family_lines('burst_endpoint_seconds', 'histogram', 'Handler time in workers by endpoint.')
+        for endpoint, histogram in worker_stat['endpoint_time_hist'].items():
+            yield self._histogram_lines('burst_endpoint_seconds', (('endpoint', endpoint),), histogram, buckets)
+
+    def _family_lines(self, name, metric_type, help_text, samples=()):
+        """
+        :param samples: [(labels, value), ...]
+        :return:
+        """
+        lines = [
+            '# TYPE %s %s' % (name, metric_type),
+            '# HELP %s %s' % (name, help_text),
+        ]
+
+        sample_name = name + '_total' if metric_type == 'counter' else name
+        for labels, value in samples:
+            lines.append('%s%s %s' % (sample_name, format_labels(labels), value))
+
+        return lines
+
+    def _histogram_lines(self, name, labels, histogram, buckets):
+        """
+        :param buckets: 从小到大排好的桶的上界，单位与直方图一致(微秒)
+        :return:
+        """
+        lines = []
+
+        for bucket, count in zip(buckets, histogram.cumulative_counts(buckets)):
+            lines.append('%s_bucket%s %s' % (
+                name, format_labels(labels + (('le', repr(bucket / 1000000.0)),)), count))
+
+        lines.append('%s_bucket%s %s' % (name, format_labels(labels + (('le', '+Inf'),)), histogram.total_count))
+        lines.append('%s_count%s %s' % (name, format_labels(labels), histogram.total_count))
+        lines.append('%s_sum%s %r' % (name, format_labels(labels), histogram.total_value / 1000000.0))
+
+        return lines
@@ -7,7 +7,8 @@ from twisted.internet.protocol import Protocol, Factory, connectionDone
 from ...share.utils import safe_call
 from ...share.log import logger
 from ...share import constants
-from ...share.task import Task
+from ...share.task import Task, pack_batch, unpack_batch
+from ..read_buffer import ReadBuffer
 
 
 class WorkerConnectionFactory(Factory):
@@ -24,11 +25,13 @@ class WorkerConnection(Protocol):
 
     # 状态
     _status = None
-    # 任务开始时间
-    _task_begin_time = None
+    # 是否正在退休，退休中不再分配新任务
+    retiring = False
 
-    # 正在处理的任务
-    _doing_task_container = None
+    # 正在处理的任务 {sn: task_container}
+    _doing_task_dict = None
+    # 最近一次分配的任务序号
+    _task_sn = 0
     # 读取缓冲
     _read_buffer = None
 
@@ -42,7 +45,8 @@ class WorkerConnection(Protocol):
         self.factory = factory
         self.address = address
         self.group_id = group_id
-        self._read_buffer = ''
+        self._doing_task_dict = dict()
+        self._read_buffer = ReadBuffer()
 
     def connectionMade(self):
         if self.factory.proxy.task_dispatcher.reloading:
@@ -66,39 +70,55 @@ class WorkerConnection(Protocol):
         :param data:
         :return:
         """
-        self._read_buffer += data
+        self._read_buffer.append(data)
 
         while self._read_buffer:
             # 因为box后面还是要用的
             task = Task()
-            ret = task.unpack(self._read_buffer)
+            ret = task.unpack(self._read_buffer.view())
             if ret == 0:
                 # 说明要继续收
                 return
             elif ret > 0:
                 # 收好了
-                self._read_buffer = self._read_buffer[ret:]
+                self._read_buffer.skip(ret)
                 safe_call(self._on_read_complete, task)
                 continue
             else:
                 # 数据已经混乱了，全部丢弃
                 logger.error('buffer invalid. proxy: %s, ret: %d, read_buffer: %r',
                              self.factory.proxy, ret, self._read_buffer)
-                self._read_buffer = ''
+                self._read_buffer.clear()
                 return
 
     def alloc_task(self):
         """
         申请任务，如果申请到的话，就直接开始执行
-        :return:
+        会一直申请到处理中的任务达到prefetch个，或者没有任务了为止
+        :return: 申请到的任务个数
         """
-        # 无论有没有任务，都会标记自己空闲
-        task_container = self.factory.proxy.task_dispatcher.alloc_task(self)
-        if task_container:
+        if self.retiring:
+            # 退休中，不再申请任务
+            self._try_finish_retire()
+            return 0
+
+        task_container_list = []
+
+        while len(self._doing_task_dict) < self.prefetch:
+            # 申请不到任务时，会根据处理中的任务数标记自己空闲或繁忙
+            task_container = self.factory.proxy.task_dispatcher.alloc_task(self)
+            if not task_container:
+                break
+
+            # 先记录下来，这样申请下一个任务时，处理中的任务数才是对的
+            self._on_task_begin(task_container)
+            task_container_list.append(task_container)
+
+        if task_container_list:
             # 如果能申请成功，就继续执行
-            self._assign_task(task_container)
+            self._send_tasks(task_container_list)
 
-        return task_container
+        return len(task_container_list)
 
     def _on_read_complete(self, task):
         """
@@ -108,18 +128,54 @@ class WorkerConnection(Protocol):
         """
 
         if task.cmd == constants.CMD_WORKER_TASK_DONE:
-            self._on_task_end()
+            self._on_task_done(task)
+            self.alloc_task()
 
-            # 如果有数据，就要先处理
-            if task.body:
-                # 要转发数据给原来的用户
-                # 要求连接存在，并且连接还处于连接中
-                if self._doing_task_container.client_conn and self._doing_task_container.client_conn.connected:
-                    self._doing_task_container.client_conn.transport.write(task.body)
+        elif task.cmd == constants.CMD_WORKER_TASK_BATCH_DONE:
+            for sub_task in unpack_batch(task.body):
+                self._on_task_done(sub_task)
+            self.alloc_task()
 
-                    self.factory.proxy.stat_counter.client_rsp += 1
+        elif task.cmd == constants.CMD_WORKER_RETIRE:
+            self.retiring = True
+            self.factory.proxy.task_dispatcher.retire_worker(self)
+            self._try_finish_retire()
 
-            self.alloc_task()
+    def _try_finish_retire(self):
+        """
+        退休中的worker处理完所有任务后，通知worker退出
+        :return:
+        """
+        if self._doing_task_dict:
+            return False
+
+        self.transport.write(Task(dict(
+            cmd=constants.CMD_WORKER_RETIRE,
+        )).pack())
+        return True
+
+    def _on_task_done(self, task):
+        """
+        单个任务完成
+        :param task:
+        :return:
+        """
+        task_container = self._doing_task_dict.pop(task.sn, None)
+        if not task_container:
+            logger.error('task not found. worker: %s, sn: %s', self, task.sn)
+            return
+
+        self.factory.proxy.task_dispatcher.update_prefetch_worker(self)
+        self._on_task_end(task_container)
+
+        # 如果有数据，就要先处理
+        if task.body:
+            # 要转发数据给原来的用户
+            # 要求连接存在，并且连接还处于连接中
+            if task_container.client_conn and task_container.client_conn.connected:
+                task_container.client_conn.transport.write(task.body)
+
+                self.factory.proxy.stat_counter.client_rsp += 1
 
     def _assign_task(self, task_container):
         """
@@ -127,10 +183,21 @@ class WorkerConnection(Protocol):
         :param task_container:
         :return:
         """
-        self._doing_task_container = task_container
-        # 发送
-        self.transport.write(task_container.task.pack())
-        self._on_task_begin()
+        self._on_task_begin(task_container)
+        self._send_tasks([task_container])
+
+    def _send_tasks(self, task_container_list):
+        """
+        发送任务，开启batch时，多个任务合并为一个包发送
+        :param task_container_list:
+        :return:
+        """
+        data_list = [task_container.task.pack() for task_container in task_container_list]
+
+        if self.batch and len(data_list) > 1:
+            self.transport.write(pack_batch(constants.CMD_WORKER_TASK_BATCH_ASSIGN, data_list))
+        else:
+            self.transport.writeSequence(data_list)
 
     @property
     def status(self):
@@ -140,26 +207,64 @@ class WorkerConnection(Protocol):
     def status(self, value):
         self._status = value
 
-        if self._status == constants.WORKER_STATUS_IDLE:
-            # 没有正在处理的任务
-            self._doing_task_container = None
-            self._task_begin_time = None
+    @property
+    def doing_task_count(self):
+        """
+        处理中的任务个数
+        :return:
+        """
+        return len(self._doing_task_dict)
+
+    @property
+    def prefetch(self):
+        """
+        最多同时分配给worker的任务个数
+        :return:
+        """
+        group_info = self.factory.proxy.app.config['GROUP_CONFIG'].get(self.group_id) or {}
+        return max(group_info.get('prefetch', 1), 1)
+
+    @property
+    def batch(self):
+        """
+        是否批量分配任务
+        :return:
+        """
+        group_info = self.factory.proxy.app.config['GROUP_CONFIG'].get(self.group_id) or {}
+        return group_info.get('batch', False)
 
-    def _on_task_begin(self):
+    def _on_task_begin(self, task_container):
         """
         当作业开始
         :return:
         """
-        self.factory.proxy.stat_counter.add_worker_req(self.group_id)
-        self._task_begin_time = time.time()
+        # worker回应时会带上sn，用来找到对应的任务
+        self._task_sn = self._task_sn % 0xFFFFFFFF + 1
+        task_container.task.sn = self._task_sn
+        self._doing_task_dict[self._task_sn] = task_container
+        self.factory.proxy.task_dispatcher.update_prefetch_worker(self)
+
+        # 借用的worker处理的任务，统计在任务所属的分组上
+        self.factory.proxy.stat_counter.add_worker_req(task_container.group_id)
+        if task_container.group_id != self.group_id:
+            self.factory.proxy.stat_counter.add_spillover_task(task_container.group_id, self.group_id)
+
+        task_container.begin_time = time.time()
+        self.factory.proxy.admission.add_queue_time(
+            task_container.group_id, task_container.begin_time - task_container.enqueue_time)
 
-    def _on_task_end(self):
+    def _on_task_end(self, task_container):
         """
         当作业结束
         :return:
         """
         now = time.time()
-        past_time_ms = int((now - self._task_begin_time) * 1000)
 
-        self.factory.proxy.stat_counter.add_task_time(past_time_ms)
-        self.factory.proxy.stat_counter.add_worker_rsp(self.group_id)
+        self.factory.proxy.stat_counter.add_task_time(
+            task_container.group_id, task_container.cmd,
+            task_container.begin_time - task_container.enqueue_time,
+            now - task_container.begin_time,
+            self.factory.proxy.task_dispatcher.group_queue.lane_names[task_container.lane],
+        )
+        self.factory.proxy.stat_counter.add_worker_rsp(task_container.group_id)
+        self.factory.proxy.stat_counter.add_cmd_rsp(task_container.cmd)
@@ -4,8 +4,375 @@
 封装通过group_id来访问数据的功能
 """
 
-from collections import defaultdict
-import Queue
+from collections import defaultdict, deque
+
+from ..share import constants
+
+
+class Queue(object):
+    """
+    单线程使用的队列，proxy运行在reactor线程里，不需要加锁
+    item需要有queued属性，队列用它标记item是否还在队列中
+    取消只是打上标记，取出时再跳过，所以取消是O(1)的
+    """
+
+    # <=0 代表无限
+    max_size = None
+
+    # 取消的item比有效的多时，才重建队列
+    compact_min_count = 64
+
+    _items = None
+    # 已经取消但还在_items中的个数
+    _cancelled_count = 0
+
+    def __init__(self, max_size=-1):
+        self.max_size = max_size
+        self._items = deque()
+        self._cancelled_count = 0
+
+    def put(self, item):
+        """
+        加入item
+        :param item:
+        :return: 如果成功返回True，队列满了返回False
+        """
+        if self.full():
+            return False
+
+        item.queued = True
+        self._items.append(item)
+        return True
+
+    def get(self):
+        """
+        取出item
+        :return: 队列为空时返回None
+        """
+        while self._items:
+            item = self._items.popleft()
+            if not item.queued:
+                # 已经取消了
+                self._cancelled_count -= 1
+                continue
+
+            item.queued = False
+            return item
+
+        return None
+
+    def peek(self):
+        """
+        查看队首的item，不取出
+        :return: 队列为空时返回None
+        """
+        while self._items:
+            item = self._items[0]
+            if item.queued:
+                return item
+
+            # 顺便把已经取消的丢掉
+            self._items.popleft()
+            self._cancelled_count -= 1
+
+        return None
+
+    def cancel(self, item):
+        """
+        取消队列中的item
+        :param item:
+        :return: 是否取消成功，已经不在队列中时返回False
+        """
+        if not item.queued:
+            return False
+
+        item.queued = False
+        self._cancelled_count += 1
+
+        if self._cancelled_count >= self.compact_min_count and self._cancelled_count * 2 > len(self._items):
+            # 重建的开销均摊到每次取消上
+            self._items = deque(item for item in self._items if item.queued)
+            self._cancelled_count = 0
+
+        return True
+
+    def drain(self, count=None):
+        """
+        批量取出
+        :param count: 最多取出的个数，None 代表全部取出
+        :return: list
+        """
+        if count is None or count >= self.qsize():
+            items = [item for item in self._items if item.queued]
+            self.clear()
+            return items
+
+        return [self.get() for _ in xrange(count)]
+
+    def clear(self):
+        for item in self._items:
+            item.queued = False
+
+        self._items.clear()
+        self._cancelled_count = 0
+
+    def full(self):
+        return 0 < self.max_size <= self.qsize()
+
+    def empty(self):
+        return not self.qsize()
+
+    def qsize(self):
+        return len(self._items) - self._cancelled_count
+
+
+class FairQueue(object):
+    """
+    公平队列，按item.flow(比如客户端连接)分成多个子队列，轮流取出
+    一个客户端塞进大量任务时，只会排在它自己的子队列里，不影响其他客户端
+    item需要有flow属性，接口与Queue一致
+    """
+
+    # 所有子队列加起来的最大长度，<=0 代表无限
+    max_size = None
+
+    # {flow: Queue}
+    _flow_dict = None
+    # 轮流取出的顺序，每个flow只会出现一次
+    _active_flows = None
+    # 有效的item个数
+    _size = 0
+
+    def __init__(self, max_size=-1):
+        self.max_size = max_size
+        self._flow_dict = dict()
+        self._active_flows = deque()
+        self._size = 0
+
+    def put(self, item):
+        """
+        加入item所在flow的子队列
+        :param item:
+        :return: 如果成功返回True，队列满了返回False
+        """
+        if self.full():
+            return False
+
+        flow_queue = self._flow_dict.get(item.flow)
+        if flow_queue is None:
+            flow_queue = self._flow_dict[item.flow] = Queue()
+            self._active_flows.append(item.flow)
+
+        flow_queue.put(item)
+        self._size += 1
+        return True
+
+    def get(self):
+        """
+        从下一个flow的子队列取出item
+        :return: 队列为空时返回None
+        """
+        active_flows = self._active_flows
+        while active_flows:
+            flow = active_flows.popleft()
+            flow_queue = self._flow_dict[flow]
+
+            item = flow_queue.get()
+            if flow_queue.empty():
+                # 子队列空了就删掉，之后再来任务时重新排到最后
+                del self._flow_dict[flow]
+            else:
+                active_flows.append(flow)
+
+            if item is not None:
+                self._size -= 1
+                return item
+
+        return None
+
+    def cancel(self, item):
+        """
+        取消队列中的item
+        子队列取消空了也不删掉，轮到它时再删，保证每个flow在_active_flows中只出现一次
+        :param item:
+        :return: 是否取消成功
+        """
+        flow_queue = self._flow_dict.get(item.flow)
+        if flow_queue is None or not flow_queue.cancel(item):
+            return False
+
+        self._size -= 1
+        return True
+
+    def drain(self, count=None):
+        """
+        批量取出，顺序与逐个get一致
+        :param count: 最多取出的个数，None 代表全部取出
+        :return: list
+        """
+        if count is None:
+            count = self._size
+
+        items = []
+        for _ in xrange(count):
+            item = self.get()
+            if item is None:
+                break
+            items.append(item)
+
+        return items
+
+    def clear(self):
+        for flow_queue in self._flow_dict.values():
+            flow_queue.clear()
+
+        self._flow_dict.clear()
+        self._active_flows.clear()
+        self._size = 0
+
+    def full(self):
+        return 0 < self.max_size <= self._size
+
+    def empty(self):
+        return not self._size
+
+    def qsize(self):
+        return self._size
+
+    def flow_count(self):
+        """
+        当前有任务在排队的flow个数
+        :return:
+        """
+        return len(self._flow_dict)
+
+
+class LaneQueue(object):
+    """
+    多个优先级通道组成的队列，每个通道内部是FIFO
+    item需要有lane属性，代表所在通道的下标
+    """
+
+    # 调度方式
+    policy = None
+
+    # 各个通道的队列，下标越小优先级越高
+    lanes = None
+    # 各个通道的权重
+    weights = None
+
+    # 平滑加权轮询的当前权重
+    _current_weights = None
+
+    def __init__(self, lane_configs, policy=constants.PRIORITY_POLICY_STRICT, fair=False):
+        """
+        :param lane_configs: [dict(max_size=, weight=), ...]
+        :param policy:
+        :param fair: 通道内部是否按flow公平调度
+        """
+        self.policy = policy
+        queue_class = FairQueue if fair else Queue
+        self.lanes = [queue_class(lane_config['max_size']) for lane_config in lane_configs]
+        self.weights = [max(lane_config['weight'], 1) for lane_config in lane_configs]
+        self._current_weights = [0] * len(lane_configs)
+
+    def put(self, item):
+        """
+        放入item.lane对应的通道
+        :param item:
+        :return: 如果成功返回True，通道满了返回False
+        """
+        return self.lanes[item.lane].put(item)
+
+    def get(self):
+        """
+        按调度方式从某个通道取出item
+        :return: 队列为空时返回None
+        """
+        lanes = self.lanes
+        if len(lanes) == 1:
+            return lanes[0].get()
+
+        if self.policy == constants.PRIORITY_POLICY_WEIGHTED:
+            return self._get_weighted()
+
+        # 严格优先级，高优先级的通道空了才轮到低优先级的
+        for lane in lanes:
+            if not lane.empty():
+                return lane.get()
+
+        return None
+
+    def _get_weighted(self):
+        """
+        平滑加权轮询，只在非空的通道间分配
+        低优先级的通道也能按权重得到处理，不会饿死
+        :return:
+        """
+        current_weights = self._current_weights
+
+        selected = None
+        total_weight = 0
+        for index, lane in enumerate(self.lanes):
+            if lane.empty():
+                continue
+
+            current_weights[index] += self.weights[index]
+            total_weight += self.weights[index]
+
+            if selected is None or current_weights[index] > current_weights[selected]:
+                selected = index
+
+        if selected is None:
+            return None
+
+        current_weights[selected] -= total_weight
+        return self.lanes[selected].get()
+
+    def cancel(self, item):
+        return self.lanes[item.lane].cancel(item)
+
+    def drain(self, count=None):
+        """
+        批量取出，顺序与逐个get一致
+        :param count: 最多取出的个数，None 代表全部取出
+        :return: list
+        """
+        if count is None:
+            count = self.qsize()
+
+        items = []
+        for _ in xrange(count):
+            item = self.get()
+            if item is None:
+                break
+            items.append(item)
+
+        return items
+
+    def clear(self):
+        for lane in self.lanes:
+            lane.clear()
+
+    def full(self, lane=0):
+        return self.lanes[lane].full()
+
+    def empty(self):
+        return not self.qsize()
+
+    def qsize(self):
+        return sum(lane.qsize() for lane in self.lanes)
+
+    def lane_qsize(self, lane):
+        return self.lanes[lane].qsize()
+
+    def flow_count(self):
+        """
+        有任务在排队的flow个数，不是公平队列时为0
+        同一个flow在多个通道中排队时会重复计算
+        :return:
+        """
+        return sum(lane.flow_count() for lane in self.lanes if isinstance(lane, FairQueue))
 
 
 class GroupQueue(object):
@@ -16,16 +383,40 @@ class GroupQueue(object):
     max_size = None
     queue_dict = None
 
-    def __init__(self, max_size=-1):
+    # 优先级通道的配置 [dict(name=, weight=, max_size=), ...]
+    lane_configs = None
+    # 通道的名字，与下标对应
+    lane_names = None
+    # 通道的调度方式
+    policy = None
+    # 通道内部是否按flow公平调度
+    fair = False
+
+    def __init__(self, max_size=-1, lane_configs=None, policy=constants.PRIORITY_POLICY_STRICT, fair=False):
+        """
+        :param max_size: 通道没有单独配置max_size时使用
+        :param lane_configs: [dict(name=, weight=, max_size=), ...]，None 代表只有一个通道
+        :param policy:
+        :param fair: 通道内部是否按flow公平调度
+        """
         self.max_size = max_size
         self.queue_dict = defaultdict(self._queue_factory)
 
+        self.lane_configs = [dict(
+            name=lane_config.get('name'),
+            weight=lane_config.get('weight', 1),
+            max_size=lane_config.get('max_size', max_size),
+        ) for lane_config in (lane_configs or [dict()])]
+        self.lane_names = [lane_config['name'] for lane_config in self.lane_configs]
+        self.policy = policy
+        self.fair = fair
+
     def _queue_factory(self):
         """
         生成queue的工厂
         :return:
         """
-        return Queue.Queue(self.max_size)
+        return LaneQueue(self.lane_configs, self.policy, self.fair)
 
     def put(self, group_id, item):
         """
@@ -35,19 +426,32 @@ class GroupQueue(object):
         :param item:
         :return:
         """
-        try:
-            self.queue_dict[group_id].put_nowait(item)
-            return True
-        except Queue.Full:
-            return False
-        except:
-            return False
+        return self.queue_dict[group_id].put(item)
 
     def get(self, group_id):
-        if self.empty(group_id):
-            return None
-        else:
-            return self.queue_dict[group_id].get_nowait()
+        return self.queue_dict[group_id].get()
+
+    def cancel(self, group_id, item):
+        """
+        取消队列中的item
+        :param group_id:
+        :param item:
+        :return: 是否取消成功
+        """
+        queue = self.queue_dict.get(group_id)
+        if queue is None:
+            return False
+
+        return queue.cancel(item)
+
+    def drain(self, group_id, count=None):
+        """
+        批量取出
+        :param group_id:
+        :param count: 最多取出的个数，None 代表全部取出
+        :return: list
+        """
+        return self.queue_dict[group_id].drain(count)
 
     def clear(self, group_id):
         """
@@ -55,13 +459,17 @@ class GroupQueue(object):
         :param group_id:
         :return:
         """
-        self.queue_dict.pop(group_id, None)
+        queue = self.queue_dict.pop(group_id, None)
+        if queue is not None:
+            queue.clear()
 
     def clear_all(self):
         """
         清空所有
         :return:
         """
+        for queue in self.queue_dict.values():
+            queue.clear()
         self.queue_dict.clear()
 
     def empty(self, group_id):
@@ -79,3 +487,12 @@ class GroupQueue(object):
         :return:
         """
         return self.queue_dict[group_id].qsize()
+
+    def lane_qsize(self, group_id, lane):
+        """
+        某个队列中某个通道的size
+        :param group_id:
+        :param lane:
+        :return:
+        """
+        return self.queue_dict[group_id].lane_qsize(lane)
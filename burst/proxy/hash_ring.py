@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+"""
+一致性哈希环
+节点增减时，只有落在该节点上的key会换到其他节点，其他key的映射不变
+"""
+
+import bisect
+import hashlib
+
+
+def hash_key(key):
+    """
+    :param key:
+    :return: 32位整数
+    """
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+
+    return int(hashlib.md5(str(key)).hexdigest()[:8], 16)
+
+
+class HashRing(object):
+    """
+    一致性哈希环，每个节点在环上有多个虚拟节点，使key分布更均匀
+    """
+
+    # 每个节点的虚拟节点个数
+    replicas = 160
+
+    # 环上的位置，从小到大
+    _positions = None
+    # 与_positions对应的节点
+    _nodes = None
+
+    def __init__(self, node_dict, replicas=None):
+        """
+        :param node_dict: {node_key: node}，node_key决定节点在环上的位置
+        :param replicas:
+        """
+        if replicas is not None:
+            self.replicas = replicas
+
+        points = sorted(
+            (hash_key('%s-%s' % (node_key, index)), node)
+            for node_key, node in node_dict.items()
+            for index in xrange(self.replicas)
+        )
+
+        self._positions = [position for position, node in points]
+        self._nodes = [node for position, node in points]
+
+    def get(self, key):
+        """
+        获取key对应的节点
+        :param key:
+        :return: 环为空时返回None
+        """
+        if not self._nodes:
+            return None
+
+        index = bisect.bisect(self._positions, hash_key(key)) % len(self._nodes)
+        return self._nodes[index]
+
+    def __repr__(self):
+        return '<%s nodes: %s>' % (type(self).__name__, len(self._nodes) // self.replicas)
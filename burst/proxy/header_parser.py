@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+"""
+只解析box的包头，不解析包体
+用于 GROUP_ROUTER 只依赖包头字段(如cmd)的场景，包体会原样转发给worker
+"""
+
+import struct
+
+from ..share.log import logger
+
+
+class HeaderBox(object):
+    """
+    只填充了包头字段的box，body 为空
+    GROUP_ROUTER、直接回应拒绝等只用到包头字段，需要完整的box时再用原始数据解析
+    """
+
+    body = ''
+    # 整个包的原始数据，由连接在解析之后赋值
+    _raw_data = None
+
+    def __init__(self, box_class, dict_values):
+        self.__dict__.update(dict_values)
+        self._box_class = box_class
+
+    def to_box(self):
+        """
+        生成完整的box
+        :return:
+        """
+        box = self._box_class()
+        if self._raw_data is not None:
+            box.unpack(self._raw_data)
+        else:
+            for k in box.header_attrs:
+                setattr(box, k, getattr(self, k))
+        return box
+
+    def map(self, map_data):
+        return self.to_box().map(map_data)
+
+    def __repr__(self):
+        return '<%s %r>' % (type(self).__name__, self.__dict__)
+
+
+class HeaderParser(object):
+    """
+    包头解析
+    """
+
+    box_class = None
+
+    # 预编译好的包头格式
+    header_struct = None
+    # 包头字段名
+    header_keys = None
+
+    # 只用来校验包头，不用每个包都创建box
+    _verify_box = None
+    # 包头里的长度字段
+    _len_key = None
+
+    def __init__(self, box_class):
+        self.box_class = box_class
+
+        # 用一个实例拿到包头格式，之后就不用每次都计算了
+        self._verify_box = self.box_class()
+        self.header_struct = struct.Struct(self._verify_box.header_fmt)
+        self.header_keys = self._verify_box.header_attrs.keys()
+
+        if 'packet_len' in self.header_keys:
+            self._len_key = 'packet_len'
+        elif 'body_len' in self.header_keys:
+            self._len_key = 'body_len'
+
+    def parse(self, buf):
+        """
+        解析包头
+        :param buf: 未读取部分的视图
+        :return: (ret, box)
+            ret 与 box.unpack 的返回值含义一致: >0 包的长度，0 继续收，<0 报错
+            box 为 HeaderBox，只填充了包头字段
+        """
+        header_size = self.header_struct.size
+        if len(buf) < header_size:
+            return 0, None
+
+        try:
+            values = self.header_struct.unpack_from(buf)
+        except Exception:
+            logger.error('unpack header fail.', exc_info=True)
+            return -1, None
+
+        dict_values = dict(zip(self.header_keys, values))
+
+        if not self._verify_box.verify_header(dict_values):
+            return -2, None
+
+        if self._len_key == 'packet_len':
+            packet_len = dict_values['packet_len']
+        elif self._len_key == 'body_len':
+            packet_len = dict_values['body_len'] + header_size
+        else:
+            logger.error('there is no packet_len or body_len in header')
+            return -3, None
+
+        if packet_len < header_size:
+            return -4, None
+
+        if len(buf) < packet_len:
+            return 0, None
+
+        return packet_len, HeaderBox(self.box_class, dict_values)
@@ -2,8 +2,10 @@
 
 import signal
 import os
+import json
 # linux 默认就是epoll
 from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
 import setproctitle
 
 from netkit.box import Box
@@ -11,10 +13,14 @@ from connection.client_connection import ClientConnectionFactory
 from connection.worker_connection import WorkerConnectionFactory
 from connection.admin_connection import AdminConnectionFactory
 from connection.master_connection import MasterConnectionFactory
+from connection.metrics_connection import MetricsConnectionFactory
 from task_dispatcher import TaskDispatcher
+from admission import AdmissionController
 from stat_counter import StatCounter
+from ..share.shared_stat import SharedStat
 from ..share import constants
 from ..share.log import logger
+from ..share.utils import safe_func
 
 
 class Proxy(object):
@@ -28,6 +34,7 @@ class Proxy(object):
     worker_connection_factory_class = WorkerConnectionFactory
     admin_connection_factory_class = AdminConnectionFactory
     master_connection_factory_class = MasterConnectionFactory
+    metrics_connection_factory_class = MetricsConnectionFactory
 
     app = None
 
@@ -38,10 +45,17 @@ class Proxy(object):
     task_dispatcher = None
     # 统计
     stat_counter = None
+    # 准入控制
+    admission = None
 
     # master的连接，因为一定只有一个，所以就一个变量即可
     master_conn = None
 
+    # 等待master回应的profile请求 {profile_id: (admin_conn, box)}
+    profile_requests = None
+    # 上一个profile_id
+    last_profile_id = 0
+
     def __init__(self, app, host, port):
         """
         构造函数
@@ -52,7 +66,10 @@ class Proxy(object):
         self.port = port
 
         self.task_dispatcher = TaskDispatcher(self, self._on_workers_reload_over)
-        self.stat_counter = StatCounter(self.app.config['TASKS_TIME_BENCHMARK'])
+        self.admission = AdmissionController(self)
+        self.profile_requests = dict()
+        self.stat_counter = StatCounter(self.app.config['TASKS_TIME_BENCHMARK'],
+                                        self.app.config['STAT_CMD_MAX_COUNT'])
 
     def run(self):
         setproctitle.setproctitle(self.app.make_proc_name(self.type))
@@ -64,6 +81,8 @@ class Proxy(object):
         if not os.path.exists(ipc_directory):
             os.makedirs(ipc_directory)
 
+        self._open_shared_stat()
+
         # 启动监听master
         master_address = os.path.join(ipc_directory, self.app.config['MASTER_ADDRESS'])
         if os.path.exists(master_address):
@@ -86,22 +105,16 @@ class Proxy(object):
                           backlog=self.app.config['PROXY_BACKLOG'], interface=self.host)
 
         # 启动admin服务
-        admin_address = self.app.config['ADMIN_ADDRESS']
-
-        if admin_address:
-            if isinstance(admin_address, (list, tuple)):
-                # 说明是网络协议
-                reactor.listenTCP(admin_address[1], self.admin_connection_factory_class(self),
-                                  interface=admin_address[0])
-            elif isinstance(admin_address, str):
-                # 说明是文件
-                admin_address = os.path.join(ipc_directory, admin_address)
-                # 防止之前异常导致遗留
-                if os.path.exists(admin_address):
-                    os.remove(admin_address)
-                reactor.listenUNIX(admin_address, self.admin_connection_factory_class(self))
-            else:
-                logger.error('invalid admin address. proxy: %s, admin_address: %s', self, admin_address)
+        if self.app.config['ADMIN_ADDRESS']:
+            self._listen_address(self.app.config['ADMIN_ADDRESS'], self.admin_connection_factory_class(self))
+
+        # 启动统计输出服务
+        if self.app.config['METRICS_ADDRESS']:
+            self._listen_address(self.app.config['METRICS_ADDRESS'], self.metrics_connection_factory_class(self))
+
+        if self.app.config['AUTOSCALE_INTERVAL']:
+            # 定时上报分组负载，master据此自动伸缩
+            LoopingCall(safe_func(self._report_group_load)).start(self.app.config['AUTOSCALE_INTERVAL'], now=False)
 
         try:
             reactor.run(installSignalHandlers=False)
@@ -110,6 +123,40 @@ class Proxy(object):
         except:
             logger.error('exc occur. proxy: %s', self, exc_info=True)
 
+    def _open_shared_stat(self):
+        """
+        打开master创建的worker统计共享内存
+        :return:
+        """
+        if not self.app.config['WORKER_STAT_SHM']:
+            return
+
+        path = os.path.join(self.app.config['IPC_ADDRESS_DIRECTORY'], self.app.config['WORKER_STAT_SHM'])
+        try:
+            self.stat_counter.shared_stat = SharedStat.open(path)
+        except:
+            logger.error('open shared stat fail. proxy: %s, path: %s', self, path, exc_info=True)
+
+    def _listen_address(self, address, factory):
+        """
+        监听网络地址或者文件
+        :param address: 'admin.sock' or ('127.0.0.1', 9910)
+        :param factory:
+        :return:
+        """
+        if isinstance(address, (list, tuple)):
+            # 说明是网络协议
+            reactor.listenTCP(address[1], factory, interface=address[0])
+        elif isinstance(address, str):
+            # 说明是文件
+            address = os.path.join(self.app.config['IPC_ADDRESS_DIRECTORY'], address)
+            # 防止之前异常导致遗留
+            if os.path.exists(address):
+                os.remove(address)
+            reactor.listenUNIX(address, factory)
+        else:
+            logger.error('invalid address. proxy: %s, address: %s', self, address)
+
     def _handle_proc_signals(self):
         def stop_handler(signum, frame):
             """
@@ -146,6 +193,24 @@ class Proxy(object):
             ))
             self.master_conn.transport.write(box.pack())
 
+    def _report_group_load(self):
+        """
+        给master上报各分组的负载
+        :return:
+        """
+        if self.task_dispatcher.reloading:
+            # reload中worker数量不准
+            return
+
+        if self.master_conn and self.master_conn.transport:
+            group_load = dict([(group_id, self.task_dispatcher.get_group_load(group_id))
+                               for group_id in self.app.config['GROUP_CONFIG']])
+            box = Box(dict(
+                cmd=constants.CMD_MASTER_GROUP_LOAD,
+                body=json.dumps(group_load),
+            ))
+            self.master_conn.transport.write(box.pack())
+
     def __repr__(self):
         return '<%s name: %s>' % (
             type(self).__name__, self.app.name
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+"""
+proxy中各连接共用的读取缓冲
+底层使用bytearray + 读取偏移，避免每解析一个包就把剩余的数据整体拷贝一次
+"""
+
+
+class ReadBuffer(object):
+    """
+    读取缓冲
+    """
+
+    # 已读取部分超过这个长度，并且超过总长度的一半时，才真正删掉已读取的部分
+    compact_threshold = 4096
+
+    # 底层数据
+    _data = None
+    # 已经读取到的位置
+    _offset = 0
+
+    def __init__(self):
+        self._data = bytearray()
+        self._offset = 0
+
+    def append(self, data):
+        """
+        追加收到的数据
+        :param data:
+        :return:
+        """
+        self._data.extend(data)
+
+    def view(self):
+        """
+        未读取部分的视图，不会拷贝数据
+        对视图进行切片时，只会拷贝切片的部分，可以直接传给box.unpack
+        :return:
+        """
+        return buffer(self._data, self._offset)
+
+    def read(self, size):
+        """
+        读取并消费掉size长度的数据
+        :param size:
+        :return: str
+        """
+        data = str(self._data[self._offset:self._offset + size])
+        self.skip(size)
+        return data
+
+    def skip(self, size):
+        """
+        消费掉size长度的数据，不返回
+        :param size:
+        :return:
+        """
+        self._offset += size
+
+        if self._offset >= len(self._data):
+            # 全部读完了，直接清空即可
+            self.clear()
+        elif self._offset >= self.compact_threshold and self._offset * 2 >= len(self._data):
+            # 均摊下来，每个字节只会被移动常数次
+            del self._data[:self._offset]
+            self._offset = 0
+
+    def clear(self):
+        """
+        清空
+        :return:
+        """
+        del self._data[:]
+        self._offset = 0
+
+    def __len__(self):
+        return len(self._data) - self._offset
+
+    def __repr__(self):
+        return repr(str(self.view()))
@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
 from collections import defaultdict
 
+from ..share.histogram import LatencyHistogram
+from ..share.utils import cached_call
+from ..share import constants
+
 
 class StatCounter(object):
 
@@ -18,15 +22,61 @@ class StatCounter(object):
     worker_req_counter = None
     # worker回应数
     worker_rsp_counter = None
-    # 作业完成时间统计
-    tasks_time_counter = None
+    # 排队超时被丢弃的任务数
+    expired_tasks_counter = None
+    # 客户端已经断开被丢弃的任务数
+    disconnected_tasks_counter = None
+    # proxy直接拒绝的任务数 {reason: {group_id: count}}
+    rejected_tasks_counter = None
+    # 借用其他分组的worker处理的任务数，按任务所属的分组统计
+    spillover_out_counter = None
+    # 帮其他分组处理的任务数，按worker所属的分组统计
+    spillover_in_counter = None
+    # 分配给了固定worker的任务数
+    affinity_hit_counter = None
+    # 等待固定worker超时，分配给了其他worker的任务数
+    affinity_miss_counter = None
+    # 作业耗时直方图，单位为微秒 {kind: {group_id: LatencyHistogram}}
+    tasks_time_hist_dict = None
+    # 按cmd统计的作业耗时直方图 {kind: {cmd: LatencyHistogram}}
+    cmd_time_hist_dict = None
     # 作业时间统计标准
     tasks_time_benchmark = None
 
-    def __init__(self, tasks_time_benchmark):
+    # 按cmd统计的客户端请求数
+    cmd_req_counter = None
+    # 按cmd统计的worker回应数
+    cmd_rsp_counter = None
+    # 按cmd统计时最多记录的个数，cmd是客户端传上来的，不能无限增长
+    cmd_max_count = None
+    # 按优先级通道统计的请求数
+    lane_req_counter = None
+    # 按优先级通道统计的因为通道满了被拒绝的请求数
+    lane_rejected_counter = None
+    # 按优先级通道统计的排队时间直方图 {lane: LatencyHistogram}
+    lane_queue_time_hist_dict = None
+
+    # workers写入的共享内存统计，按endpoint统计的数据都在这里
+    shared_stat = None
+
+    def __init__(self, tasks_time_benchmark, cmd_max_count=256):
         self.worker_req_counter = defaultdict(int)
         self.worker_rsp_counter = defaultdict(int)
-        self.tasks_time_counter = defaultdict(int)
+        self.expired_tasks_counter = defaultdict(int)
+        self.disconnected_tasks_counter = defaultdict(int)
+        self.rejected_tasks_counter = defaultdict(lambda: defaultdict(int))
+        self.spillover_out_counter = defaultdict(int)
+        self.spillover_in_counter = defaultdict(int)
+        self.affinity_hit_counter = defaultdict(int)
+        self.affinity_miss_counter = defaultdict(int)
+        self.cmd_req_counter = defaultdict(int)
+        self.cmd_rsp_counter = defaultdict(int)
+        self.cmd_max_count = cmd_max_count
+        self.lane_req_counter = defaultdict(int)
+        self.lane_rejected_counter = defaultdict(int)
+        self.lane_queue_time_hist_dict = defaultdict(LatencyHistogram)
+        self.tasks_time_hist_dict = dict((kind, defaultdict(LatencyHistogram)) for kind in constants.TASK_TIME_KINDS)
+        self.cmd_time_hist_dict = dict((kind, defaultdict(LatencyHistogram)) for kind in constants.TASK_TIME_KINDS)
         self.tasks_time_benchmark = tasks_time_benchmark
 
     def add_worker_req(self, group_id):
@@ -35,24 +85,227 @@ class StatCounter(object):
     def add_worker_rsp(self, group_id):
         self.worker_rsp_counter[group_id] += 1
 
-    def add_task_time(self, task_time):
+    def add_expired_task(self, group_id):
+        self.expired_tasks_counter[group_id] += 1
+
+    def add_disconnected_task(self, group_id):
+        self.disconnected_tasks_counter[group_id] += 1
+
+    def add_rejected_task(self, group_id, reason):
+        self.rejected_tasks_counter[reason][group_id] += 1
+
+    def add_spillover_task(self, group_id, worker_group_id):
         """
-        添加一个新的时间
-        :param task_time:
+        :param group_id: 任务所属的分组
+        :param worker_group_id: 处理任务的worker所属的分组
         :return:
         """
+        self.spillover_out_counter[group_id] += 1
+        self.spillover_in_counter[worker_group_id] += 1
+
+    def add_affinity_hit(self, group_id):
+        self.affinity_hit_counter[group_id] += 1
+
+    def add_affinity_miss(self, group_id):
+        self.affinity_miss_counter[group_id] += 1
+
+    def add_lane_req(self, lane):
+        self.lane_req_counter[lane] += 1
+
+    def add_lane_rejected(self, lane):
+        self.lane_rejected_counter[lane] += 1
+
+    def add_cmd_req(self, cmd):
+        if cmd is not None:
+            self.cmd_req_counter[self._bounded_key(self.cmd_req_counter, cmd)] += 1
+
+    def add_cmd_rsp(self, cmd):
+        if cmd is not None:
+            self.cmd_rsp_counter[self._bounded_key(self.cmd_req_counter, cmd)] += 1
+
+    def add_task_time(self, group_id, cmd, queue_time, service_time, lane=None):
+        """
+        添加一个完成的任务的耗时
+        :param group_id:
+        :param cmd: 客户端请求的cmd，为None时不按cmd统计
+        :param queue_time: 在队列中等待的时间，秒
+        :param service_time: worker处理的时间，秒
+        :param lane: 所在的优先级通道，为None时不按通道统计
+        :return:
+        """
+        queue_time_us = max(int(queue_time * 1000000), 0)
+        service_time_us = max(int(service_time * 1000000), 0)
+        total_time_us = queue_time_us + service_time_us
+
+        # 每个任务都会调用，所以不用循环
+        tasks_time_hist_dict = self.tasks_time_hist_dict
+        tasks_time_hist_dict[constants.TASK_TIME_QUEUE][group_id].record(queue_time_us)
+        tasks_time_hist_dict[constants.TASK_TIME_SERVICE][group_id].record(service_time_us)
+        tasks_time_hist_dict[constants.TASK_TIME_TOTAL][group_id].record(total_time_us)
+
+        if lane is not None:
+            self.lane_queue_time_hist_dict[lane].record(queue_time_us)
+
+        if cmd is not None:
+            cmd = self._bounded_key(self.cmd_req_counter, cmd)
+
+            cmd_time_hist_dict = self.cmd_time_hist_dict
+            cmd_time_hist_dict[constants.TASK_TIME_QUEUE][cmd].record(queue_time_us)
+            cmd_time_hist_dict[constants.TASK_TIME_SERVICE][cmd].record(service_time_us)
+            cmd_time_hist_dict[constants.TASK_TIME_TOTAL][cmd].record(total_time_us)
+
+    def tasks_time_all(self, kind):
+        """
+        所有分组汇总的直方图，只在查看统计时合并，不在每个任务完成时记录
+        :param kind:
+        :return: LatencyHistogram
+        """
+        histogram = LatencyHistogram()
+        for group_histogram in self.tasks_time_hist_dict[kind].values():
+            histogram.merge(group_histogram)
+        return histogram
+
+    @property
+    def tasks_time_counter(self):
+        """
+        按 tasks_time_benchmark 统计的worker处理时间分布，单位为毫秒，与之前的格式保持一致
+        由直方图计算而来，只在查看统计时计算
+        :return:
+        """
+        histogram = self.tasks_time_all(constants.TASK_TIME_SERVICE)
+        result = dict()
+
+        below_count = 0
+        for dst_value in self.tasks_time_benchmark:
+            count = histogram.count_below(dst_value * 1000)
+            if count > below_count:
+                result[dst_value] = count - below_count
+            below_count = count
+
+        if histogram.total_count > below_count:
+            result['more'] = histogram.total_count - below_count
+
+        return result
+
+    def tasks_time_quantiles(self, cache=None):
+        """
+        作业耗时的分位数，单位为毫秒
+        :param cache: 见 _quantiles
+        :return: {kind: {'all': {...}, group_id: {...}}}
+        """
+        result = dict()
+        for kind in constants.TASK_TIME_KINDS:
+            kind_cache = self._sub_cache(cache, kind)
+            hist_dict = self.tasks_time_hist_dict[kind]
+            result[kind] = self._quantiles(hist_dict, kind_cache)
+            # 分组的直方图都没有新记录时，不需要重新合并
+            result[kind]['all'] = cached_call(kind_cache, 'all',
+                                              sum(histogram.total_count for histogram in hist_dict.values()),
+                                              lambda: self.tasks_time_all(kind).quantiles(scale=1000))
+        return result
 
-        def trans_to_counter_value(value):
-            """
-            把时间计算为一个可以统计分布的数值
-            :return:
-            """
+    def tasks_time_snapshots(self, cache=None):
+        """
+        各分组直方图的快照，可以跨机器合并
+        :param cache: 见 _quantiles
+        :return: {kind: {group_id: snapshot}}
+        """
+        return dict((kind, self._snapshots(self.tasks_time_hist_dict[kind], self._sub_cache(cache, kind)))
+                    for kind in constants.TASK_TIME_KINDS)
+
+    def cmd_time_quantiles(self, cache=None):
+        """
+        按cmd统计的作业耗时分位数，单位为毫秒
+        :param cache: 见 _quantiles
+        :return: {kind: {cmd: {...}}}
+        """
+        return dict((kind, self._quantiles(self.cmd_time_hist_dict[kind], self._sub_cache(cache, kind)))
+                    for kind in constants.TASK_TIME_KINDS)
+
+    def cmd_time_snapshots(self, cache=None):
+        """
+        按cmd统计的直方图快照
+        :param cache: 见 _quantiles
+        :return: {kind: {cmd: snapshot}}
+        """
+        return dict((kind, self._snapshots(self.cmd_time_hist_dict[kind], self._sub_cache(cache, kind)))
+                    for kind in constants.TASK_TIME_KINDS)
+
+    def lane_queue_time_quantiles(self, cache=None):
+        """
+        按优先级通道统计的排队时间分位数，单位为毫秒
+        :param cache: 见 _quantiles
+        :return: {lane: {...}}
+        """
+        return self._quantiles(self.lane_queue_time_hist_dict, cache)
+
+    def lane_queue_time_snapshots(self, cache=None):
+        """
+        按优先级通道统计的排队时间直方图快照
+        :param cache: 见 _quantiles
+        :return: {lane: snapshot}
+        """
+        return self._snapshots(self.lane_queue_time_hist_dict, cache)
+
+    def iter_update_worker_stat(self, step):
+        """
+        分批读取workers写入共享内存的统计，每读取step个slot yield一次，之后用 worker_stat(update=False) 获取结果
+        :param step:
+        :return:
+        """
+        if not self.shared_stat:
+            return
+
+        for _ in self.shared_stat.aggregator.iter_update(step):
+            yield
+
+    def worker_stat(self, update=True):
+        """
+        汇总所有workers写入共享内存的统计，只在查看统计时调用
+        :param update: 为False时直接返回上次汇总的结果
+        :return: dict(
+            endpoint_req={endpoint: count},
+            endpoint_exc={endpoint: count},
+            endpoint_time_hist={endpoint: LatencyHistogram}, 单位为微秒
+            counters={name: value},
+        )
+        """
+        if not self.shared_stat:
+            return dict(
+                endpoint_req=dict(),
+                endpoint_exc=dict(),
+                endpoint_time_hist=dict(),
+                counters=dict(),
+            )
+
+        return self.shared_stat.aggregate(update)
+
+    def _bounded_key(self, counter, key):
+        """
+        已经记录的个数达到上限后，新出现的key都合并为 STAT_KEY_OTHER
+        :param counter: 以该dict的key作为已经记录的集合
+        :param key:
+        :return:
+        """
+        if key in counter or len(counter) < self.cmd_max_count:
+            return key
+
+        return constants.STAT_KEY_OTHER
+
+    def _quantiles(self, hist_dict, cache=None):
+        """
+        :param cache: 调用方保存的dict，直方图的记录数没有变化时直接沿用上次的结果
+            订阅统计时每次推送都要计算，而大部分直方图其实都没有新记录
+        :return:
+        """
+        return dict((key, cached_call(cache, key, histogram.total_count, histogram.quantiles, scale=1000))
+                    for key, histogram in hist_dict.items())
 
-            for dst_value in self.tasks_time_benchmark:
-                if value < dst_value:
-                    return dst_value
-            else:
-                return 'more'
+    def _snapshots(self, hist_dict, cache=None):
+        return dict((key, cached_call(cache, key, histogram.total_count, histogram.to_dict))
+                    for key, histogram in hist_dict.items())
 
-        counter_value = trans_to_counter_value(task_time)
-        self.tasks_time_counter[counter_value] += 1
+    def _sub_cache(self, cache, key):
+        if cache is None:
+            return None
+        return cache.setdefault(key, dict())
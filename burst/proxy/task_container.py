@@ -4,6 +4,7 @@
 主要为了支持到worker能知道要给返回数据的问题
 """
 
+import time
 import weakref
 
 
@@ -12,12 +13,44 @@ class TaskContainer(object):
     # 封装好的task
     task = None
 
+    # 客户端请求的cmd，box_class没有cmd时为None
+    cmd = None
+
+    # 收到请求、进入队列的时间
+    enqueue_time = None
+
+    # 分配给worker的时间
+    begin_time = None
+
+    # 路由到的分组
+    group_id = None
+
+    # 是否在分组的队列中等待
+    queued = False
+
+    # 所在的优先级通道，PRIORITY_LANES 中的下标
+    lane = 0
+
+    # 公平队列中所属的flow，比如客户端连接或者IP
+    flow = None
+
+    # 客户端请求的sn，proxy直接回应时使用
+    sn = None
+
+    # 相同的key会尽量分配给同一个worker，None 代表不固定
+    affinity_key = None
+
+    # 正在等待的指定worker，不在等待时为None
+    affinity_worker = None
+
     # 客户端连接的弱引用
     _client_conn_ref = None
 
-    def __init__(self, task, client_conn):
+    def __init__(self, task, client_conn, cmd=None):
         self.task = task
         self.client_conn = client_conn
+        self.cmd = cmd
+        self.enqueue_time = time.time()
 
     @property
     def client_conn(self):
@@ -1,10 +1,15 @@
 # -*- coding: utf-8 -*-
 
+import time
 from collections import defaultdict
 
+from twisted.internet import reactor
+
 from ..share import constants
 from ..share.log import logger
-from group_queue import GroupQueue
+from ..share.utils import safe_func
+from group_queue import GroupQueue, Queue
+from hash_ring import HashRing
 from reload_helper import ReloadHelper
 
 
@@ -21,9 +26,23 @@ class TaskDispatcher(object):
     busy_workers_dict = None
     # 空闲
     idle_workers_dict = None
+    # 繁忙，但处理中的任务还没达到prefetch个的workers {group_id: set}
+    prefetch_workers_dict = None
     # 消息队列
     group_queue = None
 
+    # 可以借用各分组worker的分组 {lender_group_id: [(group_id, spillover_min_pending), ...]}
+    spillover_borrowers_dict = None
+
+    # 各分组workers的一致性哈希环，workers变化时重建 {group_id: HashRing}
+    affinity_ring_dict = None
+    # 等待指定worker的任务 {worker: Queue}
+    affinity_tasks_dict = None
+    # 等待指定worker的任务个数 {(group_id, lane): count}，和分组队列的通道共用max_size
+    affinity_pending_dict = None
+    # 等待超时的timer {worker: DelayedCall}
+    _affinity_timer_dict = None
+
     # worker reload的帮助类
     reload_helper = None
     # reload结束后的回调
@@ -32,18 +51,37 @@ class TaskDispatcher(object):
     def __init__(self, proxy, reload_over_callback=None):
         self.busy_workers_dict = defaultdict(set)
         self.idle_workers_dict = defaultdict(set)
+        self.prefetch_workers_dict = defaultdict(set)
 
         self.proxy = proxy
-        self.group_queue = GroupQueue(self.proxy.app.config['PROXY_MSG_QUEUE_MAX_SIZE'])
+        self.group_queue = GroupQueue(
+            self.proxy.app.config['PROXY_MSG_QUEUE_MAX_SIZE'],
+            self.proxy.app.config['PRIORITY_LANES'],
+            self.proxy.app.config['PRIORITY_POLICY'],
+            bool(self.proxy.app.config['PROXY_FAIR_QUEUE']),
+        )
         self.reload_helper = ReloadHelper(self.proxy)
         self.reload_over_callback = reload_over_callback
 
+        # 修改分组配置只会改count，借用关系不会变
+        self.spillover_borrowers_dict = self._make_spillover_borrowers(self.proxy.app.config['GROUP_CONFIG'])
+
+        self.affinity_ring_dict = dict()
+        self.affinity_tasks_dict = defaultdict(Queue)
+        self.affinity_pending_dict = defaultdict(int)
+        self._affinity_timer_dict = dict()
+
     def remove_worker(self, worker):
         """
         删除worker，一般是worker断掉了
         :param worker:
         :return:
         """
+        # 等待它的任务不用再等了
+        self.affinity_ring_dict.pop(worker.group_id, None)
+        self._flush_affinity_tasks(worker)
+        self.prefetch_workers_dict[worker.group_id].discard(worker)
+
         if worker in self.busy_workers_dict[worker.group_id]:
             self.busy_workers_dict[worker.group_id].remove(worker)
             return
@@ -52,28 +90,88 @@ class TaskDispatcher(object):
             self.idle_workers_dict[worker.group_id].remove(worker)
             return
 
+    def retire_worker(self, worker):
+        """
+        worker要退休，不再给它分配任务
+        :param worker:
+        :return:
+        """
+        self.remove_worker(worker)
+
+        if self.reloading:
+            self.remove_ready_worker(worker)
+
+    def get_group_load(self, group_id):
+        """
+        分组的负载
+        :param group_id:
+        :return:
+        """
+        return dict(
+            pending=self.group_queue.qsize(group_id) + sum(
+                count for (pending_group_id, lane), count in self.affinity_pending_dict.items()
+                if pending_group_id == group_id),
+            # reload之后可能不是defaultdict
+            busy=len(self.busy_workers_dict.get(group_id, ())),
+            idle=len(self.idle_workers_dict.get(group_id, ())),
+        )
+
+    def get_lane_pending(self):
+        """
+        各分组各通道排队中的任务数，包括等待指定worker的任务
+        :return: {(group_id, lane): count}
+        """
+        lane_pending = dict()
+        for group_id, queue in self.group_queue.queue_dict.items():
+            for lane in xrange(len(self.group_queue.lane_configs)):
+                lane_pending[(group_id, lane)] = queue.lane_qsize(lane)
+
+        for key, count in self.affinity_pending_dict.items():
+            lane_pending[key] = lane_pending.get(key, 0) + count
+
+        return lane_pending
+
     def add_task(self, group_id, item):
         """
         添加任务
         当新消息来得时候，应该先检查有没有空闲的worker，如果没有的话，才放入消息队列
-        :return:
+        :return: 是否成功，队列满了返回False
+        """
+        item.group_id = group_id
+        self.proxy.stat_counter.add_lane_req(self.group_queue.lane_names[item.lane])
+
+        if item.affinity_key is not None and self._add_affinity_task(group_id, item):
+            return True
+
+        return self._dispatch_task(group_id, item)
+
+    def _dispatch_task(self, group_id, item):
+        """
+        分配给任意空闲的worker，没有的话放入消息队列
+        :param group_id:
+        :param item:
+        :return: 是否成功，队列满了返回False
         """
         if self.reload_helper.workers_done:
             # 不能丢消息
-            if not self.group_queue.put(group_id, item):
-                logger.error('put item fail. group_id: %s, queue_size: %s / %s',
-                             group_id, self.group_queue.qsize(group_id), self.group_queue.max_size)
+            result = self._put_task(group_id, item)
 
             # 说明在reload，并且worker已经都ok了
             self._try_replace_workers()
-            return
+            return result
 
         idle_workers = self.idle_workers_dict[group_id]
         if not idle_workers:
-            if not self.group_queue.put(group_id, item):
-                logger.error('put item fail. group_id: %s, queue_size: %s / %s',
-                             group_id, self.group_queue.qsize(group_id), self.group_queue.max_size)
-            return
+            worker = self._get_prefetch_worker(group_id)
+            if worker is not None:
+                worker._assign_task(item)
+                return True
+
+            if not self._put_task(group_id, item):
+                return False
+
+            self._try_spillover(group_id)
+            return True
 
         # 弹出一个可用的worker
         worker = idle_workers.pop()
@@ -84,6 +182,58 @@ class TaskDispatcher(object):
 
         # 让worker去处理任务吧
         worker._assign_task(item)
+        return True
+
+    def _get_prefetch_worker(self, group_id):
+        """
+        找一个处理中的任务还没达到prefetch个的繁忙worker
+        :param group_id:
+        :return: 没有时返回None
+        """
+        if not self.group_queue.empty(group_id):
+            # 队列里还有任务说明workers都满了，新任务要排在它们后面
+            return None
+
+        prefetch_workers = self.prefetch_workers_dict.get(group_id)
+        if not prefetch_workers:
+            return None
+
+        return next(iter(prefetch_workers))
+
+    def update_prefetch_worker(self, worker):
+        """
+        worker的状态或者处理中的任务数变化后调用，维护 prefetch_workers_dict
+        :param worker:
+        :return:
+        """
+        prefetch_workers = self.prefetch_workers_dict[worker.group_id]
+
+        # 已经删掉的worker不在busy_workers_dict中
+        if worker.doing_task_count < worker.prefetch and worker in self.busy_workers_dict[worker.group_id]:
+            prefetch_workers.add(worker)
+        else:
+            prefetch_workers.discard(worker)
+
+    def cancel_tasks(self, task_containers):
+        """
+        取消还在排队的任务，一般是客户端断开了
+        :param task_containers:
+        :return:
+        """
+        for task_container in task_containers:
+            if task_container.affinity_worker is not None:
+                worker = task_container.affinity_worker
+                affinity_tasks = self.affinity_tasks_dict[worker]
+                # 只是打上标记，不用在队列中查找
+                affinity_tasks.cancel(task_container)
+                self._on_affinity_task_removed(task_container)
+                if affinity_tasks.empty():
+                    self._clear_affinity_tasks(worker)
+
+                self.proxy.stat_counter.add_disconnected_task(task_container.group_id)
+
+            elif self.group_queue.cancel(task_container.group_id, task_container):
+                self.proxy.stat_counter.add_disconnected_task(task_container.group_id)
 
     def alloc_task(self, worker):
         """
@@ -92,15 +242,18 @@ class TaskDispatcher(object):
         """
         if self.reload_helper.workers_done:
             # 说明在reload，并且worker已经都ok了
-            worker.status = constants.WORKER_STATUS_IDLE
+            # 还有处理中的任务时，要等处理完才算空闲
+            worker.status = constants.WORKER_STATUS_BUSY if worker.doing_task_count else constants.WORKER_STATUS_IDLE
             # 同步状态
             self._sync_worker_status(worker)
 
             self._try_replace_workers()
             return None
 
-        task = self.group_queue.get(worker.group_id)
-        dst_status = constants.WORKER_STATUS_BUSY if task else constants.WORKER_STATUS_IDLE
+        task = self._get_affinity_task(worker) or self._get_alive_task(worker.group_id) or \
+            self._get_spillover_task(worker)
+        # prefetch时，即使申请不到新任务，只要还有处理中的任务就还是繁忙
+        dst_status = constants.WORKER_STATUS_BUSY if task or worker.doing_task_count else constants.WORKER_STATUS_IDLE
 
         if worker.status != dst_status:
             # 说明状态有变化，需要调整队列
@@ -110,6 +263,332 @@ class TaskDispatcher(object):
 
         return task
 
+    def get_max_queue_age(self, group_id):
+        """
+        任务在队列中最多等待的时间
+        :param group_id:
+        :return: None 代表不限制
+        """
+        return self._get_group_info(group_id).get('max_queue_age', self.proxy.app.config['PROXY_TASK_MAX_QUEUE_AGE'])
+
+    def _get_alive_task(self, group_id):
+        """
+        从队列中取出任务，客户端已经断开或者排队超时的任务直接丢弃，不分配给worker
+        :param group_id:
+        :return: 没有可以分配的任务时返回None
+        """
+        max_queue_age = self.get_max_queue_age(group_id)
+        now = time.time() if max_queue_age is not None else None
+
+        while 1:
+            task_container = self.group_queue.get(group_id)
+            if task_container is None:
+                return None
+
+            client_conn = task_container.client_conn
+            if not client_conn or not client_conn.connected:
+                # 客户端已经断开，处理了也回应不了
+                self.proxy.stat_counter.add_disconnected_task(group_id)
+                continue
+
+            client_conn.queued_tasks.discard(task_container)
+
+            if now is not None and now - task_container.enqueue_time > max_queue_age:
+                # 客户端大概率已经放弃了
+                self.proxy.stat_counter.add_expired_task(group_id)
+                continue
+
+            return task_container
+
+    def _try_spillover(self, group_id):
+        """
+        本分组没有空闲的worker时，让可以借用的分组的空闲worker来处理
+        :param group_id:
+        :return:
+        """
+        for lender_group_id in self._get_group_info(group_id).get('spillover_groups') or ():
+            # reload之后可能不是defaultdict
+            idle_workers = self.idle_workers_dict.get(lender_group_id)
+
+            while idle_workers and not self.group_queue.empty(group_id):
+                # 申请到任务后，worker会从空闲列表中移走
+                if not next(iter(idle_workers)).alloc_task():
+                    break
+
+    def _make_spillover_borrowers(self, group_config):
+        """
+        按出借worker的分组整理借用关系，空闲worker申请任务时不用遍历所有分组
+        :param group_config:
+        :return: {lender_group_id: [(group_id, spillover_min_pending), ...]}
+        """
+        borrowers_dict = defaultdict(list)
+        for group_id, group_info in group_config.items():
+            for lender_group_id in group_info.get('spillover_groups') or ():
+                borrowers_dict[lender_group_id].append((group_id, group_info.get('spillover_min_pending', 1)))
+
+        return dict(borrowers_dict)
+
+    def _get_spillover_task(self, worker):
+        """
+        worker自己的分组没有任务时，帮其他分组处理
+        :param worker:
+        :return: 没有可以处理的任务时返回None
+        """
+        borrower_infos = self.spillover_borrowers_dict.get(worker.group_id)
+        if not borrower_infos:
+            # 没有分组可以借用它
+            return None
+
+        lender_info = self._get_group_info(worker.group_id)
+        idle_workers = self.idle_workers_dict.get(worker.group_id, ())
+        if len(idle_workers) - (worker in idle_workers) < lender_info.get('spillover_reserve', 0):
+            # 要给自己的分组留着
+            return None
+
+        # 优先帮排队最多的分组
+        borrowers = sorted(
+            ((self.group_queue.qsize(group_id), group_id)
+             for group_id, min_pending in borrower_infos
+             if self.group_queue.qsize(group_id) >= min_pending),
+            reverse=True,
+        )
+
+        for qsize, group_id in borrowers:
+            task = self._get_alive_task(group_id)
+            if task:
+                return task
+
+        return None
+
+    def _get_group_info(self, group_id):
+        return self.proxy.app.config['GROUP_CONFIG'].get(group_id) or {}
+
+    def get_affinity_wait(self, group_id):
+        """
+        任务等待指定worker的最长时间
+        :param group_id:
+        :return:
+        """
+        return self._get_group_info(group_id).get('affinity_wait', self.proxy.app.config['PROXY_AFFINITY_WAIT'])
+
+    def _get_affinity_worker(self, group_id, affinity_key):
+        """
+        通过一致性哈希找到affinity_key对应的worker
+        :param group_id:
+        :param affinity_key:
+        :return: 分组没有worker时返回None
+        """
+        ring = self.affinity_ring_dict.get(group_id)
+        if ring is None:
+            # reload之后可能不是defaultdict
+            workers = self.idle_workers_dict.get(group_id, set()) | self.busy_workers_dict.get(group_id, set())
+            if not workers:
+                return None
+
+            # 连接对象就是worker进程的标识，worker重启后缓存也没有了，位置变了也没关系
+            ring = self.affinity_ring_dict[group_id] = HashRing(dict((id(worker), worker) for worker in workers))
+
+        return ring.get(affinity_key)
+
+    def _add_affinity_task(self, group_id, item):
+        """
+        分配给affinity_key对应的worker，它正忙时等待一小段时间
+        :param group_id:
+        :param item:
+        :return: 是否处理了，返回False时按普通任务分配
+        """
+        if self.reload_helper.running:
+            # reload中workers随时会被替换
+            return False
+
+        worker = self._get_affinity_worker(group_id, item.affinity_key)
+        if worker is None or worker.retiring:
+            return False
+
+        if worker.status == constants.WORKER_STATUS_IDLE or (
+                worker.doing_task_count < worker.prefetch and self.group_queue.empty(group_id)):
+            # 和 _get_prefetch_worker 一样，队列里还有任务时不能插到它们前面
+            if worker.status != constants.WORKER_STATUS_BUSY:
+                worker.status = constants.WORKER_STATUS_BUSY
+                self._sync_worker_status(worker)
+
+            self.proxy.stat_counter.add_affinity_hit(group_id)
+            worker._assign_task(item)
+            return True
+
+        affinity_wait = self.get_affinity_wait(group_id)
+        if not affinity_wait:
+            return False
+
+        if self._is_lane_full(group_id, item.lane):
+            # 让它按普通任务去排队，排不上时会被拒绝
+            return False
+
+        self.affinity_tasks_dict[worker].put(item)
+        item.affinity_worker = worker
+        self.affinity_pending_dict[(group_id, item.lane)] += 1
+        # 客户端断开时可以直接取消
+        if item.client_conn:
+            item.client_conn.queued_tasks.add(item)
+
+        if worker not in self._affinity_timer_dict:
+            self._affinity_timer_dict[worker] = reactor.callLater(
+                affinity_wait, safe_func(self._on_affinity_timeout), worker)
+
+        return True
+
+    def _get_affinity_task(self, worker):
+        """
+        取出等待该worker的任务
+        :param worker:
+        :return: 没有时返回None
+        """
+        affinity_tasks = self.affinity_tasks_dict.get(worker)
+        if affinity_tasks is None:
+            return None
+
+        while 1:
+            task_container = affinity_tasks.get()
+            if task_container is None:
+                break
+
+            self._on_affinity_task_removed(task_container)
+
+            client_conn = task_container.client_conn
+            if not client_conn or not client_conn.connected:
+                self.proxy.stat_counter.add_disconnected_task(worker.group_id)
+                continue
+
+            client_conn.queued_tasks.discard(task_container)
+
+            if affinity_tasks.empty():
+                # 不用再等超时
+                self._clear_affinity_tasks(worker)
+
+            self.proxy.stat_counter.add_affinity_hit(worker.group_id)
+            return task_container
+
+        self._clear_affinity_tasks(worker)
+        return None
+
+    def _on_affinity_timeout(self, worker):
+        """
+        等待超时的任务交给其他worker
+        :param worker:
+        :return:
+        """
+        self._affinity_timer_dict.pop(worker, None)
+
+        affinity_tasks = self.affinity_tasks_dict.get(worker)
+        if affinity_tasks is None:
+            return
+
+        affinity_wait = self.get_affinity_wait(worker.group_id)
+        now = time.time()
+        # 按到达的顺序，前面的先超时
+        while 1:
+            task_container = affinity_tasks.peek()
+            if task_container is None or now - task_container.enqueue_time < affinity_wait:
+                break
+
+            affinity_tasks.get()
+            self._on_affinity_task_removed(task_container)
+            self._fallback_affinity_task(task_container)
+
+        if task_container is not None:
+            self._affinity_timer_dict[worker] = reactor.callLater(
+                max(task_container.enqueue_time + affinity_wait - now, 0),
+                safe_func(self._on_affinity_timeout), worker)
+        else:
+            self._clear_affinity_tasks(worker)
+
+    def _flush_affinity_tasks(self, worker):
+        """
+        等待该worker的任务全部交给其他worker，一般是worker断掉或者退休了
+        :param worker:
+        :return:
+        """
+        affinity_tasks = self.affinity_tasks_dict.get(worker)
+        if affinity_tasks is None:
+            return
+
+        self._clear_affinity_tasks(worker)
+
+        for task_container in affinity_tasks.drain():
+            self._on_affinity_task_removed(task_container)
+            self._fallback_affinity_task(task_container)
+
+    def _clear_affinity_tasks(self, worker):
+        self.affinity_tasks_dict.pop(worker, None)
+
+        timer = self._affinity_timer_dict.pop(worker, None)
+        if timer and timer.active():
+            timer.cancel()
+
+    def _on_affinity_task_removed(self, task_container):
+        """
+        任务不再等待指定的worker
+        :param task_container:
+        :return:
+        """
+        task_container.affinity_worker = None
+
+        pending_key = (task_container.group_id, task_container.lane)
+        self.affinity_pending_dict[pending_key] -= 1
+        if self.affinity_pending_dict[pending_key] <= 0:
+            self.affinity_pending_dict.pop(pending_key, None)
+
+    def _fallback_affinity_task(self, task_container):
+        """
+        不再等待指定的worker，按普通任务分配
+        :param task_container:
+        :return:
+        """
+        group_id = task_container.group_id
+
+        client_conn = task_container.client_conn
+        if not client_conn or not client_conn.connected:
+            self.proxy.stat_counter.add_disconnected_task(group_id)
+            return
+
+        client_conn.queued_tasks.discard(task_container)
+        self.proxy.stat_counter.add_affinity_miss(group_id)
+        if not self._dispatch_task(group_id, task_container):
+            client_conn.reject(self.proxy.app.box_class(dict(cmd=task_container.cmd, sn=task_container.sn)),
+                               group_id, constants.REJECT_REASON_QUEUE_FULL)
+
+    def _put_task(self, group_id, item):
+        """
+        放入消息队列，并记录到客户端连接上，客户端断开时可以直接取消
+        :param group_id:
+        :param item:
+        :return:
+        """
+        if self._is_lane_full(group_id, item.lane) or not self.group_queue.put(group_id, item):
+            lane_config = self.group_queue.lane_configs[item.lane]
+            logger.error('put item fail. group_id: %s, lane: %s, lane_size: %s / %s',
+                         group_id, lane_config['name'], self.group_queue.lane_qsize(group_id, item.lane),
+                         lane_config['max_size'])
+            self.proxy.stat_counter.add_lane_rejected(lane_config['name'])
+            return False
+
+        client_conn = item.client_conn
+        if client_conn:
+            client_conn.queued_tasks.add(item)
+
+        return True
+
+    def _is_lane_full(self, group_id, lane):
+        """
+        通道是否已满，等待指定worker的任务和分组队列共用通道的max_size
+        :param group_id:
+        :param lane:
+        :return:
+        """
+        max_size = self.group_queue.lane_configs[lane]['max_size']
+        return 0 < max_size <= self.group_queue.lane_qsize(group_id, lane) + \
+            self.affinity_pending_dict.get((group_id, lane), 0)
+
     def clear_tasks(self, group_id):
         """
         清空任务
@@ -182,6 +661,9 @@ class TaskDispatcher(object):
 
         # 一定要stop
         self.reload_helper.stop()
+        # workers都换了
+        self.affinity_ring_dict.clear()
+        self.prefetch_workers_dict.clear()
 
         # 分配现有的idle workers
         for group_id, _workers in bk_idle_workers_dict.items():
@@ -212,8 +694,12 @@ class TaskDispatcher(object):
         if worker in src_workers_dict[worker.group_id]:
             # 因为有可能worker的状态是None的话，是不在任何队列里面的，所以先判断一下
             src_workers_dict[worker.group_id].remove(worker)
+        elif worker not in dst_workers_dict[worker.group_id]:
+            # 新加入的worker
+            self.affinity_ring_dict.pop(worker.group_id, None)
 
         dst_workers_dict[worker.group_id].add(worker)
+        self.update_prefetch_worker(worker)
 
     def _on_workers_reload_over(self):
         """
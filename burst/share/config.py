@@ -77,10 +77,9 @@ class ConfigAttribute(object):
     def __get__(self, obj, type=None):
         if obj is None:
             return self
-        rv = obj.config[self.__name__]
         if self.get_converter is not None:
-            rv = self.get_converter(rv)
-        return rv
+            return obj.config.get_converted(self.__name__, self.get_converter)
+        return obj.config[self.__name__]
 
     def __set__(self, obj, value):
         obj.config[self.__name__] = value
@@ -133,6 +132,27 @@ class Config(dict):
     def __init__(self, root_path=None, defaults=None):
         dict.__init__(self, defaults or {})
         self.root_path = root_path or ''
+        # key -> (raw value, converted value)
+        self._converted_values = {}
+
+    def get_converted(self, key, converter):
+        """Returns the value for `key` passed through `converter`.  The
+        converted value is cached until the raw value stored under `key`
+        is replaced, so converters like :func:`import_string` only run once
+        per configured value.
+
+        :param key: the config key.
+        :param converter: a callable that converts the raw value.
+        """
+        rv = self[key]
+        cached = self._converted_values.get(key)
+        # compare by identity, so any way of replacing the value invalidates it
+        if cached is not None and cached[0] is rv:
+            return cached[1]
+
+        converted = converter(rv)
+        self._converted_values[key] = (rv, converted)
+        return converted
 
     def from_envvar(self, variable_name, silent=False):
         """Loads a configuration from an environment variable pointing to
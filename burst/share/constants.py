@@ -7,22 +7,35 @@ NAME = 'burst'
 RET_INVALID_CMD = -10000
 # 系统内部异常
 RET_INTERNAL = -10001
+# proxy拒绝了请求(限流或者过载)，请求没有交给worker处理
+RET_PROXY_REJECTED = -10002
 # admin用户验证失败
 RET_ADIMN_AUTH_FAIL = -20000
+# admin命令参数不合法
+RET_ADMIN_INVALID_PARAMS = -20001
 # master连接未连接
 RET_MASTER_NOT_CONNECTED = -21000
 
 # 内部使用的命令字
 # 分配任务.
 CMD_WORKER_TASK_ASSIGN = 100
+# 批量分配任务. body为多个 CMD_WORKER_TASK_ASSIGN 打包后拼接在一起
+CMD_WORKER_TASK_BATCH_ASSIGN = 101
 # 任务完成. 如果body里面带数据，说明是要写回；如果没有数据，说明只是要求分配task
 CMD_WORKER_TASK_DONE = 200
+# 批量任务完成. body为多个 CMD_WORKER_TASK_DONE 打包后拼接在一起
+CMD_WORKER_TASK_BATCH_DONE = 201
+# worker退休. worker发给proxy代表不再接收新任务；proxy处理完它手上的任务后原样回复，worker收到后退出
+CMD_WORKER_RETIRE = 300
 
 # 管理员命令
 # 获取运行状态统计
 CMD_ADMIN_SERVER_STAT = 20000
+# 订阅统计. proxy按payload中的interval(秒)定时推送，第一次为全量，之后只推送变化了的部分(删除的key值为None)
+# 直方图快照(*_hist)很大，payload中hist为真时才推送
+CMD_ADMIN_STAT_SUBSCRIBE = 20001
 
-# 修改配置，比如worker数量。workers会自动reload
+# 修改配置，比如worker数量。只增减对应分组的worker，不会reload
 CMD_ADMIN_CHANGE = 21000
 # 优雅重启workers
 CMD_ADMIN_RELOAD = 21001
@@ -30,9 +43,17 @@ CMD_ADMIN_RELOAD = 21001
 CMD_ADMIN_STOP = 21003
 # 清空某个或者多个分组的消息
 CMD_ADMIN_CLEAR = 21004
+# 对某个分组的workers进行采样profile. 采样结束后才回应，body为json，其中stacks为 {collapsed_stack: count}
+CMD_ADMIN_PROFILE = 21005
 
 # 通知master替换workers
 CMD_MASTER_REPLACE_WORKERS = 30000
+# proxy上报各分组的负载给master，用于自动伸缩
+CMD_MASTER_GROUP_LOAD = 30001
+# master通知proxy分组的worker数量变化
+CMD_MASTER_CHANGE_GROUP = 30002
+# master把收集好的profile结果发给proxy
+CMD_MASTER_PROFILE_RESULT = 30003
 
 # worker的状态
 WORKER_STATUS_IDLE = 1
@@ -48,6 +69,50 @@ PROC_TYPE_WORKER = 'worker'
 RELOAD_STATUS_STOPPED = 0
 RELOAD_STATUS_PREPARING = 1      # 准备中
 RELOAD_STATUS_WORKERS_DONE = 2   # 已经准备好了
+RELOAD_STATUS_ROLLING = 3        # 滚动替换中
+
+# reload方式
+# 先启动一整套新的workers，全部准备好之后再替换老的workers
+RELOAD_MODE_FULL = 'full'
+# 每个分组每次只替换几个worker，新worker连上就开始处理任务，老worker处理完手上的任务后退出
+RELOAD_MODE_ROLLING = 'rolling'
+
+# 优先级通道的调度方式
+# 严格优先级，高优先级的通道空了才处理低优先级的
+PRIORITY_POLICY_STRICT = 'strict'
+# 平滑加权轮询，按权重分配，低优先级的通道不会饿死
+PRIORITY_POLICY_WEIGHTED = 'weighted'
+
+# 公平队列的flow划分方式
+# 按客户端连接
+FAIR_QUEUE_BY_CONNECTION = 'connection'
+# 按客户端IP，同一台机器上的多个连接算一个
+FAIR_QUEUE_BY_IP = 'ip'
+
+# 任务固定分配到同一个worker的key
+# 按客户端连接
+AFFINITY_BY_CONNECTION = 'connection'
+# 按客户端IP
+AFFINITY_BY_IP = 'ip'
+
+# proxy拒绝请求的原因
+# 客户端IP限流
+REJECT_REASON_IP_RATE = 'ip_rate'
+# cmd限流
+REJECT_REASON_CMD_RATE = 'cmd_rate'
+# 分组队列满了
+REJECT_REASON_QUEUE_FULL = 'queue_full'
+# 分组排队时间过长
+REJECT_REASON_QUEUE_TIME = 'queue_time'
+
+# 任务耗时的种类
+TASK_TIME_QUEUE = 'queue'        # 在队列中等待的时间
+TASK_TIME_SERVICE = 'service'    # worker处理的时间
+TASK_TIME_TOTAL = 'total'        # 从收到请求到worker回应的时间
+TASK_TIME_KINDS = (TASK_TIME_QUEUE, TASK_TIME_SERVICE, TASK_TIME_TOTAL)
+
+# 按cmd/endpoint统计时，超过 STAT_CMD_MAX_COUNT 的部分都计入这个key
+STAT_KEY_OTHER = 'other'
 
 
 # 默认配置
@@ -79,6 +144,25 @@ DEFAULT_CONFIG = {
     #    {
     #        $group_id: {
     #            count: 10,
+    #            # 可选，每个worker最多同时分配的任务数，默认为1
+    #            prefetch: 1,
+    #            # 可选，是否批量分配任务，默认为False。一批最多prefetch个任务，worker会批量回应
+    #            batch: False,
+    #            # 可选，任务在队列中最多等待的时间(秒)，超过后不再分配给worker，默认为 PROXY_TASK_MAX_QUEUE_AGE
+    #            max_queue_age: None,
+    #            # 可选，排队时间超过后拒绝新的请求，默认为 PROXY_ADMISSION_QUEUE_TIME
+    #            admission_queue_time: None,
+    #            # 可选，任务等待指定worker的最长时间(秒)，默认为 PROXY_AFFINITY_WAIT
+    #            affinity_wait: 0.01,
+    #            # 可选，队列中有任务时，可以借用这些分组的空闲worker处理，要求这些分组的worker能处理本分组的cmd
+    #            spillover_groups: (10, ),
+    #            # 可选，队列中的任务数达到后才借用其他分组的worker，默认为1
+    #            spillover_min_pending: 1,
+    #            # 可选，借给其他分组时，本分组至少保留的空闲worker数，默认为0
+    #            spillover_reserve: 0,
+    #            # 可选，自动伸缩时worker数量的范围。配置了max_count的分组才会自动伸缩
+    #            min_count: 1,
+    #            max_count: 20,
     #        }
     #    }
     'GROUP_CONFIG': {
@@ -90,6 +174,33 @@ DEFAULT_CONFIG = {
     #    def group_router(box):
     #        return group_id
     'GROUP_ROUTER': lambda box: 1,
+    # 通过box确定分组内的优先级通道，返回 PRIORITY_LANES 中的name，找不到时放入最后一个通道:
+    #    def group_priority(box):
+    #        return 'high'
+    # None 代表所有任务都在第一个通道
+    'GROUP_PRIORITY': None,
+    # 每个分组队列内的优先级通道，优先级从高到低:
+    #    (
+    #        # weight: 可选，按权重调度时使用，默认为1
+    #        # max_size: 可选，通道的最大长度，<=0 代表无限，默认为 PROXY_MSG_QUEUE_MAX_SIZE
+    #        dict(name='high', weight=8, max_size=1000),
+    #        dict(name='low', weight=1),
+    #    )
+    'PRIORITY_LANES': (
+        dict(name='default'),
+    ),
+    # 多个通道之间的调度方式: PRIORITY_POLICY_STRICT / PRIORITY_POLICY_WEIGHTED
+    'PRIORITY_POLICY': PRIORITY_POLICY_STRICT,
+    # 任务固定分配到同一个worker，worker内存中的缓存更容易命中
+    # 可以是 AFFINITY_BY_CONNECTION / AFFINITY_BY_IP，或者通过box返回key的函数(比如uid)，返回None的任务不固定:
+    #    def group_affinity(box):
+    #        return box.get_json()['uid']
+    # key通过一致性哈希映射到分组内的worker，None 代表不开启
+    'GROUP_AFFINITY': None,
+    # proxy只解析包头，不解析包体。GROUP_ROUTER拿到的box只有包头字段，body为空
+    # GROUP_ROUTER只依赖cmd等包头字段时，建议打开
+    # GROUP_PRIORITY 或 GROUP_AFFINITY 配置为函数时，它们可能用到body，proxy还是会解析完整的box
+    'PROXY_ROUTE_BY_HEADER': False,
 
     # 停止子进程超时(秒). 使用 TERM 进行停止时，如果超时未停止会发送KILL信号
     'STOP_TIMEOUT': None,
@@ -109,6 +220,23 @@ DEFAULT_CONFIG = {
     'PROXY_CLIENT_TIMEOUT': None,
     # proxy的每个分组的消息队列的最大长度, <=0 代表无限
     'PROXY_MSG_QUEUE_MAX_SIZE': -1,
+    # 公平队列，每个分组(的每个优先级通道)内按客户端分成子队列轮流取出，一个客户端塞进大量任务时不会堵住其他客户端
+    # FAIR_QUEUE_BY_CONNECTION / FAIR_QUEUE_BY_IP，None 代表不开启，所有任务按到达顺序处理
+    'PROXY_FAIR_QUEUE': None,
+    # 任务在队列中最多等待的时间(秒)，超过后直接丢弃，不再分配给worker. None 代表不限制
+    # 客户端一般早就超时放弃了，处理了也是浪费。可以在GROUP_CONFIG中按分组配置
+    'PROXY_TASK_MAX_QUEUE_AGE': None,
+    # 以下为准入控制，被拒绝的请求由proxy直接回应 RET_PROXY_REJECTED，不会交给worker
+    # 按客户端IP限流 (每秒请求数, 允许的突发请求数)，None 代表不限制
+    'PROXY_IP_RATE_LIMIT': None,
+    # 按cmd限流 {cmd: (每秒请求数, 允许的突发请求数)}，没有配置的cmd不限制
+    'PROXY_CMD_RATE_LIMIT': None,
+    # 分组最近的排队时间(秒，指数平滑)超过后，队列不为空时拒绝新的请求. None 代表不限制
+    # 可以在GROUP_CONFIG中按分组配置
+    'PROXY_ADMISSION_QUEUE_TIME': None,
+    # 固定分配的worker正忙时，任务最多等待的时间(秒)，超过后交给其他worker. 0 代表不等待
+    # 等待中的任务和分组队列一起受通道的max_size限制
+    'PROXY_AFFINITY_WAIT': 0.01,
 
     # worker<->proxy网络连接超时(秒), 包括 connect once，read once，write once
     'WORKER_CONN_TIMEOUT': 3,
@@ -117,16 +245,57 @@ DEFAULT_CONFIG = {
     # worker重连等待时间
     'WORKER_TRY_CONNECT_INTERVAL': 1,
 
+    # reload方式: RELOAD_MODE_FULL / RELOAD_MODE_ROLLING
+    'RELOAD_MODE': RELOAD_MODE_FULL,
+    # 滚动reload时，每个分组同时替换的worker数量
+    'RELOAD_ROLLING_BATCH_SIZE': 1,
+
     # 子进程标识进程类型的环境变量
     'CHILD_PROCESS_ENV_KEY': 'BURST_ENV',
+    # 是否由master直接fork出子进程。子进程共享master已经加载好的app，启动更快，内存也可以写时复制
+    # 注意: 开启后reload只会重启进程，不会重新加载代码
+    'PRELOAD_APP': False,
 
     # 管理员，可以连接proxy获取数据
     # 管理员访问地址: 'admin.sock' or ('127.0.0.1', 9910)
     'ADMIN_ADDRESS': 'admin.sock',
     'ADMIN_USERNAME': None,
     'ADMIN_PASSWORD': None,
+    # 订阅统计时允许的最小推送间隔(秒)
+    'ADMIN_STAT_MIN_INTERVAL': 0.1,
+
+    # OpenMetrics(Prometheus)统计输出地址，HTTP协议. None 代表不开启
+    # 'metrics.sock' or ('127.0.0.1', 9911)
+    'METRICS_ADDRESS': None,
+    # 输出直方图时使用的桶的上界(秒)
+    'METRICS_BUCKETS': (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+
+    # profile单次最长的采样时间(秒)
+    'PROFILE_MAX_SECONDS': 60,
+    # profile最小的采样间隔(秒)，间隔越小对worker的影响越大
+    'PROFILE_MIN_INTERVAL': 0.001,
+    # 采样结束后，master最多再等待workers写入结果的时间(秒)
+    'PROFILE_COLLECT_TIMEOUT': 3,
+
+    # 自动伸缩，只对GROUP_CONFIG中配置了max_count的分组生效
+    # proxy向master上报分组负载的间隔(秒). None 代表不开启
+    'AUTOSCALE_INTERVAL': None,
+    # 分组扩容或缩容后，多久之内不再调整(秒)
+    'AUTOSCALE_COOLDOWN': 30,
+    # 繁忙worker的比例不低于这个值，并且有排队的任务时扩容，每次最多翻倍
+    'AUTOSCALE_UP_BUSY_RATIO': 0.9,
+    # 繁忙worker的比例不高于这个值，并且没有排队的任务时缩容，每次减少一个
+    'AUTOSCALE_DOWN_BUSY_RATIO': 0.3,
 
     # 统计相关
     # 作业时间统计标准
     'TASKS_TIME_BENCHMARK': (10, 50, 100, 500, 1000, 5000),
+    # 按cmd/endpoint统计时，最多记录的个数，超过的部分合并计入 'other'
+    'STAT_CMD_MAX_COUNT': 256,
+    # worker按endpoint统计使用的共享内存文件，放在 IPC_ADDRESS_DIRECTORY 下，由master创建. None 代表不统计
+    'WORKER_STAT_SHM': 'stats.shm',
+    # 共享内存中的slot个数，每个worker进程占用一个，退出后回收. None 代表按GROUP_CONFIG自动计算
+    'WORKER_STAT_SLOTS': None,
+    # worker自定义计数的名字，在worker中通过 worker.stat_counter.incr(name) 累加
+    'WORKER_STAT_COUNTERS': (),
 }
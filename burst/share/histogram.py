@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+
+"""
+对数线性的直方图，参考HdrHistogram
+每个2的幂区间内再等分为若干个子桶，相对误差固定，记录一个值是O(1)的
+快照可以合并，方便把多台机器的统计汇总之后再计算分位数
+"""
+
+from array import array
+
+
+class LatencyHistogram(object):
+    """
+    延迟直方图，只记录非负整数，单位由调用方决定(proxy中为微秒)
+    """
+
+    # 子桶数量的位数，7代表每个区间分为128个子桶，相对误差不超过1/64
+    precision_bits = None
+    # 可记录的最大值的位数，超过的值记录到最后一个桶
+    max_value_bits = None
+
+    # 每个桶的计数
+    counts = None
+    # 总个数
+    total_count = 0
+    # 总和，用来计算平均值
+    total_value = 0
+    min_value = None
+    max_value = None
+
+    _sub_bucket_count = None
+    _sub_bucket_half_count = None
+    _max_index = None
+
+    def __init__(self, precision_bits=7, max_value_bits=36):
+        self.precision_bits = precision_bits
+        self.max_value_bits = max(max_value_bits, precision_bits + 1)
+
+        self._sub_bucket_count = 1 << precision_bits
+        self._sub_bucket_half_count = self._sub_bucket_count >> 1
+
+        bucket_count = self._sub_bucket_count + \
+            (self.max_value_bits - precision_bits) * self._sub_bucket_half_count
+        self._max_index = bucket_count - 1
+        self.counts = array('L', [0]) * bucket_count
+
+        self.total_count = 0
+        self.total_value = 0
+        self.min_value = None
+        self.max_value = None
+
+    def record(self, value, count=1):
+        """
+        记录一个值
+        在proxy中每个任务都会调用多次，所以计算桶的逻辑直接写在这里，少一次函数调用
+        :param value: 非负整数
+        :param count: 次数
+        :return:
+        """
+        if value < self._sub_bucket_count:
+            if value < 0:
+                value = 0
+            index = value
+        else:
+            shift = value.bit_length() - self.precision_bits
+            index = self._sub_bucket_count + (shift - 1) * self._sub_bucket_half_count + \
+                (value >> shift) - self._sub_bucket_half_count
+            if index > self._max_index:
+                index = self._max_index
+
+        self.counts[index] += count
+        self.total_count += count
+        self.total_value += value * count
+
+        if self.min_value is None or value < self.min_value:
+            self.min_value = value
+        if self.max_value is None or value > self.max_value:
+            self.max_value = value
+
+    def value_at_quantile(self, quantile):
+        """
+        计算分位数
+        :param quantile: 0~1, 如 0.99
+        :return: 对应桶的上界，不会超过记录到的最大值。没有数据时返回0
+        """
+        if not self.total_count:
+            return 0
+
+        # 至少要覆盖到1个
+        target = max(int(round(quantile * self.total_count)), 1)
+
+        passed = 0
+        for index, count in enumerate(self.counts):
+            if not count:
+                continue
+            passed += count
+            if passed >= target:
+                return min(self._highest_equivalent_value(index), self.max_value)
+
+        return self.max_value
+
+    def count_below(self, value):
+        """
+        小于value的个数，按桶计算，误差与桶的精度一致
+        :param value:
+        :return:
+        """
+        return sum(self.counts[:self.bucket_index(value)])
+
+    def cumulative_counts(self, value_list):
+        """
+        小于等于各个值的个数，按桶计算，误差与桶的精度一致
+        只遍历一次所有的桶
+        :param value_list: 从小到大排序
+        :return: list
+        """
+        result = []
+        passed = 0
+        index = 0
+
+        for value in value_list:
+            end = self.bucket_index(value) + 1
+            if end > index:
+                passed += sum(self.counts[index:end])
+                index = end
+            result.append(passed)
+
+        return result
+
+    def mean(self):
+        if not self.total_count:
+            return 0
+        return float(self.total_value) / self.total_count
+
+    def merge(self, other):
+        """
+        把另一个直方图合并进来，精度必须一致
+        :param other: LatencyHistogram
+        :return:
+        """
+        if (other.precision_bits, other.max_value_bits) != (self.precision_bits, self.max_value_bits):
+            raise ValueError('histogram layout mismatch')
+
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+
+        self.total_count += other.total_count
+        self.total_value += other.total_value
+
+        if other.min_value is not None and (self.min_value is None or other.min_value < self.min_value):
+            self.min_value = other.min_value
+        if other.max_value is not None and (self.max_value is None or other.max_value > self.max_value):
+            self.max_value = other.max_value
+
+    def subtract(self, other):
+        """
+        减去之前的快照，得到这段时间内的分布
+        最小值和最大值无法精确还原，按桶的范围估算
+        :param other: LatencyHistogram
+        :return:
+        """
+        if (other.precision_bits, other.max_value_bits) != (self.precision_bits, self.max_value_bits):
+            raise ValueError('histogram layout mismatch')
+
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] = max(self.counts[index] - count, 0)
+
+        self.total_count = max(self.total_count - other.total_count, 0)
+        self.total_value = max(self.total_value - other.total_value, 0)
+
+        index_list = [index for index, count in enumerate(self.counts) if count]
+        if index_list:
+            self.min_value = self._lowest_equivalent_value(index_list[0])
+            self.max_value = min(self._highest_equivalent_value(index_list[-1]), self.max_value)
+        else:
+            self.min_value = self.max_value = None
+
+    def reset(self):
+        for index in xrange(len(self.counts)):
+            self.counts[index] = 0
+
+        self.total_count = 0
+        self.total_value = 0
+        self.min_value = None
+        self.max_value = None
+
+    def quantiles(self, quantile_list=(0.5, 0.9, 0.99, 0.999), scale=1):
+        """
+        常用的统计值
+        :param quantile_list:
+        :param scale: 输出时除以的倍数，如微秒转毫秒传1000
+        :return: dict
+        """
+        scale = float(scale)
+
+        result = dict(
+            count=self.total_count,
+            min=(self.min_value or 0) / scale,
+            max=(self.max_value or 0) / scale,
+            mean=round(self.mean() / scale, 3),
+        )
+
+        for quantile in quantile_list:
+            # 0.99 -> p99, 0.999 -> p999
+            key = 'p' + ('%g' % (quantile * 100)).replace('.', '')
+            result[key] = self.value_at_quantile(quantile) / scale
+
+        return result
+
+    def to_dict(self):
+        """
+        生成快照，只保存非0的桶，可以直接json序列化
+        :return:
+        """
+        return dict(
+            precision_bits=self.precision_bits,
+            max_value_bits=self.max_value_bits,
+            total_count=self.total_count,
+            total_value=self.total_value,
+            min_value=self.min_value,
+            max_value=self.max_value,
+            counts=dict((index, count) for index, count in enumerate(self.counts) if count),
+        )
+
+    @classmethod
+    def from_dict(cls, snapshot):
+        """
+        从快照还原
+        :param snapshot: to_dict 的结果，经过json之后key会变成字符串，这里兼容
+        :return:
+        """
+        histogram = cls(snapshot['precision_bits'], snapshot['max_value_bits'])
+
+        for index, count in snapshot['counts'].items():
+            histogram.counts[int(index)] = count
+
+        histogram.total_count = snapshot['total_count']
+        histogram.total_value = snapshot['total_value']
+        histogram.min_value = snapshot['min_value']
+        histogram.max_value = snapshot['max_value']
+
+        return histogram
+
+    @classmethod
+    def from_counts(cls, precision_bits, max_value_bits, counts, total_value, max_value):
+        """
+        从各个桶的计数还原，用于共享内存中只保存了桶的场景
+        最小值按桶的范围估算
+        :param counts: 每个桶的计数，长度必须与布局一致
+        :param total_value:
+        :param max_value:
+        :return:
+        """
+        histogram = cls(precision_bits, max_value_bits)
+        histogram.counts = array('L', counts)
+        histogram.total_count = sum(counts)
+        histogram.total_value = total_value
+
+        if histogram.total_count:
+            for index, count in enumerate(counts):
+                if count:
+                    histogram.min_value = histogram._lowest_equivalent_value(index)
+                    break
+            histogram.max_value = max_value
+
+        return histogram
+
+    def bucket_index(self, value):
+        """
+        计算值所在的桶
+        :param value:
+        :return:
+        """
+        if value < self._sub_bucket_count:
+            return max(value, 0)
+
+        shift = value.bit_length() - self.precision_bits
+        index = self._sub_bucket_count + (shift - 1) * self._sub_bucket_half_count + \
+            (value >> shift) - self._sub_bucket_half_count
+
+        return min(index, self._max_index)
+
+    @property
+    def bucket_count(self):
+        return len(self.counts)
+
+    def _lowest_equivalent_value(self, index):
+        """
+        桶内的最小值
+        :param index:
+        :return:
+        """
+        if index < self._sub_bucket_count:
+            return index
+
+        shift, sub_index = divmod(index - self._sub_bucket_count, self._sub_bucket_half_count)
+        shift += 1
+        return (sub_index + self._sub_bucket_half_count) << shift
+
+    def _highest_equivalent_value(self, index):
+        """
+        桶内的最大值
+        :param index:
+        :return:
+        """
+        if index < self._sub_bucket_count:
+            return index
+
+        return self._lowest_equivalent_value(index + 1) - 1
+
+
+def merge_snapshots(snapshot_list):
+    """
+    合并多个快照，比如多台机器的统计
+    :param snapshot_list:
+    :return: LatencyHistogram，没有快照时返回None
+    """
+    result = None
+    for snapshot in snapshot_list:
+        histogram = LatencyHistogram.from_dict(snapshot)
+        if result is None:
+            result = histogram
+        else:
+            result.merge(histogram)
+
+    return result
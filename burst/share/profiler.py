@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+"""
+采样profiler
+在子线程中定时读取被采样线程的调用栈，合并成collapsed格式(每行为 "栈 次数")，可以直接用flamegraph.pl生成火焰图
+只在profile期间运行，时间到了线程就退出，不会影响正常处理请求
+master与worker之间通过文件交换参数和结果
+"""
+
+import os
+import sys
+import json
+import time
+import thread
+from collections import defaultdict
+
+from log import logger
+from utils import safe_call
+
+# profile请求文件，master写入后给worker发信号
+REQUEST_FILE_TPL = 'profile.%s.req'
+# profile结果文件，worker采样结束后写入，master收集之后删除
+RESULT_FILE_TPL = 'profile.%s.%s.out'
+
+
+def request_path(directory, pid):
+    return os.path.join(directory, REQUEST_FILE_TPL % pid)
+
+
+def result_path(directory, pid, profile_id):
+    return os.path.join(directory, RESULT_FILE_TPL % (pid, profile_id))
+
+
+def collapse_stack(frame):
+    """
+    把调用栈合并为一行，最外层在前
+    :param frame:
+    :return: 'func (file:line);func (file:line)'
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('%s (%s:%s)' % (code.co_name, code.co_filename, code.co_firstlineno))
+        frame = frame.f_back
+
+    names.reverse()
+    return ';'.join(names)
+
+
+def write_json_file(path, data):
+    """
+    先写临时文件再改名，读取方不会读到一半的数据
+    :param path:
+    :param data:
+    :return:
+    """
+    tmp_path = '%s.tmp' % path
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.rename(tmp_path, path)
+
+
+def read_json_file(path, remove=True):
+    """
+    :param path:
+    :param remove: 读取之后删除
+    :return: 文件不存在返回None
+    """
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except IOError:
+        return None
+
+    if remove:
+        os.remove(path)
+
+    return data
+
+
+class StackSampler(object):
+    """
+    调用栈采样
+    """
+
+    # 被采样的线程
+    thread_ident = None
+    # 采样间隔(秒)
+    interval = None
+    # 持续时间(秒)
+    seconds = None
+
+    # {collapsed_stack: count}
+    stack_counter = None
+    # 采样次数
+    samples = 0
+
+    running = False
+
+    def __init__(self, thread_ident, interval, seconds):
+        self.thread_ident = thread_ident
+        self.interval = interval
+        self.seconds = seconds
+        self.stack_counter = defaultdict(int)
+
+    def start(self, callback=None):
+        """
+        启动采样线程
+        :param callback: 采样结束后在采样线程中调用 callback(sampler)
+        :return:
+        """
+        self.running = True
+        thread.start_new_thread(self._run, (callback,))
+
+    def stop(self):
+        self.running = False
+
+    def _run(self, callback):
+        end_time = time.time() + self.seconds
+
+        try:
+            while self.running and time.time() < end_time:
+                frame = sys._current_frames().get(self.thread_ident)
+                if frame is not None:
+                    self.stack_counter[collapse_stack(frame)] += 1
+                    self.samples += 1
+                # 不要一直引用着frame，否则其中的局部变量无法释放
+                frame = None
+
+                time.sleep(self.interval)
+        except:
+            logger.error('exc occur. sampler: %s', self, exc_info=True)
+        finally:
+            self.running = False
+
+        if callback:
+            safe_call(callback, self)
+
+    def __repr__(self):
+        return '<%s thread_ident: %s, interval: %s, seconds: %s, samples: %s>' % (
+            type(self).__name__, self.thread_ident, self.interval, self.seconds, self.samples
+        )
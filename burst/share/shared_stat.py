@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+
+"""
+worker统计使用的共享内存
+文件由master创建，每个worker占用一个slot，只有它自己会写，proxy查看统计时直接读取汇总，不需要任何通信
+每个计数都是对齐的64位整数，单个写入者不需要加锁
+slot被新的worker复用时不会清零，所以对每个slot来说计数是单调递增的，读取时只需要累加和上次读到的差值
+"""
+
+import os
+import json
+import mmap
+import ctypes
+import struct
+from array import array
+from operator import add, sub
+from collections import defaultdict
+
+from constants import STAT_KEY_OTHER
+from histogram import LatencyHistogram
+from log import logger
+
+MAGIC = 'BURSTST1'
+
+# magic, header_size, slot_count, slot_size, precision_bits, max_value_bits, table_len
+HEADER_STRUCT = struct.Struct('=8s6Q')
+
+# slot头部: pid, group_id, 写入序号, 保留
+SLOT_HEADER_SIZE = 4
+SLOT_PID = 0
+SLOT_GROUP_ID = 1
+# 每次写完计数后加1，序号没变的slot汇总时可以直接跳过
+SLOT_SEQ = 2
+
+# endpoint块头部: 请求数, 异常数, 总耗时, 最大耗时，之后是直方图的桶
+ENDPOINT_HEADER_SIZE = 4
+ENDPOINT_REQ = 0
+ENDPOINT_EXC = 1
+ENDPOINT_TOTAL_VALUE = 2
+ENDPOINT_MAX_VALUE = 3
+
+
+def calc_slot_count(group_config):
+    """
+    没有配置 WORKER_STAT_SLOTS 时的slot个数
+    reload时新老workers会同时存在，再留一些给退出中的workers
+    :param group_config:
+    :return:
+    """
+    return 2 * sum(max(group_info['count'], group_info.get('max_count', 0))
+                   for group_info in group_config.values()) + 16
+
+
+class SharedStat(object):
+    """
+    共享内存统计
+    布局(endpoint列表、自定义计数列表、直方图精度)写在文件头里，
+    这样reload之后代码里新增了endpoint，也不会和proxy读到的布局不一致
+    """
+
+    path = None
+
+    # slot个数
+    slot_count = None
+    # 每个slot的64位整数个数
+    slot_size = None
+    # slot开始的位置
+    header_size = None
+
+    # 在共享内存中记录的endpoint，其他的endpoint都记录到 STAT_KEY_OTHER
+    endpoints = None
+    # 自定义计数
+    counters = None
+
+    precision_bits = None
+    max_value_bits = None
+    bucket_count = None
+
+    _mmap = None
+    _endpoint_index_dict = None
+    _counter_index_dict = None
+    # 汇总用的累计值，只有读取的进程才会创建
+    _aggregator = None
+
+    def __init__(self, path, mm, header_size, slot_count, slot_size, precision_bits, max_value_bits, table):
+        self.path = path
+        self._mmap = mm
+        self.header_size = header_size
+        self.slot_count = slot_count
+        self.slot_size = slot_size
+        self.precision_bits = precision_bits
+        self.max_value_bits = max_value_bits
+        self.bucket_count = LatencyHistogram(precision_bits, max_value_bits).bucket_count
+
+        self.endpoints = table['endpoints']
+        self.counters = table['counters']
+        self._endpoint_index_dict = dict((endpoint, index) for index, endpoint in enumerate(self.endpoints))
+        self._counter_index_dict = dict((name, index) for index, name in enumerate(self.counters))
+
+    @classmethod
+    def create(cls, path, slot_count, endpoints, counters, precision_bits=5, max_value_bits=32):
+        """
+        创建共享内存文件，已经存在的会被删掉重建
+        :param path:
+        :param slot_count:
+        :param endpoints:
+        :param counters: 自定义计数的名字
+        :param precision_bits: 直方图精度，默认每个区间32个子桶
+        :param max_value_bits: 直方图最大值，默认2^32微秒
+        :return:
+        """
+        table = json.dumps(dict(
+            endpoints=list(endpoints),
+            counters=list(counters),
+        ))
+
+        # slot从新的一页开始
+        header_size = (HEADER_STRUCT.size + len(table) + mmap.PAGESIZE - 1) // mmap.PAGESIZE * mmap.PAGESIZE
+        bucket_count = LatencyHistogram(precision_bits, max_value_bits).bucket_count
+        # 多出来的一个endpoint块给 STAT_KEY_OTHER
+        slot_size = SLOT_HEADER_SIZE + len(counters) + (len(endpoints) + 1) * (ENDPOINT_HEADER_SIZE + bucket_count)
+
+        if os.path.exists(path):
+            # 之前的进程可能还映射着，删掉重建，不影响它们
+            os.remove(path)
+
+        with open(path, 'w+b') as f:
+            # 文件是稀疏的，没有写过的页不会占用内存
+            f.truncate(header_size + slot_count * slot_size * ctypes.sizeof(ctypes.c_uint64))
+            f.write(HEADER_STRUCT.pack(MAGIC, header_size, slot_count, slot_size,
+                                       precision_bits, max_value_bits, len(table)))
+            f.write(table)
+
+        return cls.open(path)
+
+    @classmethod
+    def open(cls, path):
+        """
+        打开master创建好的共享内存文件
+        :param path:
+        :return:
+        """
+        with open(path, 'r+b') as f:
+            mm = mmap.mmap(f.fileno(), 0)
+
+        magic, header_size, slot_count, slot_size, precision_bits, max_value_bits, table_len = \
+            HEADER_STRUCT.unpack_from(mm)
+        if magic != MAGIC:
+            raise ValueError('invalid shared stat file: %s' % path)
+
+        table = json.loads(mm[HEADER_STRUCT.size:HEADER_STRUCT.size + table_len])
+
+        return cls(path, mm, header_size, slot_count, slot_size, precision_bits, max_value_bits, table)
+
+    def slot_values(self, slot):
+        """
+        slot对应的共享内存，写入会直接反映到其他进程
+        :param slot:
+        :return: ctypes数组
+        """
+        return (ctypes.c_uint64 * self.slot_size).from_buffer(self._mmap, self._slot_offset(slot))
+
+    def endpoint_offset(self, endpoint):
+        """
+        endpoint块在slot中的位置
+        :param endpoint:
+        :return:
+        """
+        index = self._endpoint_index_dict.get(endpoint, len(self.endpoints))
+        return SLOT_HEADER_SIZE + len(self.counters) + index * (ENDPOINT_HEADER_SIZE + self.bucket_count)
+
+    def counter_offset(self, name):
+        """
+        自定义计数在slot中的位置
+        :param name:
+        :return: 没有配置这个计数时返回None
+        """
+        index = self._counter_index_dict.get(name)
+        if index is None:
+            return None
+        return SLOT_HEADER_SIZE + index
+
+    @property
+    def aggregator(self):
+        """
+        汇总用的累计值，第一次使用时创建
+        :return: StatAggregator
+        """
+        if self._aggregator is None:
+            self._aggregator = StatAggregator(self)
+        return self._aggregator
+
+    def aggregate(self, update=True):
+        """
+        汇总所有slot，只读取上次汇总之后有变化的部分
+        :param update: 为False时不读取共享内存，直接返回上次汇总的结果
+        :return: dict(
+            endpoint_req={endpoint: count},
+            endpoint_exc={endpoint: count},
+            endpoint_time_hist={endpoint: LatencyHistogram},
+            counters={name: value},
+        )
+        """
+        if update:
+            self.aggregator.update()
+        return self.aggregator.result()
+
+    def _slot_offset(self, slot):
+        if not 0 <= slot < self.slot_count:
+            raise IndexError('slot out of range: %s / %s' % (slot, self.slot_count))
+
+        return self.header_size + slot * self.slot_size * ctypes.sizeof(ctypes.c_uint64)
+
+    def __repr__(self):
+        return '<%s path: %s, slot_count: %s, slot_size: %s>' % (
+            type(self).__name__, self.path, self.slot_count, self.slot_size
+        )
+
+
+class StatSlot(object):
+    """
+    worker写入自己的slot
+    """
+
+    shared_stat = None
+
+    _values = None
+    _histogram_layout = None
+
+    def __init__(self, shared_stat, slot, pid, group_id):
+        self.shared_stat = shared_stat
+        self._values = shared_stat.slot_values(slot)
+        # 只用来计算值所在的桶
+        self._histogram_layout = LatencyHistogram(shared_stat.precision_bits, shared_stat.max_value_bits)
+
+        self._values[SLOT_PID] = pid
+        self._values[SLOT_GROUP_ID] = group_id
+
+    def add_request(self, endpoint, handle_time, exc=False):
+        """
+        添加一个处理完成的请求
+        :param endpoint:
+        :param handle_time: 处理时间，秒
+        :param exc: 是否抛出了异常
+        :return:
+        """
+        values = self._values
+        offset = self.shared_stat.endpoint_offset(endpoint)
+        value = max(int(handle_time * 1000000), 0)
+
+        if exc:
+            values[offset + ENDPOINT_EXC] += 1
+        values[offset + ENDPOINT_TOTAL_VALUE] += value
+        if value > values[offset + ENDPOINT_MAX_VALUE]:
+            values[offset + ENDPOINT_MAX_VALUE] = value
+        values[offset + ENDPOINT_HEADER_SIZE + self._histogram_layout.bucket_index(value)] += 1
+        # 请求数最后写，汇总时请求数没变的endpoint块会被跳过
+        values[offset + ENDPOINT_REQ] += 1
+        values[SLOT_SEQ] += 1
+
+    def incr(self, name, value=1):
+        """
+        自定义计数
+        :param name: 必须在 WORKER_STAT_COUNTERS 中配置过
+        :param value:
+        :return: 是否成功
+        """
+        offset = self.shared_stat.counter_offset(name)
+        if offset is None:
+            logger.error('stat counter not configured. name: %s', name)
+            return False
+
+        self._values[offset] += value
+        self._values[SLOT_SEQ] += 1
+        return True
+
+
+class StatAggregator(object):
+    """
+    增量汇总共享内存统计
+    记录每个slot上次读到的值，只累加差值: 写入序号没变的slot直接跳过，请求数没变的endpoint块也不读取
+    """
+
+    shared_stat = None
+
+    # [slot]，上次读到的写入序号
+    _slot_seq_list = None
+    # [slot]，上次读到的自定义计数
+    _slot_counters_list = None
+    # {(slot, endpoint_index): array}，上次读到的endpoint块
+    _block_dict = None
+    _slot_values_list = None
+
+    # 累计值
+    _counters = None
+    _endpoint_req = None
+    _endpoint_exc = None
+    _endpoint_total_value = None
+    _endpoint_max_value = None
+    _endpoint_counts = None
+
+    def __init__(self, shared_stat):
+        self.shared_stat = shared_stat
+        self._slot_seq_list = [0] * shared_stat.slot_count
+        self._slot_counters_list = [[0] * len(shared_stat.counters) for _ in xrange(shared_stat.slot_count)]
+        self._block_dict = dict()
+        self._slot_values_list = [shared_stat.slot_values(slot) for slot in xrange(shared_stat.slot_count)]
+
+        self._counters = [0] * len(shared_stat.counters)
+        self._endpoint_req = defaultdict(int)
+        self._endpoint_exc = defaultdict(int)
+        self._endpoint_total_value = defaultdict(int)
+        self._endpoint_max_value = defaultdict(int)
+        self._endpoint_counts = dict()
+
+    def update(self):
+        """
+        读取所有slot的变化
+        :return:
+        """
+        for _ in self.iter_update():
+            pass
+
+    def iter_update(self, step=None):
+        """
+        逐个slot读取变化，每读取step个slot yield一次，方便在reactor中分批执行
+        :param step: None 代表中间不yield
+        :return:
+        """
+        for slot in xrange(self.shared_stat.slot_count):
+            self._update_slot(slot)
+            if step and (slot + 1) % step == 0:
+                yield slot
+
+    def result(self):
+        """
+        当前的汇总结果，每次都是新的对象
+        :return: 格式同 SharedStat.aggregate
+        """
+        shared_stat = self.shared_stat
+
+        endpoint_time_hist = dict(
+            (endpoint, LatencyHistogram.from_counts(shared_stat.precision_bits, shared_stat.max_value_bits, counts,
+                                                    self._endpoint_total_value[endpoint],
+                                                    self._endpoint_max_value[endpoint]))
+            for endpoint, counts in self._endpoint_counts.items()
+        )
+
+        return dict(
+            endpoint_req=dict(self._endpoint_req),
+            endpoint_exc=dict((endpoint, count) for endpoint, count in self._endpoint_exc.items() if count),
+            endpoint_time_hist=endpoint_time_hist,
+            counters=dict(zip(shared_stat.counters, self._counters)),
+        )
+
+    def _update_slot(self, slot):
+        values = self._slot_values_list[slot]
+        seq = values[SLOT_SEQ]
+        if seq == self._slot_seq_list[slot]:
+            return
+        # 先记下序号再读，读的过程中又有写入的话，下次序号一定会变
+        self._slot_seq_list[slot] = seq
+
+        shared_stat = self.shared_stat
+        counter_count = len(shared_stat.counters)
+        first_block = SLOT_HEADER_SIZE + counter_count
+        block_size = ENDPOINT_HEADER_SIZE + shared_stat.bucket_count
+
+        if counter_count:
+            slot_counters = values[SLOT_HEADER_SIZE:first_block]
+            self._counters = map(add, self._counters, map(sub, slot_counters, self._slot_counters_list[slot]))
+            self._slot_counters_list[slot] = slot_counters
+
+        for index, endpoint in enumerate(shared_stat.endpoints + [STAT_KEY_OTHER]):
+            offset = first_block + index * block_size
+            old_block = self._block_dict.get((slot, index))
+            if values[offset + ENDPOINT_REQ] == (old_block[ENDPOINT_REQ] if old_block else 0):
+                continue
+
+            block = array('L', values[offset:offset + block_size])
+            delta = map(sub, block, old_block) if old_block else block
+            self._block_dict[(slot, index)] = block
+
+            self._endpoint_req[endpoint] += delta[ENDPOINT_REQ]
+            self._endpoint_exc[endpoint] += delta[ENDPOINT_EXC]
+            self._endpoint_total_value[endpoint] += delta[ENDPOINT_TOTAL_VALUE]
+            self._endpoint_max_value[endpoint] = max(self._endpoint_max_value[endpoint], block[ENDPOINT_MAX_VALUE])
+
+            counts = delta[ENDPOINT_HEADER_SIZE:]
+            if endpoint in self._endpoint_counts:
+                self._endpoint_counts[endpoint] = array('L', map(add, self._endpoint_counts[endpoint], counts))
+            else:
+                self._endpoint_counts[endpoint] = array('L', counts)
@@ -3,6 +3,8 @@
 from netkit.box import Box
 from collections import OrderedDict
 
+from log import logger
+
 # 如果header字段变化，那么格式也会变化
 HEADER_ATTRS = OrderedDict([
     ('magic', ('i', 2037952207)),
@@ -10,8 +12,48 @@ HEADER_ATTRS = OrderedDict([
     ('packet_len', ('i', 0)),
     ('cmd', ('i', 0)),
     ('client_ip_num', ('I', 0)),
+    # 任务序号，worker回应时原样带回
+    ('sn', ('I', 0)),
+    # 任务所属的分组，借用其他分组的worker处理时，与worker的分组不同
+    ('group_id', ('i', 0)),
     ])
 
 
 class Task(Box):
     header_attrs = HEADER_ATTRS
+
+
+def pack_batch(cmd, data_list):
+    """
+    把多个打包好的task合并为一个task
+    :param cmd: CMD_WORKER_TASK_BATCH_ASSIGN / CMD_WORKER_TASK_BATCH_DONE
+    :param data_list: 打包好的task列表
+    :return: 打包好的数据
+    """
+    return Task(dict(
+        cmd=cmd,
+        body=''.join(data_list),
+    )).pack()
+
+
+def unpack_batch(data):
+    """
+    从合并的task的body中解析出所有task
+    :param data:
+    :return: task列表
+    """
+    task_list = []
+    offset = 0
+
+    while offset < len(data):
+        task = Task()
+        # 用buffer避免每次都拷贝剩余的数据
+        ret = task.unpack(buffer(data, offset))
+        if ret <= 0:
+            logger.error('unpack batch fail. ret: %s, offset: %s, data_len: %s', ret, offset, len(data))
+            break
+
+        task_list.append(task)
+        offset += ret
+
+    return task_list
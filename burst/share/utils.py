@@ -58,3 +58,70 @@ def import_module_or_string(src):
     """
     from config import import_string
     return import_string(src) if isinstance(src, (str, unicode)) else src
+
+
+def cached_call(cache, key, version, func, *args, **kwargs):
+    """
+    version和上次调用时相同，就直接返回上次的结果
+    :param cache: {key: (version, result)}，为None时不缓存
+    :param key:
+    :param version:
+    :param func:
+    :return: func(*args, **kwargs)
+    """
+    if cache is not None:
+        cached = cache.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+    result = func(*args, **kwargs)
+    if cache is not None:
+        cache[key] = (version, result)
+
+    return result
+
+
+def diff_dict(old_dict, new_dict):
+    """
+    比较两个嵌套的dict，只保留变化了的部分
+    :param old_dict:
+    :param new_dict:
+    :return: 变化的部分，被删除的key对应的值为None
+    """
+    delta = dict()
+
+    for key, new_value in new_dict.items():
+        old_value = old_dict.get(key)
+        if new_value is old_value:
+            # 同一个对象，比如沿用了上次的计算结果
+            continue
+        if isinstance(new_value, dict) and isinstance(old_value, dict):
+            sub_delta = diff_dict(old_value, new_value)
+            if sub_delta:
+                delta[key] = sub_delta
+        elif key not in old_dict or old_value != new_value:
+            delta[key] = new_value
+
+    for key in old_dict:
+        if key not in new_dict:
+            delta[key] = None
+
+    return delta
+
+
+def apply_dict_delta(target_dict, delta):
+    """
+    把 diff_dict 的结果合并到dict中
+    :param target_dict: 会被直接修改
+    :param delta:
+    :return: target_dict
+    """
+    for key, value in delta.items():
+        if value is None:
+            target_dict.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target_dict.get(key), dict):
+            apply_dict_delta(target_dict[key], value)
+        else:
+            target_dict[key] = value
+
+    return target_dict
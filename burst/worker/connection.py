@@ -8,7 +8,7 @@ from netkit.contrib.tcp_client import TcpClient
 
 from ..share import constants
 from ..share.log import logger
-from ..share.task import Task
+from ..share.task import Task, pack_batch, unpack_batch
 
 
 class Connection(object):
@@ -16,6 +16,12 @@ class Connection(object):
     # 工作进展
     work_progress = None
 
+    # 批量处理时，待发送的回应。为None时代表不在批量处理中
+    _batch_rsp_list = None
+
+    # 是否已经通知proxy要退休
+    _retire_sent = False
+
     def __init__(self, worker, address, conn_timeout):
         self.worker = worker
         # 直接创建即可
@@ -52,6 +58,10 @@ class Connection(object):
                     os._exit(-1)
 
     def _handle(self):
+        if self.worker.retiring and self.closed():
+            # 要退休了，不需要再重连
+            self.worker.enable = False
+
         while self.worker.enable and self.closed():
             if not self._connect():
                 logger.error('connect fail. worker: %s, address: %s, sleep %ss',
@@ -91,20 +101,48 @@ class Connection(object):
         for bp in self.worker.app.blueprints:
             bp.events.before_app_response(self, data)
 
+        if self._batch_rsp_list is not None:
+            # 批量处理中，先攒起来，整批处理完之后一起发送
+            self._batch_rsp_list.append(data)
+            return True
+
         ret = self.client.write(data)
         if not ret:
             logger.error('connection write fail. worker: %s, data: %r', self.worker, data)
 
+        self._on_response_written(data, ret)
+
+        return ret
+
+    def _flush_batch(self):
+        """
+        把批量处理时攒下的回应合并为一个包发送
+        """
+        rsp_list = self._batch_rsp_list
+        self._batch_rsp_list = None
+
+        if not rsp_list:
+            return
+
+        ret = self.client.write(pack_batch(constants.CMD_WORKER_TASK_BATCH_DONE, rsp_list))
+        if not ret:
+            logger.error('connection write fail. worker: %s, rsp_count: %s', self.worker, len(rsp_list))
+
+        for data in rsp_list:
+            self._on_response_written(data, ret)
+
+    def _on_response_written(self, data, ret):
         for bp in self.worker.app.blueprints:
             bp.events.after_app_response(self, data, ret)
         self.worker.app.events.after_response(self, data, ret)
 
-        return ret
-
     def _read_message(self):
         task = None
 
         while 1:
+            if self.worker.retiring and not self._retire_sent:
+                self._send_retire()
+
             try:
                 # 读取数据 gw_box
                 task = self.client.read()
@@ -138,6 +176,53 @@ class Connection(object):
         """
         数据获取结束
         """
+        if task.cmd == constants.CMD_WORKER_RETIRE:
+            # proxy已经不会再分配任务了，可以退出
+            logger.info('retire done. worker: %s', self.worker)
+            self.worker.enable = False
+        elif task.cmd == constants.CMD_WORKER_TASK_BATCH_ASSIGN:
+            self._on_batch_read_complete(task)
+        else:
+            self._on_task_read_complete(task)
+
+    def on_retire(self):
+        """
+        收到退休信号，在信号处理函数中调用
+        阻塞读取时netkit遇到EINTR会继续读，要等到读超时才会回到循环中检查退休标记，所以直接通知proxy
+        正在读取说明没有在写数据，这时写不会和其他数据交错
+        """
+        if self._retire_sent or self.closed() or not self.client.stream.reading:
+            return
+
+        self._send_retire()
+
+    def _send_retire(self):
+        """
+        通知proxy不要再分配新任务
+        """
+        self._retire_sent = True
+
+        task = Task(dict(
+            cmd=constants.CMD_WORKER_RETIRE,
+        ))
+        if not self.client.write(task.pack()):
+            logger.error('connection write fail. worker: %s, task: %r', self.worker, task)
+
+    def _on_batch_read_complete(self, task):
+        """
+        批量任务，逐个处理之后一起回应
+        """
+        self._batch_rsp_list = []
+        try:
+            for sub_task in unpack_batch(task.body):
+                self._on_task_read_complete(sub_task)
+        finally:
+            self._flush_batch()
+
+    def _on_task_read_complete(self, task):
+        """
+        处理单个任务
+        """
         request = self.worker.request_class(self, task)
 
         # 设置task开始处理的时间和信息
@@ -166,6 +251,8 @@ class Connection(object):
             for bp in self.worker.app.blueprints:
                 bp.events.before_app_first_request(request)
 
+        begin_time = time.time()
+
         self.worker.app.events.before_request(request)
         for bp in self.worker.app.blueprints:
             bp.events.before_app_request(request)
@@ -178,6 +265,7 @@ class Connection(object):
             self.write(request.make_rsp(
                 request.interrupt_data
             ))
+            self.worker.stat_counter.add_request(request.endpoint, time.time() - begin_time)
             return True
 
         view_func_exc = None
@@ -201,6 +289,8 @@ class Connection(object):
             bp.events.after_app_request(request, view_func_exc)
         self.worker.app.events.after_request(request, view_func_exc)
 
+        self.worker.stat_counter.add_request(request.endpoint, time.time() - begin_time, view_func_exc is not None)
+
         return True
 
     def close(self):
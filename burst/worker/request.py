@@ -83,6 +83,14 @@ class Request(object):
         """
         return ip_int_to_str(self.task.client_ip_num)
 
+    @property
+    def group_id(self):
+        """
+        任务所属的分组，借用其他分组的worker处理时，与 worker.group_id 不同
+        :return:
+        """
+        return self.task.group_id
+
     @property
     def cmd(self):
         try:
@@ -117,6 +125,7 @@ class Request(object):
 
         task = Task(dict(
             cmd=constants.CMD_WORKER_TASK_DONE,
+            sn=self.task.sn,
             body=data or '',
         ))
 
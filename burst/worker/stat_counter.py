@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+"""
+worker端按endpoint统计，直接写入master创建的共享内存，proxy查看统计时读取汇总
+"""
+
+from ..share.shared_stat import SharedStat, StatSlot
+from ..share.log import logger
+
+
+class StatCounter(object):
+    """
+    统计计算类
+    没有分配到slot时(比如没有配置 WORKER_STAT_SHM)，所有统计都直接忽略
+    """
+
+    # 写入的slot
+    stat_slot = None
+
+    def open(self, path, slot, pid, group_id):
+        """
+        打开共享内存
+        :param path:
+        :param slot:
+        :param pid:
+        :param group_id:
+        :return: 是否成功
+        """
+        try:
+            self.stat_slot = StatSlot(SharedStat.open(path), slot, pid, group_id)
+        except:
+            logger.error('open shared stat fail. path: %s, slot: %s', path, slot, exc_info=True)
+            return False
+
+        return True
+
+    def add_request(self, endpoint, handle_time, exc=False):
+        """
+        添加一个处理完成的请求
+        :param endpoint:
+        :param handle_time: 处理时间，秒
+        :param exc: view_func是否抛出了异常
+        :return:
+        """
+        if self.stat_slot:
+            self.stat_slot.add_request(endpoint, handle_time, exc)
+
+    def incr(self, name, value=1):
+        """
+        自定义计数，name必须在 WORKER_STAT_COUNTERS 中配置过
+        :param name:
+        :param value:
+        :return:
+        """
+        if self.stat_slot:
+            self.stat_slot.incr(name, value)
@@ -3,10 +3,15 @@
 import signal
 import setproctitle
 import os
+import thread
+import functools
 
 from .connection import Connection
 from ..share.log import logger
+from ..share.utils import safe_call
+from ..share import profiler
 from .request import Request
+from .stat_counter import StatCounter
 from ..share import constants
 
 
@@ -23,6 +28,22 @@ class Worker(object):
     # 是否有效(父进程中代表程序有效，子进程中代表worker是否有效)
     enable = True
 
+    # 是否要退休，处理完已经分配的任务后退出
+    retiring = False
+
+    # 与proxy的连接
+    connection = None
+
+    # 统计
+    stat_counter = None
+    # master分配的共享内存统计slot
+    stat_slot = None
+
+    # 正在进行的profile采样
+    stack_sampler = None
+    # 处理请求的线程，profile时采样这个线程
+    _main_thread_ident = None
+
     def __init__(self, app, group_id):
         """
         构造函数
@@ -30,13 +51,17 @@ class Worker(object):
         """
         self.app = app
         self.group_id = group_id
+        self.stat_counter = StatCounter()
 
     def run(self):
         setproctitle.setproctitle(self.app.make_proc_name(
             '%s:%s' % (self.type, self.group_id)
         ))
 
+        self._main_thread_ident = thread.get_ident()
+
         self._handle_proc_signals()
+        self._open_stat_counter()
         self._on_worker_run()
 
         try:
@@ -44,13 +69,60 @@ class Worker(object):
                 self.app.config['IPC_ADDRESS_DIRECTORY'],
                 self.app.config['WORKER_ADDRESS_TPL'] % self.group_id
             )
-            conn = self.connection_class(self, address, self.app.config['WORKER_CONN_TIMEOUT'])
-            conn.run()
+            self.connection = self.connection_class(self, address, self.app.config['WORKER_CONN_TIMEOUT'])
+            self.connection.run()
         except KeyboardInterrupt:
             pass
         except:
             logger.error('exc occur. worker: %s', self, exc_info=True)
 
+    def _open_stat_counter(self):
+        if self.stat_slot is None or not self.app.config['WORKER_STAT_SHM']:
+            return
+
+        path = os.path.join(
+            self.app.config['IPC_ADDRESS_DIRECTORY'],
+            self.app.config['WORKER_STAT_SHM']
+        )
+        self.stat_counter.open(path, self.stat_slot, os.getpid(), self.group_id)
+
+    def _start_profile(self):
+        """
+        master写好profile请求文件后发信号通知，开始采样
+        :return:
+        """
+        ipc_directory = self.app.config['IPC_ADDRESS_DIRECTORY']
+        params = profiler.read_json_file(profiler.request_path(ipc_directory, os.getpid()))
+        if not params:
+            logger.error('profile request not found. worker: %s', self)
+            return
+
+        if self.stack_sampler and self.stack_sampler.running:
+            logger.error('profile already running. worker: %s, params: %s', self, params)
+            return
+
+        logger.info('profile start. worker: %s, params: %s', self, params)
+
+        self.stack_sampler = profiler.StackSampler(self._main_thread_ident, params['interval'], params['seconds'])
+        self.stack_sampler.start(functools.partial(self._on_profile_done, params['profile_id']))
+
+    def _on_profile_done(self, profile_id, sampler):
+        """
+        采样结束，在采样线程中调用，把结果写入文件等待master收集
+        :param profile_id:
+        :param sampler:
+        :return:
+        """
+        profiler.write_json_file(
+            profiler.result_path(self.app.config['IPC_ADDRESS_DIRECTORY'], os.getpid(), profile_id),
+            dict(
+                samples=sampler.samples,
+                stacks=sampler.stack_counter,
+            )
+        )
+
+        logger.info('profile done. worker: %s, sampler: %s', self, sampler)
+
     def _on_worker_run(self):
         self.app.events.create_worker(self)
         for bp in self.app.blueprints:
@@ -66,12 +138,26 @@ class Worker(object):
         def safe_stop_handler(signum, frame):
             self.enable = False
 
+        def retire_handler(signum, frame):
+            self.retiring = True
+            # 可能正在写数据，由connection判断能否立即通知proxy
+            if self.connection:
+                self.connection.on_retire()
+
+        def profile_handler(signum, frame):
+            # 只是启动采样线程，不影响正在处理的请求
+            safe_call(self._start_profile)
+
         # 强制结束，抛出异常终止程序进行
         signal.signal(signal.SIGINT, stop_handler)
         signal.signal(signal.SIGQUIT, stop_handler)
         # 安全停止
         signal.signal(signal.SIGTERM, safe_stop_handler)
         signal.signal(signal.SIGHUP, safe_stop_handler)
+        # 退休，用于减少worker数量
+        signal.signal(signal.SIGUSR1, retire_handler)
+        # 开始profile采样
+        signal.signal(signal.SIGUSR2, profile_handler)
 
     def __repr__(self):
         return '<%s name: %s, group_id: %r>' % (
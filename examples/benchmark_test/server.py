@@ -23,6 +23,9 @@ logger.setLevel(logging.DEBUG)
 GROUP_CONFIG = {
     1: {
         'count': 10,
+        # 对比批量分配任务的效果
+        # 'prefetch': 8,
+        # 'batch': True,
     },
 }
 
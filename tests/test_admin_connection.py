@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+import json
+import unittest
+
+from netkit.box import Box
+
+from burst.share import constants
+from burst.share.histogram import LatencyHistogram
+from burst.share.utils import apply_dict_delta
+from burst.proxy.stat_counter import StatCounter
+from burst.proxy.task_dispatcher import TaskDispatcher
+from burst.proxy.connection.admin_connection import AdminConnection
+
+
+class FakeApp(object):
+
+    box_class = Box
+
+    def __init__(self, **kwargs):
+        self.config = dict(constants.DEFAULT_CONFIG)
+        self.config.update(kwargs)
+
+
+class FakeSharedStat(object):
+
+    def __init__(self, slot_count):
+        self.slot_count = slot_count
+
+
+class FakeProxy(object):
+
+    master_conn = None
+
+    def __init__(self, **kwargs):
+        self.app = FakeApp(**kwargs)
+        self.stat_counter = StatCounter(self.app.config['TASKS_TIME_BENCHMARK'])
+        self.task_dispatcher = TaskDispatcher(self)
+        self.profile_requests = dict()
+
+
+class FakeFactory(object):
+
+    def __init__(self, **kwargs):
+        self.proxy = FakeProxy(**kwargs)
+
+
+class FakeTransport(object):
+
+    def __init__(self):
+        self.data_list = []
+
+    def write(self, data):
+        self.data_list.append(data)
+
+
+class GroupChangeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = FakeFactory(GROUP_CONFIG={
+            1: dict(count=2),
+            2: dict(count=1, max_count=4),
+        })
+        self.conn = AdminConnection(self.factory, ('127.0.0.1', 0))
+
+    def test_valid(self):
+        self.assertTrue(self.conn._validate_group_change(1, 1))
+        self.assertTrue(self.conn._validate_group_change(1, 100))
+
+    def test_invalid_params(self):
+        self.assertFalse(self.conn._validate_group_change('1', 1))
+        self.assertFalse(self.conn._validate_group_change(1, '1'))
+        self.assertFalse(self.conn._validate_group_change(1, 1.0))
+
+    def test_unknown_group(self):
+        self.assertFalse(self.conn._validate_group_change(3, 1))
+
+    def test_keep_one_worker(self):
+        # 分组没有worker时，master会退出
+        self.assertFalse(self.conn._validate_group_change(1, 0))
+        self.assertFalse(self.conn._validate_group_change(1, -1))
+
+    def test_stat_slot_capacity(self):
+        # 2 * (2 + 4) + 16
+        self.factory.proxy.stat_counter.shared_stat = FakeSharedStat(28)
+
+        self.assertFalse(self.conn._validate_group_change(1, 3))
+        # max_count之内不需要新的slot
+        self.assertTrue(self.conn._validate_group_change(2, 4))
+        self.assertFalse(self.conn._validate_group_change(2, 5))
+
+        self.factory.proxy.stat_counter.shared_stat = FakeSharedStat(30)
+        self.assertTrue(self.conn._validate_group_change(1, 3))
+
+    def test_shrink_always_allowed(self):
+        # 配置了较小的 WORKER_STAT_SLOTS 时，也要能缩容
+        self.factory.proxy.stat_counter.shared_stat = FakeSharedStat(4)
+        self.assertTrue(self.conn._validate_group_change(1, 1))
+        self.assertFalse(self.conn._validate_group_change(1, 3))
+
+
+class StatSubscribeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = FakeFactory(GROUP_CONFIG={1: dict(count=1), 2: dict(count=1)})
+        self.stat_counter = self.factory.proxy.stat_counter
+        self.conn = AdminConnection(self.factory, ('127.0.0.1', 0))
+        self.conn.transport = FakeTransport()
+        self.conn.connected = 1
+
+        for cmd in xrange(10):
+            self.stat_counter.add_cmd_req(cmd)
+            self.stat_counter.add_task_time(1, cmd, 0.001, 0.01)
+
+        # 统计计算分位数的次数
+        self.quantiles_count = 0
+        self._quantiles = LatencyHistogram.quantiles
+
+        def quantiles(histogram, *args, **kwargs):
+            self.quantiles_count += 1
+            return self._quantiles(histogram, *args, **kwargs)
+
+        LatencyHistogram.quantiles = quantiles
+
+    def tearDown(self):
+        LatencyHistogram.quantiles = self._quantiles
+        self.conn.connectionLost()
+
+    def subscribe(self, with_hist=False):
+        self.conn._start_stat_subscribe(Box(dict(cmd=constants.CMD_ADMIN_STAT_SUBSCRIBE)), 10, with_hist)
+        return self.pop_delta()
+
+    def pop_delta(self):
+        box = Box()
+        box.unpack(self.conn.transport.data_list.pop(0))
+        self.assertEqual(self.conn.transport.data_list, [])
+        return json.loads(box.body)
+
+    def push(self):
+        self.conn._push_stat()
+        return self.pop_delta()
+
+    def test_first_push_is_full(self):
+        body = self.subscribe()
+        full_body = json.loads(json.dumps(self.conn._make_stat_body(with_hist=False)))
+        self.assertEqual(body, full_body)
+
+        # 快照只在需要时推送
+        self.assertNotIn('cmd_time_hist', body)
+        self.assertIn('cmd_time_hist', self.conn._make_stat_body())
+
+    def test_push_only_changed(self):
+        self.subscribe()
+        self.quantiles_count = 0
+        self.assertEqual(self.push(), dict())
+        # 没有新记录，不需要重新计算
+        self.assertEqual(self.quantiles_count, 0)
+
+        self.stat_counter.add_cmd_req(3)
+        self.stat_counter.add_task_time(1, 3, 0.001, 0.02)
+        delta = self.push()
+
+        self.assertEqual(delta['cmd_req'], {'3': 2})
+        for kind in constants.TASK_TIME_KINDS:
+            self.assertEqual(delta['cmd_time_quantiles'][kind].keys(), ['3'])
+            self.assertEqual(sorted(delta['tasks_time_quantiles'][kind].keys()), ['1', 'all'])
+        self.assertEqual(delta['cmd_time_quantiles']['service']['3']['count'], 2)
+        # cmd, 分组, 汇总，每种耗时各一次
+        self.assertEqual(self.quantiles_count, 3 * len(constants.TASK_TIME_KINDS))
+
+    def test_push_hist(self):
+        result = self.subscribe(with_hist=True)
+        self.assertEqual(result['cmd_time_hist']['service']['3']['total_count'], 1)
+        self.assertEqual(self.push(), dict())
+
+        self.stat_counter.add_task_time(1, 3, 0.001, 0.02)
+        delta = self.push()
+        self.assertEqual(delta['cmd_time_hist']['service'].keys(), ['3'])
+
+        # 客户端合并之后与全量一致
+        apply_dict_delta(result, delta)
+        self.assertEqual(result, json.loads(json.dumps(self.conn._make_stat_body())))
+
+    def test_stop(self):
+        self.subscribe()
+        self.conn._stop_stat_subscribe()
+
+        # 不在订阅中时不缓存
+        self.conn._make_stat_body()
+        self.quantiles_count = 0
+        self.conn._make_stat_body()
+        self.assertGreater(self.quantiles_count, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from burst.proxy.admission import TokenBucket, RateLimiter
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_burst(self):
+        bucket = TokenBucket(1, 3, now=0)
+        self.assertEqual([bucket.acquire(0) for _ in xrange(4)], [True, True, True, False])
+
+    def test_refill(self):
+        bucket = TokenBucket(10, 2, now=0)
+        bucket.acquire(0)
+        bucket.acquire(0)
+        self.assertFalse(bucket.acquire(0))
+
+        # 0.1秒补充1个
+        self.assertTrue(bucket.acquire(0.1))
+        self.assertFalse(bucket.acquire(0.1))
+
+    def test_refill_capped(self):
+        bucket = TokenBucket(10, 2, now=0)
+        bucket.acquire(0)
+
+        self.assertEqual([bucket.acquire(100) for _ in xrange(3)], [True, True, False])
+
+    def test_clock_backwards(self):
+        bucket = TokenBucket(10, 1, now=10)
+        self.assertTrue(bucket.acquire(10))
+        # 时间回退时不补充
+        self.assertFalse(bucket.acquire(5))
+        # 之后从回退后的时间开始补充
+        self.assertTrue(bucket.acquire(5.5))
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def test_default_limit(self):
+        limiter = RateLimiter((1, 2))
+        self.assertEqual([limiter.acquire('a', 0) for _ in xrange(3)], [True, True, False])
+        # 每个key单独限流
+        self.assertTrue(limiter.acquire('b', 0))
+
+    def test_limit_dict(self):
+        limiter = RateLimiter(limit_dict={1: (1, 1)})
+        self.assertTrue(limiter.acquire(1, 0))
+        self.assertFalse(limiter.acquire(1, 0))
+
+        # 没有配置的key不限流，也不占用桶
+        for _ in xrange(10):
+            self.assertTrue(limiter.acquire(2, 0))
+        self.assertEqual(len(limiter.bucket_dict), 1)
+
+    def test_empty_limiter_still_limits(self):
+        limiter = RateLimiter((1, 1))
+        self.assertTrue(limiter)
+        self.assertTrue(limiter.acquire('a', 0))
+        self.assertFalse(limiter.acquire('a', 0))
+
+    def test_lru_eviction(self):
+        limiter = RateLimiter((1, 1))
+        limiter.max_buckets = 3
+
+        for key in 'abc':
+            limiter.acquire(key, 0)
+        # 使用过的移到最后
+        limiter.acquire('a', 0)
+        limiter.acquire('d', 0)
+
+        self.assertEqual(limiter.bucket_dict.keys(), ['c', 'a', 'd'])
+        # 被淘汰的key会拿到新的桶
+        self.assertTrue(limiter.acquire('b', 0))
+        self.assertEqual(limiter.bucket_dict.keys(), ['a', 'd', 'b'])
+        # 没有被淘汰的key还是原来的桶
+        self.assertFalse(limiter.acquire('a', 0))
+
+    def test_max_buckets(self):
+        limiter = RateLimiter((1, 1))
+        limiter.max_buckets = 100
+
+        for key in xrange(1000):
+            limiter.acquire(key, 0)
+
+        self.assertEqual(len(limiter.bucket_dict), 100)
+        self.assertEqual(limiter.bucket_dict.keys(), range(900, 1000))
+
+
+if __name__ == '__main__':
+    unittest.main()
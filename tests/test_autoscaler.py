@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from burst.share import constants
+from burst.master.autoscaler import Autoscaler
+
+
+class FakeApp(object):
+
+    def __init__(self, group_config, **kwargs):
+        self.config = dict(constants.DEFAULT_CONFIG)
+        self.config.update(kwargs)
+        self.config['GROUP_CONFIG'] = group_config
+
+
+def make_load(pending, busy, idle):
+    return dict(pending=pending, busy=busy, idle=idle)
+
+
+class AutoscalerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = FakeApp({
+            1: dict(count=4, min_count=2, max_count=10),
+            2: dict(count=3),
+        })
+        self.autoscaler = Autoscaler(self.app)
+
+    def test_scale_up(self):
+        # 每次最多翻倍
+        self.assertEqual(self.autoscaler.decide({1: make_load(100, 4, 0)}), {1: 8})
+
+    def test_scale_up_limited_by_pending(self):
+        self.assertEqual(self.autoscaler.decide({1: make_load(1, 4, 0)}), {1: 5})
+
+    def test_scale_up_limited_by_max_count(self):
+        self.app.config['GROUP_CONFIG'][1]['count'] = 8
+        self.assertEqual(self.autoscaler.decide({1: make_load(100, 8, 0)}), {1: 10})
+
+        self.app.config['GROUP_CONFIG'][1]['count'] = 10
+        self.autoscaler.last_scale_time_dict.clear()
+        self.assertEqual(self.autoscaler.decide({1: make_load(100, 10, 0)}), {})
+
+    def test_no_scale_up_when_idle_workers(self):
+        self.assertEqual(self.autoscaler.decide({1: make_load(10, 2, 2)}), {})
+
+    def test_scale_down(self):
+        self.assertEqual(self.autoscaler.decide({1: make_load(0, 1, 3)}), {1: 3})
+
+    def test_scale_down_limited_by_min_count(self):
+        self.app.config['GROUP_CONFIG'][1]['count'] = 2
+        self.assertEqual(self.autoscaler.decide({1: make_load(0, 0, 2)}), {})
+
+    def test_keep_at_least_one_worker(self):
+        self.app.config['GROUP_CONFIG'][1].update(count=1, min_count=0)
+        self.assertEqual(self.autoscaler.decide({1: make_load(0, 0, 1)}), {})
+
+    def test_workers_not_match_count(self):
+        # 还有worker没有连上，不调整
+        self.assertEqual(self.autoscaler.decide({1: make_load(100, 3, 0)}), {})
+
+    def test_group_without_max_count(self):
+        self.assertEqual(self.autoscaler.decide({2: make_load(100, 3, 0)}), {})
+        self.assertEqual(self.autoscaler.decide({3: make_load(100, 3, 0)}), {})
+
+    def test_cooldown(self):
+        self.assertEqual(self.autoscaler.decide({1: make_load(100, 4, 0)}), {1: 8})
+        self.app.config['GROUP_CONFIG'][1]['count'] = 8
+
+        self.assertEqual(self.autoscaler.decide({1: make_load(100, 8, 0)}), {})
+
+        self.autoscaler.last_scale_time_dict[1] -= self.app.config['AUTOSCALE_COOLDOWN']
+        self.assertEqual(self.autoscaler.decide({1: make_load(100, 8, 0)}), {1: 10})
+
+
+if __name__ == '__main__':
+    unittest.main()
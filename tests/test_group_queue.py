@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from burst.share import constants
+from burst.proxy.group_queue import Queue, FairQueue, LaneQueue, GroupQueue
+
+
+class Item(object):
+
+    queued = False
+
+    def __init__(self, name, lane=0, flow=None):
+        self.name = name
+        self.lane = lane
+        self.flow = flow
+
+    def __repr__(self):
+        return '<Item %s>' % self.name
+
+
+def drain_names(queue):
+    return [item.name for item in queue.drain()]
+
+
+class QueueTest(unittest.TestCase):
+
+    def test_fifo(self):
+        queue = Queue()
+        for index in xrange(5):
+            queue.put(Item(index))
+
+        self.assertEqual(queue.qsize(), 5)
+        self.assertEqual([queue.get().name for _ in xrange(5)], range(5))
+        self.assertIsNone(queue.get())
+        self.assertTrue(queue.empty())
+
+    def test_max_size(self):
+        queue = Queue(2)
+        self.assertTrue(queue.put(Item(0)))
+        self.assertTrue(queue.put(Item(1)))
+        self.assertTrue(queue.full())
+        self.assertFalse(queue.put(Item(2)))
+
+        # 取消之后空出位置
+        queue.cancel(queue._items[0])
+        self.assertTrue(queue.put(Item(3)))
+        self.assertEqual(drain_names(queue), [1, 3])
+
+    def test_cancel_skipped_by_get(self):
+        queue = Queue()
+        items = [Item(index) for index in xrange(5)]
+        for item in items:
+            queue.put(item)
+
+        self.assertTrue(queue.cancel(items[0]))
+        self.assertTrue(queue.cancel(items[3]))
+        # 已经取消的不能再取消
+        self.assertFalse(queue.cancel(items[3]))
+
+        self.assertEqual(queue.qsize(), 3)
+        self.assertEqual([queue.get().name for _ in xrange(3)], [1, 2, 4])
+        self.assertIsNone(queue.get())
+        self.assertEqual(queue._cancelled_count, 0)
+
+    def test_peek(self):
+        queue = Queue()
+        self.assertIsNone(queue.peek())
+
+        items = [Item(index) for index in xrange(2)]
+        for item in items:
+            queue.put(item)
+
+        queue.cancel(items[0])
+        self.assertIs(queue.peek(), items[1])
+        # 不会取出
+        self.assertEqual(queue.qsize(), 1)
+        self.assertEqual(queue._cancelled_count, 0)
+        self.assertIs(queue.get(), items[1])
+
+    def test_cancel_after_get(self):
+        queue = Queue()
+        item = Item(0)
+        queue.put(item)
+
+        self.assertIs(queue.get(), item)
+        self.assertFalse(queue.cancel(item))
+        self.assertEqual(queue.qsize(), 0)
+
+    def test_compact(self):
+        queue = Queue()
+        queue.compact_min_count = 4
+        items = [Item(index) for index in xrange(10)]
+        for item in items:
+            queue.put(item)
+
+        # 取消的没有超过一半，不重建
+        for item in items[:4]:
+            queue.cancel(item)
+        self.assertEqual(len(queue._items), 10)
+        self.assertEqual(queue._cancelled_count, 4)
+
+        # 超过一半时重建，只留下有效的
+        for item in items[4:6]:
+            queue.cancel(item)
+        self.assertEqual(len(queue._items), 4)
+        self.assertEqual(queue._cancelled_count, 0)
+        self.assertEqual(queue.qsize(), 4)
+        self.assertEqual(drain_names(queue), [6, 7, 8, 9])
+
+    def test_compact_min_count(self):
+        queue = Queue()
+        items = [Item(index) for index in xrange(4)]
+        for item in items:
+            queue.put(item)
+
+        # 没有达到compact_min_count，即使全部取消也不重建
+        for item in items:
+            queue.cancel(item)
+        self.assertEqual(len(queue._items), 4)
+        self.assertTrue(queue.empty())
+        self.assertIsNone(queue.get())
+        self.assertEqual(len(queue._items), 0)
+
+    def test_drain(self):
+        queue = Queue()
+        items = [Item(index) for index in xrange(5)]
+        for item in items:
+            queue.put(item)
+        queue.cancel(items[1])
+
+        self.assertEqual([item.name for item in queue.drain(2)], [0, 2])
+        self.assertEqual(drain_names(queue), [3, 4])
+        self.assertTrue(queue.empty())
+        self.assertFalse(any(item.queued for item in items))
+
+    def test_clear(self):
+        queue = Queue()
+        items = [Item(index) for index in xrange(3)]
+        for item in items:
+            queue.put(item)
+
+        queue.clear()
+        self.assertTrue(queue.empty())
+        self.assertFalse(any(item.queued for item in items))
+        self.assertFalse(queue.cancel(items[0]))
+
+
+class FairQueueTest(unittest.TestCase):
+
+    def test_round_robin(self):
+        queue = FairQueue()
+        for index in xrange(4):
+            queue.put(Item('a%s' % index, flow='a'))
+        for index in xrange(2):
+            queue.put(Item('b%s' % index, flow='b'))
+        queue.put(Item('c0', flow='c'))
+
+        self.assertEqual(queue.qsize(), 7)
+        self.assertEqual(queue.flow_count(), 3)
+        self.assertEqual(drain_names(queue), ['a0', 'b0', 'c0', 'a1', 'b1', 'a2', 'a3'])
+        self.assertEqual(queue.flow_count(), 0)
+
+    def test_flow_requeued_at_tail(self):
+        queue = FairQueue()
+        queue.put(Item('a0', flow='a'))
+        queue.put(Item('b0', flow='b'))
+        self.assertEqual(queue.get().name, 'a0')
+
+        # a的子队列已经空了，再来任务时排到b后面
+        queue.put(Item('a1', flow='a'))
+        queue.put(Item('b1', flow='b'))
+        self.assertEqual(drain_names(queue), ['b0', 'a1', 'b1'])
+
+    def test_max_size(self):
+        queue = FairQueue(3)
+        self.assertTrue(queue.put(Item('a0', flow='a')))
+        self.assertTrue(queue.put(Item('a1', flow='a')))
+        self.assertTrue(queue.put(Item('b0', flow='b')))
+        self.assertFalse(queue.put(Item('c0', flow='c')))
+        self.assertTrue(queue.full())
+
+    def test_cancel(self):
+        queue = FairQueue()
+        a0 = Item('a0', flow='a')
+        b0 = Item('b0', flow='b')
+        queue.put(a0)
+        queue.put(Item('a1', flow='a'))
+        queue.put(b0)
+
+        self.assertTrue(queue.cancel(b0))
+        self.assertFalse(queue.cancel(b0))
+        self.assertFalse(queue.cancel(Item('x', flow='x')))
+        self.assertEqual(queue.qsize(), 2)
+
+        # b的子队列取消空了，轮到它时直接跳过
+        self.assertEqual(drain_names(queue), ['a0', 'a1'])
+        self.assertIsNone(queue.get())
+        self.assertEqual(queue.flow_count(), 0)
+
+
+class LaneQueueTest(unittest.TestCase):
+
+    lane_configs = [dict(max_size=-1, weight=3), dict(max_size=-1, weight=1)]
+
+    def test_strict(self):
+        queue = LaneQueue(self.lane_configs, constants.PRIORITY_POLICY_STRICT)
+        for index in xrange(3):
+            queue.put(Item('low%s' % index, lane=1))
+        for index in xrange(2):
+            queue.put(Item('high%s' % index, lane=0))
+
+        self.assertEqual(queue.qsize(), 5)
+        self.assertEqual(queue.lane_qsize(0), 2)
+        self.assertEqual(drain_names(queue), ['high0', 'high1', 'low0', 'low1', 'low2'])
+
+    def test_weighted(self):
+        queue = LaneQueue(self.lane_configs, constants.PRIORITY_POLICY_WEIGHTED)
+        for index in xrange(8):
+            queue.put(Item('high%s' % index, lane=0))
+            queue.put(Item('low%s' % index, lane=1))
+
+        lanes = [item.lane for item in queue.drain(8)]
+        # 按3:1的权重交替，低优先级不会饿死
+        self.assertEqual(lanes, [0, 0, 1, 0] * 2)
+
+    def test_weighted_skips_empty_lane(self):
+        queue = LaneQueue(self.lane_configs, constants.PRIORITY_POLICY_WEIGHTED)
+        for index in xrange(3):
+            queue.put(Item('low%s' % index, lane=1))
+
+        self.assertEqual(drain_names(queue), ['low0', 'low1', 'low2'])
+        self.assertIsNone(queue.get())
+
+    def test_lane_max_size(self):
+        queue = LaneQueue([dict(max_size=1, weight=1), dict(max_size=-1, weight=1)])
+        self.assertTrue(queue.put(Item('high0', lane=0)))
+        self.assertFalse(queue.put(Item('high1', lane=0)))
+        self.assertTrue(queue.put(Item('low0', lane=1)))
+        self.assertTrue(queue.full(0))
+        self.assertFalse(queue.full(1))
+
+    def test_fair_lanes(self):
+        queue = LaneQueue(self.lane_configs, constants.PRIORITY_POLICY_STRICT, fair=True)
+        queue.put(Item('a0', flow='a'))
+        queue.put(Item('a1', flow='a'))
+        queue.put(Item('b0', flow='b'))
+        queue.put(Item('c0', lane=1, flow='c'))
+
+        self.assertEqual(queue.flow_count(), 3)
+        self.assertEqual(drain_names(queue), ['a0', 'b0', 'a1', 'c0'])
+
+    def test_cancel(self):
+        queue = LaneQueue(self.lane_configs)
+        item = Item('low0', lane=1)
+        queue.put(item)
+        queue.put(Item('high0', lane=0))
+
+        self.assertTrue(queue.cancel(item))
+        self.assertEqual(queue.lane_qsize(1), 0)
+        self.assertEqual(drain_names(queue), ['high0'])
+
+
+class GroupQueueTest(unittest.TestCase):
+
+    def test_lane_configs(self):
+        queue = GroupQueue(10, [dict(name='high', max_size=2), dict(name='low')])
+
+        self.assertEqual(queue.lane_names, ['high', 'low'])
+        self.assertEqual([lane_config['max_size'] for lane_config in queue.lane_configs], [2, 10])
+        self.assertEqual([lane_config['weight'] for lane_config in queue.lane_configs], [1, 1])
+
+    def test_groups(self):
+        queue = GroupQueue()
+        queue.put(1, Item('g1'))
+        queue.put(2, Item('g2'))
+
+        self.assertEqual(queue.qsize(1), 1)
+        self.assertEqual(queue.get(2).name, 'g2')
+        self.assertTrue(queue.empty(2))
+        self.assertFalse(queue.empty(1))
+
+
+if __name__ == '__main__':
+    unittest.main()
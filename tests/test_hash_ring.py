@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from collections import Counter
+
+from burst.proxy.hash_ring import HashRing, hash_key
+
+
+class HashRingTest(unittest.TestCase):
+
+    def test_empty(self):
+        self.assertIsNone(HashRing(dict()).get('a'))
+
+    def test_hash_key(self):
+        self.assertEqual(hash_key('a'), hash_key(u'a'))
+        self.assertEqual(hash_key(1), hash_key('1'))
+        self.assertTrue(0 <= hash_key('a') < 2 ** 32)
+
+    def test_stable(self):
+        node_dict = dict((index, 'node%s' % index) for index in xrange(4))
+        ring = HashRing(node_dict)
+        other_ring = HashRing(dict(reversed(node_dict.items())))
+
+        for key in xrange(1000):
+            self.assertEqual(ring.get(key), other_ring.get(key))
+
+    def test_distribution(self):
+        ring = HashRing(dict((index, index) for index in xrange(4)))
+        counter = Counter(ring.get(key) for key in xrange(10000))
+
+        self.assertEqual(sorted(counter), range(4))
+        # 虚拟节点足够多时，每个节点分到的key不会偏离平均值太多
+        for count in counter.values():
+            self.assertTrue(1500 < count < 3500, counter)
+
+    def test_remove_node(self):
+        node_dict = dict((index, index) for index in xrange(5))
+        ring = HashRing(node_dict)
+        del node_dict[2]
+        new_ring = HashRing(node_dict)
+
+        for key in xrange(2000):
+            node = ring.get(key)
+            if node != 2:
+                # 只有落在删掉的节点上的key会换节点
+                self.assertEqual(new_ring.get(key), node)
+            else:
+                self.assertIn(new_ring.get(key), node_dict)
+
+    def test_replicas(self):
+        ring = HashRing(dict(a=1, b=2), replicas=3)
+        self.assertEqual(len(ring._positions), 6)
+        self.assertEqual(ring._positions, sorted(ring._positions))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import unittest
+
+from netkit.box import Box
+
+from burst.share.log import logger
+from burst.proxy.header_parser import HeaderParser, HeaderBox
+
+# 包头不合法时会打错误日志
+logger.addHandler(logging.NullHandler())
+
+
+class HeaderParserTest(unittest.TestCase):
+
+    def setUp(self):
+        self.parser = HeaderParser(Box)
+        self.data = Box(dict(cmd=3, sn=7, body='hello')).pack()
+
+    def test_parse(self):
+        ret, box = self.parser.parse(buffer(self.data + 'next'))
+
+        self.assertEqual(ret, len(self.data))
+        self.assertIsInstance(box, HeaderBox)
+        self.assertEqual((box.cmd, box.sn, box.packet_len), (3, 7, len(self.data)))
+        # 包体不解析
+        self.assertEqual(box.body, '')
+
+    def test_incomplete(self):
+        self.assertEqual(self.parser.parse(buffer(self.data[:10])), (0, None))
+        self.assertEqual(self.parser.parse(buffer(self.data[:-1])), (0, None))
+
+    def test_invalid(self):
+        ret, box = self.parser.parse(buffer('x' * 100))
+        self.assertTrue(ret < 0)
+        self.assertIsNone(box)
+
+    def test_same_as_box(self):
+        full_box = Box()
+        ret, box = self.parser.parse(buffer(self.data))
+        self.assertEqual(ret, full_box.unpack(self.data))
+
+        box._raw_data = self.data[:ret]
+        self.assertEqual(box.to_box().body, 'hello')
+        self.assertEqual(box.to_box().pack(), self.data)
+
+    def test_map(self):
+        ret, box = self.parser.parse(buffer(self.data))
+        box._raw_data = self.data[:ret]
+
+        rsp = box.map(dict(ret=-1))
+        self.assertIsInstance(rsp, Box)
+        self.assertEqual((rsp.cmd, rsp.sn, rsp.ret), (3, 7, -1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+import json
+import random
+import unittest
+
+from burst.share.histogram import LatencyHistogram, merge_snapshots
+
+
+class LatencyHistogramTest(unittest.TestCase):
+
+    def test_bucket_count(self):
+        histogram = LatencyHistogram(5, 32)
+        # 前32个桶精确记录，之后每个2的幂区间16个桶
+        self.assertEqual(histogram.bucket_count, 32 + (32 - 5) * 16)
+
+    def test_small_values_exact(self):
+        histogram = LatencyHistogram(5, 32)
+        for value in xrange(32):
+            index = histogram.bucket_index(value)
+            self.assertEqual(index, value)
+            self.assertEqual(histogram._lowest_equivalent_value(index), value)
+            self.assertEqual(histogram._highest_equivalent_value(index), value)
+
+        self.assertEqual(histogram.bucket_index(-1), 0)
+
+    def test_bucket_bounds(self):
+        for precision_bits in (3, 5, 7):
+            histogram = LatencyHistogram(precision_bits, 32)
+            # 桶宽度相对于桶内最小值的比例
+            max_ratio = 1.0 / (1 << (precision_bits - 1))
+
+            last_index = 0
+            for value in range(0, 5000) + [random.randint(0, 2 ** 32 - 1) for _ in xrange(5000)]:
+                index = histogram.bucket_index(value)
+                lowest = histogram._lowest_equivalent_value(index)
+                highest = histogram._highest_equivalent_value(index)
+
+                self.assertTrue(lowest <= value <= highest, (precision_bits, value, lowest, highest))
+                self.assertTrue(highest - lowest <= lowest * max_ratio, (precision_bits, value, lowest, highest))
+
+                if value < 5000:
+                    # 值越大，桶的下标不会变小
+                    self.assertTrue(index >= last_index)
+                    last_index = index
+
+    def test_adjacent_buckets(self):
+        histogram = LatencyHistogram(5, 20)
+        for index in xrange(histogram.bucket_count - 1):
+            self.assertEqual(histogram._highest_equivalent_value(index) + 1,
+                             histogram._lowest_equivalent_value(index + 1))
+
+    def test_record_matches_bucket_index(self):
+        histogram = LatencyHistogram(5, 32)
+        for value in (0, 1, 31, 32, 33, 63, 64, 1000, 123456, 2 ** 31, 2 ** 40):
+            histogram.reset()
+            histogram.record(value)
+            self.assertEqual(histogram.counts[histogram.bucket_index(value)], 1, value)
+
+    def test_max_value_clamped(self):
+        histogram = LatencyHistogram(5, 20)
+        histogram.record(2 ** 30)
+
+        self.assertEqual(histogram.counts[-1], 1)
+        self.assertEqual(histogram.max_value, 2 ** 30)
+        self.assertEqual(histogram.value_at_quantile(1), histogram._highest_equivalent_value(histogram.bucket_count - 1))
+
+    def test_quantile_accuracy(self):
+        histogram = LatencyHistogram(7, 36)
+        values = range(1, 100001)
+        random.shuffle(values)
+        for value in values:
+            histogram.record(value)
+
+        self.assertEqual(histogram.total_count, 100000)
+        self.assertEqual(histogram.min_value, 1)
+        self.assertEqual(histogram.max_value, 100000)
+        self.assertAlmostEqual(histogram.mean(), 50000.5)
+
+        for quantile in (0.01, 0.5, 0.9, 0.99, 0.999):
+            expected = quantile * 100000
+            result = histogram.value_at_quantile(quantile)
+            # 返回桶的上界，相对误差不超过1/64
+            self.assertTrue(expected <= result <= expected * (1 + 1.0 / 64), (quantile, result))
+
+        self.assertEqual(histogram.value_at_quantile(1), 100000)
+
+    def test_quantile_skewed(self):
+        histogram = LatencyHistogram(5, 32)
+        histogram.record(100, 990)
+        histogram.record(100000, 10)
+
+        self.assertEqual(histogram.value_at_quantile(0.5), histogram._highest_equivalent_value(
+            histogram.bucket_index(100)))
+        self.assertEqual(histogram.value_at_quantile(0.999), 100000)
+
+    def test_empty(self):
+        histogram = LatencyHistogram()
+        self.assertEqual(histogram.value_at_quantile(0.99), 0)
+        self.assertEqual(histogram.mean(), 0)
+        self.assertEqual(histogram.quantiles(), dict(count=0, min=0, max=0, mean=0, p50=0, p90=0, p99=0, p999=0))
+
+    def test_quantiles(self):
+        histogram = LatencyHistogram()
+        histogram.record(1000)
+        histogram.record(3000)
+
+        result = histogram.quantiles((0.5, 0.99), scale=1000)
+        self.assertEqual(sorted(result), ['count', 'max', 'mean', 'min', 'p50', 'p99'])
+        self.assertEqual(result['count'], 2)
+        self.assertEqual(result['min'], 1)
+        self.assertEqual(result['max'], 3)
+        self.assertEqual(result['mean'], 2)
+
+    def test_count_below(self):
+        histogram = LatencyHistogram(5, 32)
+        for value in xrange(100):
+            histogram.record(value)
+
+        self.assertEqual(histogram.count_below(10), 10)
+        self.assertEqual(histogram.cumulative_counts([9, 31, 1000]), [10, 32, 100])
+
+    def test_merge(self):
+        histogram = LatencyHistogram(5, 32)
+        other = LatencyHistogram(5, 32)
+        histogram.record(10)
+        other.record(5)
+        other.record(1000)
+        histogram.merge(other)
+
+        self.assertEqual(histogram.total_count, 3)
+        self.assertEqual(histogram.total_value, 1015)
+        self.assertEqual(histogram.min_value, 5)
+        self.assertEqual(histogram.max_value, 1000)
+
+        self.assertRaises(ValueError, histogram.merge, LatencyHistogram(7, 32))
+
+    def test_subtract(self):
+        histogram = LatencyHistogram(5, 32)
+        for value in (10, 20, 3000):
+            histogram.record(value)
+        previous = LatencyHistogram.from_dict(histogram.to_dict())
+        histogram.record(100)
+        histogram.record(200)
+
+        histogram.subtract(previous)
+        self.assertEqual(histogram.total_count, 2)
+        self.assertEqual(histogram.total_value, 300)
+        self.assertEqual(histogram.min_value, histogram._lowest_equivalent_value(histogram.bucket_index(100)))
+        self.assertEqual(histogram.max_value, histogram._highest_equivalent_value(histogram.bucket_index(200)))
+
+        histogram.subtract(histogram)
+        self.assertEqual(histogram.total_count, 0)
+        self.assertIsNone(histogram.min_value)
+
+    def test_snapshot(self):
+        histogram = LatencyHistogram(5, 32)
+        for value in (1, 50, 50, 7000):
+            histogram.record(value)
+
+        # 经过json之后key会变成字符串
+        restored = LatencyHistogram.from_dict(json.loads(json.dumps(histogram.to_dict())))
+        self.assertEqual(list(restored.counts), list(histogram.counts))
+        self.assertEqual(restored.quantiles(), histogram.quantiles())
+
+        merged = merge_snapshots([histogram.to_dict(), histogram.to_dict()])
+        self.assertEqual(merged.total_count, 8)
+        self.assertIsNone(merge_snapshots([]))
+
+    def test_from_counts(self):
+        histogram = LatencyHistogram(5, 32)
+        for value in (100, 200, 300):
+            histogram.record(value)
+
+        restored = LatencyHistogram.from_counts(5, 32, list(histogram.counts), histogram.total_value, 300)
+        self.assertEqual(restored.total_count, 3)
+        self.assertEqual(restored.max_value, 300)
+        # 最小值按桶的下界估算
+        self.assertEqual(restored.min_value, histogram._lowest_equivalent_value(histogram.bucket_index(100)))
+        self.assertEqual(restored.value_at_quantile(0.5), histogram.value_at_quantile(0.5))
+
+        empty = LatencyHistogram.from_counts(5, 32, [0] * histogram.bucket_count, 0, 0)
+        self.assertIsNone(empty.min_value)
+
+
+if __name__ == '__main__':
+    unittest.main()
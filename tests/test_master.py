@@ -0,0 +1,429 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import select
+import signal
+import socket
+import logging
+import threading
+import unittest
+
+from netkit.box import Box
+from netkit.contrib.tcp_client import TcpClient
+
+from burst.burst import Burst
+from burst.share import constants
+from burst.share.log import logger
+from burst.master.master import Master
+from burst.master.forked_process import ForkedProcess, status_to_returncode
+
+
+# 没有连接proxy等情况会打错误日志
+logger.addHandler(logging.NullHandler())
+
+
+class FakeApp(Burst):
+
+    def __init__(self, **kwargs):
+        super(FakeApp, self).__init__()
+        self.config.update(kwargs)
+        self.run_child_callback = None
+
+    def run_child(self, proc_env):
+        if self.run_child_callback:
+            self.run_child_callback(proc_env)
+
+
+class FakeProcess(object):
+
+    returncode = None
+
+    def __init__(self, proc_env):
+        self.proc_env = proc_env
+        self.signals = []
+
+    def send_signal(self, signum):
+        self.signals.append(signum)
+
+
+class FakeMaster(Master):
+    """
+    不真正启动子进程，也不连接proxy
+    """
+
+    def __init__(self, app):
+        super(FakeMaster, self).__init__(app)
+        self.proxy_group_changes = []
+        self.kill_later_processes = []
+        self.worker_processes = []
+
+    def _start_child_process(self, proc_env):
+        return FakeProcess(proc_env)
+
+    def _notify_proxy_group_change(self, group_id, count):
+        self.proxy_group_changes.append((group_id, count))
+        return True
+
+    def _kill_processes_later(self, processes, timeout):
+        self.kill_later_processes.extend(processes)
+
+    def start_workers(self):
+        self.worker_processes = self._spawn_workers()
+
+    def group_processes(self, group_id):
+        return [p for p in self.worker_processes if p and p.proc_env['group_id'] == group_id]
+
+
+def wait_child(pid, timeout=5):
+    """
+    等待子进程退出，超时就杀掉
+    :return: 退出码，超时返回None
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        wpid, status = os.waitpid(pid, os.WNOHANG)
+        if wpid == pid:
+            return status_to_returncode(status)
+        time.sleep(0.01)
+
+    os.kill(pid, 9)
+    os.waitpid(pid, 0)
+    return None
+
+
+class ForkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = FakeApp(PRELOAD_APP=True)
+        self.master = Master(self.app)
+
+        self.log_rfd, log_wfd = os.pipe()
+        self.log_file = os.fdopen(log_wfd, 'w', 0)
+        self.handler = logging.StreamHandler(self.log_file)
+        self.logger = logging.getLogger('burst.tests.master')
+        self.logger.addHandler(self.handler)
+        self.logger.propagate = False
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+        self.handler.close()
+        self.log_file.close()
+        os.close(self.log_rfd)
+
+    def test_fork_while_handler_locked(self):
+        # 其他线程fork时正在打日志
+        locked = threading.Event()
+
+        def hold_handler_lock():
+            self.handler.acquire()
+            locked.set()
+            time.sleep(0.2)
+            self.handler.release()
+
+        t = threading.Thread(target=hold_handler_lock)
+        t.start()
+        locked.wait()
+
+        pid = self.master._fork()
+        if pid == 0:
+            try:
+                self.logger.error('child')
+            finally:
+                os._exit(0)
+
+        t.join()
+        self.assertEqual(wait_child(pid), 0)
+        self.assertEqual(os.read(self.log_rfd, 1024), 'child\n')
+
+        # 父进程的锁也已经释放
+        self.logger.error('parent')
+        self.assertEqual(os.read(self.log_rfd, 1024), 'parent\n')
+
+    def test_child_closes_proxy_client(self):
+        master_sock, proxy_sock = socket.socketpair()
+        self.master.proxy_client = TcpClient(Box)
+        self.master.proxy_client.stream.sock = master_sock
+        self.master._wakeup_rfd, self.master._wakeup_wfd = os.pipe()
+
+        def run_child(proc_env):
+            self.logger.error('closed: %s', self.master.proxy_client.closed())
+
+        self.app.run_child_callback = run_child
+
+        p = self.master._fork_child_process(dict(type=constants.PROC_TYPE_PROXY))
+        self.assertEqual(wait_child(p.pid), 0)
+        self.assertEqual(os.read(self.log_rfd, 1024), 'closed: True\n')
+
+        # 父进程的连接不受影响
+        self.assertFalse(self.master.proxy_client.closed())
+        self.master.proxy_client.write('ping')
+        self.assertEqual(proxy_sock.recv(4), 'ping')
+
+        os.close(self.master._wakeup_rfd)
+        os.close(self.master._wakeup_wfd)
+        self.master.proxy_client.close()
+        proxy_sock.close()
+
+
+class ReapTest(unittest.TestCase):
+
+    signums = (signal.SIGINT, signal.SIGQUIT, signal.SIGTERM, signal.SIGHUP, signal.SIGCHLD, signal.SIGUSR2)
+
+    def setUp(self):
+        self.master = Master(FakeApp())
+
+    def tearDown(self):
+        for pid in self.master.child_processes:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+
+    def fork_child(self, exit_code=0, sleep=0):
+        pid = os.fork()
+        if pid == 0:
+            time.sleep(sleep)
+            os._exit(exit_code)
+
+        p = ForkedProcess(pid, dict(type=constants.PROC_TYPE_WORKER, group_id=1))
+        self.master.child_processes[pid] = p
+        return p
+
+    def test_status_to_returncode(self):
+        exited = self.fork_child(3)
+        killed = self.fork_child(sleep=10)
+        killed.send_signal(signal.SIGKILL)
+
+        reaped = []
+        deadline = time.time() + 5
+        while len(reaped) < 2 and time.time() < deadline:
+            reaped.extend(self.master._reap_child_processes())
+            time.sleep(0.01)
+
+        self.assertEqual(set(reaped), set([exited, killed]))
+        self.assertEqual(exited.returncode, 3)
+        self.assertEqual(killed.returncode, -signal.SIGKILL)
+        self.assertEqual(self.master.child_processes, {})
+
+        # 已经回收的进程不会再发信号
+        killed.send_signal(signal.SIGKILL)
+
+    def test_running_child_not_reaped(self):
+        p = self.fork_child(sleep=10)
+        self.assertEqual(self.master._reap_child_processes(), [])
+        self.assertIsNone(p.returncode)
+
+    def test_sigchld_wakeup(self):
+        old_handlers = [(signum, signal.getsignal(signum)) for signum in self.signums]
+        self.master._init_wakeup_fd()
+        self.master._handle_proc_signals()
+
+        try:
+            p = self.fork_child(sleep=0.1)
+            # 主循环阻塞在wakeup fd上，子进程退出后立即可读
+            while 1:
+                try:
+                    readable = select.select([self.master._wakeup_rfd], [], [], 5)[0]
+                    break
+                except select.error:
+                    # 被SIGCHLD打断，wakeup fd里已经有数据了
+                    continue
+            self.assertEqual(readable, [self.master._wakeup_rfd])
+
+            self.master._wait_wakeup()
+            self.assertEqual(self.master._reap_child_processes(), [p])
+            self.assertEqual(p.returncode, 0)
+        finally:
+            signal.set_wakeup_fd(-1)
+            for signum, handler in old_handlers:
+                signal.signal(signum, handler)
+            os.close(self.master._wakeup_rfd)
+            os.close(self.master._wakeup_wfd)
+
+
+class AutoscaleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = FakeApp(GROUP_CONFIG={
+            1: dict(count=2, max_count=4),
+            2: dict(count=1),
+        })
+        self.master = FakeMaster(self.app)
+        self.master.start_workers()
+
+    def test_scale_up(self):
+        old_processes = self.master.group_processes(1)
+        self.master._autoscale({1: dict(pending=10, busy=2, idle=0), 2: dict(pending=10, busy=1, idle=0)})
+
+        self.assertEqual(self.app.config['GROUP_CONFIG'][1]['count'], 4)
+        self.assertEqual(self.master.proxy_group_changes, [(1, 4)])
+        # 老worker不受影响，其他分组也不受影响
+        self.assertEqual(self.master.group_processes(1)[:2], old_processes)
+        self.assertEqual(len(self.master.group_processes(1)), 4)
+        self.assertEqual(len(self.master.group_processes(2)), 1)
+        self.assertEqual(self.master.reload_status, constants.RELOAD_STATUS_STOPPED)
+
+    def test_scale_down(self):
+        retiring_process = self.master.group_processes(1)[-1]
+        self.master._autoscale({1: dict(pending=0, busy=0, idle=2)})
+
+        self.assertEqual(self.app.config['GROUP_CONFIG'][1]['count'], 1)
+        self.assertEqual(len(self.master.group_processes(1)), 1)
+        self.assertEqual(retiring_process.signals, [signal.SIGUSR1])
+
+    def test_no_scale_during_reload(self):
+        self.master.reload_status = constants.RELOAD_STATUS_PREPARING
+        self.master._autoscale({1: dict(pending=10, busy=2, idle=0)})
+
+        self.assertEqual(self.app.config['GROUP_CONFIG'][1]['count'], 2)
+        self.assertEqual(self.master.proxy_group_changes, [])
+
+    def test_no_scale_when_stopping(self):
+        self.master.enable = False
+        self.master._autoscale({1: dict(pending=10, busy=2, idle=0)})
+
+        self.assertEqual(self.app.config['GROUP_CONFIG'][1]['count'], 2)
+
+
+class ResizeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = FakeApp(STOP_TIMEOUT=10, GROUP_CONFIG={
+            1: dict(count=2),
+            2: dict(count=2),
+        })
+        self.master = FakeMaster(self.app)
+        self.master.start_workers()
+
+    def test_grow(self):
+        old_processes = self.master.worker_processes[:]
+        self.assertTrue(self.master._change_group(1, 4))
+
+        self.assertEqual(self.app.config['GROUP_CONFIG'][1]['count'], 4)
+        self.assertEqual(self.master.proxy_group_changes, [(1, 4)])
+        # 只启动新增的worker
+        self.assertEqual(self.master.worker_processes[:4], old_processes)
+        self.assertEqual(len(self.master.group_processes(1)), 4)
+        self.assertEqual(len(self.master.group_processes(2)), 2)
+        self.assertEqual(self.master.reload_status, constants.RELOAD_STATUS_STOPPED)
+
+    def test_shrink(self):
+        self.master._change_group(1, 4)
+        new_processes = self.master.group_processes(1)[2:]
+
+        self.assertTrue(self.master._change_group(1, 2))
+        self.assertEqual(len(self.master.group_processes(1)), 2)
+
+        # 优先退休新启动的
+        for p in new_processes:
+            self.assertNotIn(p, self.master.worker_processes)
+            self.assertEqual(p.signals, [signal.SIGUSR1])
+        self.assertEqual(self.master.kill_later_processes, new_processes)
+
+        # 退休的worker退出后不会被重新拉起
+        for p in new_processes:
+            self.master._on_child_process_exit(p)
+        self.assertEqual(len(self.master.group_processes(1)), 2)
+
+    def test_shrink_without_stop_timeout(self):
+        self.app.config['STOP_TIMEOUT'] = None
+        self.master._change_group(1, 1)
+        self.assertEqual(self.master.kill_later_processes, [])
+
+    def test_invalid_count(self):
+        self.assertFalse(self.master._change_group(1, '3'))
+        self.assertEqual(len(self.master.group_processes(1)), 2)
+        self.assertEqual(self.master.proxy_group_changes, [])
+
+    def test_change_during_reload(self):
+        self.master.reload_status = constants.RELOAD_STATUS_PREPARING
+        self.assertTrue(self.master._change_group(1, 3))
+
+        # reload结束后才执行
+        self.assertEqual(len(self.master.group_processes(1)), 2)
+        self.assertEqual(self.master.pending_group_changes, {1: 3})
+
+        self.master._on_reload_over()
+        self.assertEqual(len(self.master.group_processes(1)), 3)
+        self.assertEqual(self.master.pending_group_changes, {})
+        self.assertEqual(self.master.proxy_group_changes, [(1, 3)])
+
+
+class RollingReloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = FakeApp(RELOAD_MODE=constants.RELOAD_MODE_ROLLING, STOP_TIMEOUT=10, GROUP_CONFIG={
+            1: dict(count=3),
+            2: dict(count=1),
+        })
+        self.master = FakeMaster(self.app)
+        self.master.start_workers()
+
+    def retiring_processes(self, group_id):
+        return [p for p in self.master.rolling_retiring_processes if p.proc_env['group_id'] == group_id]
+
+    def test_rolling_reload(self):
+        old_processes = self.master.group_processes(1)
+        self.assertTrue(self.master._reload_workers())
+        self.assertEqual(self.master.reload_status, constants.RELOAD_STATUS_ROLLING)
+
+        for it in xrange(3):
+            # 每个分组每次只替换一个，worker总数不变
+            retiring_processes = self.retiring_processes(1)
+            self.assertEqual(retiring_processes, [old_processes[it]])
+            self.assertEqual(retiring_processes[0].signals, [signal.SIGUSR1])
+            self.assertEqual(len(self.master.group_processes(1)), 3)
+            self.assertEqual(len([p for p in self.master.group_processes(1) if p in old_processes]), 2 - it)
+
+            self.master._on_child_process_exit(retiring_processes[0])
+
+        # 分组2的老worker还没有退出
+        self.assertEqual(self.master.reload_status, constants.RELOAD_STATUS_ROLLING)
+        self.master._on_child_process_exit(self.retiring_processes(2)[0])
+
+        self.assertEqual(self.master.reload_status, constants.RELOAD_STATUS_STOPPED)
+        self.assertEqual(len(self.master.group_processes(1)), 3)
+        self.assertEqual(len(self.master.group_processes(2)), 1)
+        self.assertEqual(len(self.master.kill_later_processes), 4)
+
+    def test_batch_size(self):
+        self.app.config['RELOAD_ROLLING_BATCH_SIZE'] = 2
+        self.master._reload_workers()
+
+        self.assertEqual(len(self.retiring_processes(1)), 2)
+        self.assertEqual(len(self.retiring_processes(2)), 1)
+
+    def test_reload_once(self):
+        self.master._reload_workers()
+        self.assertFalse(self.master._reload_workers())
+
+    def test_old_worker_exit_during_reload(self):
+        old_processes = self.master.group_processes(1)
+        self.master._reload_workers()
+
+        # 还没有轮到的老worker异常退出，被重新拉起后就不需要再替换
+        self.master._on_child_process_exit(old_processes[2])
+        self.assertNotIn(old_processes[2], self.master.worker_processes)
+
+        self.master._on_child_process_exit(old_processes[0])
+        self.assertEqual(self.retiring_processes(1), [old_processes[1]])
+
+        self.master._on_child_process_exit(old_processes[1])
+        self.assertEqual(self.retiring_processes(1), [])
+        self.assertEqual(len(self.master.group_processes(1)), 3)
+
+    def test_group_change_after_reload(self):
+        self.master._reload_workers()
+        self.master._change_group(1, 4)
+        self.assertEqual(self.master.pending_group_changes, {1: 4})
+
+        for p in self.master.rolling_retiring_processes[:]:
+            self.master._on_child_process_exit(p)
+        while self.master.rolling_retiring_processes:
+            self.master._on_child_process_exit(self.master.rolling_retiring_processes[0])
+
+        self.assertEqual(self.master.reload_status, constants.RELOAD_STATUS_STOPPED)
+        self.assertEqual(len(self.master.group_processes(1)), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from netkit.box import Box
+from twisted.internet.error import ConnectionDone
+from twisted.internet.task import Clock, Cooperator
+from twisted.python.failure import Failure
+from twisted.web.test.requesthelper import DummyRequest
+
+from burst.share import constants
+from burst.share.shared_stat import SharedStat, StatSlot
+from burst.proxy.stat_counter import StatCounter
+from burst.proxy.task_dispatcher import TaskDispatcher
+from burst.proxy.connection import metrics_connection
+from burst.proxy.connection.metrics_connection import MetricsResource, format_labels
+
+
+class FakeApp(object):
+
+    box_class = Box
+
+    def __init__(self, **kwargs):
+        self.config = dict(constants.DEFAULT_CONFIG)
+        self.config.update(kwargs)
+
+
+class FakeProxy(object):
+
+    def __init__(self, **kwargs):
+        self.app = FakeApp(**kwargs)
+        self.stat_counter = StatCounter(self.app.config['TASKS_TIME_BENCHMARK'])
+        self.task_dispatcher = TaskDispatcher(self)
+
+
+def parse_samples(text):
+    """
+    :return: {sample_name + labels: value}
+    """
+    samples = dict()
+    for line in text.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        key, value = line.rsplit(' ', 1)
+        samples[key] = value
+    return samples
+
+
+class FormatTest(unittest.TestCase):
+
+    def test_format_labels(self):
+        self.assertEqual(format_labels(()), '')
+        self.assertEqual(format_labels((('group', 1), ('kind', 'queue'))), '{group="1",kind="queue"}')
+
+    def test_escape(self):
+        self.assertEqual(format_labels((('cmd', 'a"b\\c\nd'),)), '{cmd="a\\"b\\\\c\\nd"}')
+
+
+class MetricsResourceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.proxy = FakeProxy(GROUP_CONFIG={1: dict(count=2), 2: dict(count=1)},
+                               METRICS_BUCKETS=(0.01, 0.001))
+        self.resource = MetricsResource(self.proxy)
+
+        # 让reactor的调度由测试控制，每次只执行一步
+        self.clock = Clock()
+        self.cooperator = Cooperator(terminationPredicateFactory=lambda: lambda: True,
+                                     scheduler=lambda func: self.clock.callLater(1, func))
+        self._cooperate = metrics_connection.cooperate
+        metrics_connection.cooperate = self.cooperator.cooperate
+
+    def tearDown(self):
+        metrics_connection.cooperate = self._cooperate
+
+    def render(self, max_steps=10000):
+        request = DummyRequest([''])
+        self.resource.render(request)
+
+        for _ in xrange(max_steps):
+            if request.finished:
+                break
+            self.clock.advance(1)
+
+        return request
+
+    def test_render(self):
+        stat_counter = self.proxy.stat_counter
+        stat_counter.add_worker_req(1)
+        stat_counter.add_rejected_task(2, 'lane_full')
+        stat_counter.add_cmd_req(10)
+        stat_counter.add_task_time(1, 10, 0.0005, 0.005)
+        stat_counter.add_task_time(1, 10, 0.0005, 0.05)
+
+        request = self.render()
+        self.assertEqual(request.finished, 1)
+        self.assertEqual(request.responseHeaders.getRawHeaders('Content-Type'), [metrics_connection.CONTENT_TYPE])
+
+        text = ''.join(request.written)
+        self.assertTrue(text.endswith('# EOF\n'))
+        self.assertIn('# TYPE burst_worker_requests counter', text)
+
+        samples = parse_samples(text)
+        self.assertEqual(samples['burst_worker_requests_total{group="1"}'], '1')
+        self.assertEqual(samples['burst_rejected_tasks_total{group="2",reason="lane_full"}'], '1')
+        self.assertEqual(samples['burst_cmd_requests_total{cmd="10"}'], '1')
+        self.assertEqual(samples['burst_workers{group="1"}'], '2')
+
+        # 桶按从小到大输出，计数是累加的
+        labels = 'group="1",kind="service"'
+        self.assertEqual(samples['burst_task_seconds_bucket{%s,le="0.001"}' % labels], '0')
+        self.assertEqual(samples['burst_task_seconds_bucket{%s,le="0.01"}' % labels], '1')
+        self.assertEqual(samples['burst_task_seconds_bucket{%s,le="+Inf"}' % labels], '2')
+        self.assertEqual(samples['burst_task_seconds_count{%s}' % labels], '2')
+        self.assertAlmostEqual(float(samples['burst_task_seconds_sum{%s}' % labels]), 0.055, places=2)
+        self.assertIn('burst_cmd_task_seconds_count{cmd="10",kind="total"}', samples)
+
+    def test_write_in_batches(self):
+        self.resource.write_lines_count = 10
+        for cmd in xrange(20):
+            self.proxy.stat_counter.add_cmd_req(cmd)
+
+        request = self.render()
+        self.assertEqual(request.finished, 1)
+        self.assertGreater(len(request.written), 1)
+        self.assertEqual(len([key for key in parse_samples(''.join(request.written))
+                              if key.startswith('burst_cmd_requests_total')]), 20)
+
+    def test_worker_stat(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            shared_stat = SharedStat.create(os.path.join(tmp_dir, 'stat'), 20, ['a'], ['hits'])
+            self.proxy.stat_counter.shared_stat = SharedStat.open(shared_stat.path)
+
+            for slot in xrange(20):
+                StatSlot(shared_stat, slot, 100 + slot, 1).add_request('a', 0.001)
+            StatSlot(shared_stat, 0, 100, 1).incr('hits', 3)
+
+            request = self.render()
+            samples = parse_samples(''.join(request.written))
+            self.assertEqual(samples['burst_endpoint_requests_total{endpoint="a"}'], '20')
+            self.assertEqual(samples['burst_worker_counter_total{name="hits"}'], '3')
+            self.assertEqual(samples['burst_endpoint_seconds_count{endpoint="a"}'], '20')
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_request_lost(self):
+        self.resource.write_lines_count = 1
+        request = DummyRequest([''])
+        self.resource.render(request)
+        self.clock.advance(1)
+
+        request.processingFailed(Failure(ConnectionDone()))
+        written_count = len(request.written)
+        for _ in xrange(100):
+            self.clock.advance(1)
+
+        # 不会继续生成，也不会再调用finish
+        self.assertEqual(len(request.written), written_count)
+        self.assertEqual(request.finished, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import shutil
+import logging
+import tempfile
+import threading
+import unittest
+
+from burst.burst import Burst
+from burst.share import profiler
+from burst.share.log import logger
+from burst.master.master import Master
+from burst.worker.worker import Worker
+
+
+# 没有连接proxy等情况会打错误日志
+logger.addHandler(logging.NullHandler())
+
+
+def busy_loop(stop_event):
+    while not stop_event.is_set():
+        pass
+
+
+class ProfilerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_collapse_stack(self):
+        def inner():
+            return profiler.collapse_stack(sys._getframe())
+
+        def outer():
+            return inner()
+
+        names = outer().split(';')
+        # 最外层在前
+        self.assertTrue(names[-1].startswith('inner ('))
+        self.assertTrue(names[-2].startswith('outer ('))
+        self.assertIn('test_collapse_stack (', names[-3])
+        self.assertIn(__file__.rstrip('c'), names[-1])
+
+    def test_json_file(self):
+        path = profiler.result_path(self.tmp_dir, 100, 1)
+        profiler.write_json_file(path, dict(samples=1))
+        self.assertEqual(os.listdir(self.tmp_dir), [os.path.basename(path)])
+
+        self.assertEqual(profiler.read_json_file(path, remove=False), dict(samples=1))
+        self.assertEqual(profiler.read_json_file(path), dict(samples=1))
+        self.assertIsNone(profiler.read_json_file(path))
+
+    def test_sampler(self):
+        stop_event = threading.Event()
+        t = threading.Thread(target=busy_loop, args=(stop_event,))
+        t.start()
+
+        done = threading.Event()
+        sampler = profiler.StackSampler(t.ident, 0.001, 0.1)
+        try:
+            sampler.start(lambda _: done.set())
+            done.wait(5)
+        finally:
+            stop_event.set()
+            t.join()
+
+        self.assertTrue(done.is_set())
+        self.assertFalse(sampler.running)
+        self.assertGreater(sampler.samples, 0)
+        self.assertEqual(sum(sampler.stack_counter.values()), sampler.samples)
+        for stack in sampler.stack_counter:
+            self.assertIn(';busy_loop (', stack)
+
+    def test_sampler_stop(self):
+        done = threading.Event()
+        sampler = profiler.StackSampler(threading.current_thread().ident, 0.01, 100)
+        sampler.start(lambda _: done.set())
+        sampler.stop()
+
+        self.assertTrue(done.wait(5))
+        self.assertFalse(sampler.running)
+
+
+class WorkerProfileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        app = Burst()
+        app.config.update(IPC_ADDRESS_DIRECTORY=self.tmp_dir)
+        self.worker = Worker(app, 1)
+        self.worker._main_thread_ident = threading.current_thread().ident
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_profile(self):
+        pid = os.getpid()
+        profiler.write_json_file(profiler.request_path(self.tmp_dir, pid),
+                                 dict(profile_id=3, seconds=0.05, interval=0.001))
+        self.worker._start_profile()
+        # 请求文件读取之后就删除了
+        self.assertFalse(os.path.exists(profiler.request_path(self.tmp_dir, pid)))
+
+        path = profiler.result_path(self.tmp_dir, pid, 3)
+        deadline = time.time() + 5
+        while not os.path.exists(path) and time.time() < deadline:
+            time.sleep(0.01)
+
+        result = profiler.read_json_file(path)
+        self.assertGreater(result['samples'], 0)
+        self.assertEqual(sum(result['stacks'].values()), result['samples'])
+
+    def test_no_request(self):
+        self.worker._start_profile()
+        self.assertIsNone(self.worker.stack_sampler)
+
+
+class MasterCollectTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        app = Burst()
+        app.config.update(IPC_ADDRESS_DIRECTORY=self.tmp_dir, PROFILE_COLLECT_TIMEOUT=0.2)
+        self.master = Master(app)
+        self.master._wakeup_rfd, self.master._wakeup_wfd = os.pipe()
+
+    def tearDown(self):
+        os.close(self.master._wakeup_rfd)
+        os.close(self.master._wakeup_wfd)
+        shutil.rmtree(self.tmp_dir)
+
+    def collect(self, pids):
+        self.master._collect_profile(dict(profile_id=1, seconds=0), pids)
+
+        func, args = self.master._main_loop_calls.popleft()
+        self.assertEqual(func, self.master._send_profile_result)
+        return args[0]
+
+    def test_merge(self):
+        profiler.write_json_file(profiler.result_path(self.tmp_dir, 100, 1),
+                                 dict(samples=3, stacks={'a;b': 2, 'a;c': 1}))
+        profiler.write_json_file(profiler.result_path(self.tmp_dir, 101, 1),
+                                 dict(samples=2, stacks={'a;b': 2}))
+
+        result = self.collect([100, 101])
+        self.assertEqual(result, dict(
+            profile_id=1,
+            workers=2,
+            profiled_workers=2,
+            samples=5,
+            stacks={'a;b': 4, 'a;c': 1},
+        ))
+        # 结果文件收集之后就删除了
+        self.assertEqual(os.listdir(self.tmp_dir), [])
+
+    def test_worker_not_respond(self):
+        profiler.write_json_file(profiler.result_path(self.tmp_dir, 100, 1),
+                                 dict(samples=1, stacks={'a': 1}))
+        # 101没有收到信号，请求文件还在
+        profiler.write_json_file(profiler.request_path(self.tmp_dir, 101), dict(profile_id=1))
+
+        result = self.collect([100, 101])
+        self.assertEqual(result['workers'], 2)
+        self.assertEqual(result['profiled_workers'], 1)
+        self.assertEqual(result['stacks'], {'a': 1})
+        self.assertEqual(os.listdir(self.tmp_dir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
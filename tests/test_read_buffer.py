@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from burst.proxy.read_buffer import ReadBuffer
+
+
+class ReadBufferTest(unittest.TestCase):
+
+    def test_read(self):
+        read_buffer = ReadBuffer()
+        read_buffer.append('hello')
+        read_buffer.append(' world')
+
+        self.assertEqual(len(read_buffer), 11)
+        self.assertEqual(read_buffer.read(5), 'hello')
+        self.assertEqual(str(read_buffer.view()), ' world')
+        self.assertEqual(len(read_buffer), 6)
+
+        read_buffer.skip(1)
+        self.assertEqual(read_buffer.read(5), 'world')
+        self.assertEqual(len(read_buffer), 0)
+        self.assertFalse(read_buffer)
+
+    def test_read_all_clears(self):
+        read_buffer = ReadBuffer()
+        read_buffer.append('abc')
+        read_buffer.read(3)
+
+        self.assertEqual(len(read_buffer._data), 0)
+        self.assertEqual(read_buffer._offset, 0)
+
+    def test_view_no_copy(self):
+        read_buffer = ReadBuffer()
+        read_buffer.append('abcdef')
+        read_buffer.skip(2)
+
+        view = read_buffer.view()
+        self.assertIsInstance(view, buffer)
+        self.assertEqual(view[:2], 'cd')
+
+    def test_compact(self):
+        read_buffer = ReadBuffer()
+        read_buffer.compact_threshold = 8
+        read_buffer.append('a' * 10 + 'b' * 10)
+
+        # 已读取部分没有超过一半，不移动数据
+        read_buffer.skip(9)
+        self.assertEqual(read_buffer._offset, 9)
+        self.assertEqual(len(read_buffer._data), 20)
+
+        read_buffer.skip(1)
+        self.assertEqual(read_buffer._offset, 0)
+        self.assertEqual(str(read_buffer._data), 'b' * 10)
+        self.assertEqual(read_buffer.read(10), 'b' * 10)
+
+    def test_compact_threshold(self):
+        read_buffer = ReadBuffer()
+        read_buffer.append('a' * 100)
+
+        # 没有达到compact_threshold，即使超过一半也不移动数据
+        read_buffer.skip(90)
+        self.assertEqual(read_buffer._offset, 90)
+        self.assertEqual(str(read_buffer.view()), 'a' * 10)
+
+    def test_append_after_compact(self):
+        read_buffer = ReadBuffer()
+        read_buffer.compact_threshold = 4
+        read_buffer.append('0123456789')
+        read_buffer.skip(6)
+        read_buffer.append('abc')
+
+        self.assertEqual(str(read_buffer.view()), '6789abc')
+
+    def test_clear(self):
+        read_buffer = ReadBuffer()
+        read_buffer.append('abc')
+        read_buffer.skip(1)
+        read_buffer.clear()
+
+        self.assertEqual(len(read_buffer), 0)
+        self.assertEqual(str(read_buffer.view()), '')
+
+
+if __name__ == '__main__':
+    unittest.main()
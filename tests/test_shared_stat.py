@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from burst.share.constants import STAT_KEY_OTHER
+from burst.share.histogram import LatencyHistogram
+from burst.share.shared_stat import SharedStat, StatSlot, StatAggregator
+
+
+class SharedStatTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.shared_stat = SharedStat.create(os.path.join(self.tmp_dir, 'stat'), 4, ['a', 'b'], ['hits'])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_open(self):
+        shared_stat = SharedStat.open(self.shared_stat.path)
+
+        self.assertEqual(shared_stat.endpoints, ['a', 'b'])
+        self.assertEqual(shared_stat.counters, ['hits'])
+        self.assertEqual(shared_stat.slot_size, self.shared_stat.slot_size)
+
+    def test_aggregate(self):
+        slot0 = StatSlot(self.shared_stat, 0, 100, 1)
+        slot1 = StatSlot(self.shared_stat, 1, 101, 1)
+        slot0.add_request('a', 0.001)
+        slot0.add_request('a', 0.003, exc=True)
+        slot1.add_request('a', 0.002)
+        slot1.add_request('unknown', 0.5)
+        slot1.incr('hits', 3)
+        self.assertFalse(slot1.incr('not_configured'))
+
+        result = self.shared_stat.aggregate()
+        self.assertEqual(result['endpoint_req'], {'a': 3, STAT_KEY_OTHER: 1})
+        self.assertEqual(result['endpoint_exc'], {'a': 1})
+        self.assertEqual(result['counters'], {'hits': 3})
+
+        histogram = result['endpoint_time_hist']['a']
+        self.assertEqual(histogram.total_count, 3)
+        self.assertEqual(histogram.total_value, 6000)
+        self.assertEqual(histogram.max_value, 3000)
+
+    def test_incremental(self):
+        slot0 = StatSlot(self.shared_stat, 0, 100, 1)
+        slot1 = StatSlot(self.shared_stat, 1, 101, 1)
+        slot0.add_request('a', 0.001)
+        slot1.incr('hits')
+        self.shared_stat.aggregate()
+
+        slot0.add_request('a', 0.01)
+        slot0.add_request('b', 0.02)
+        slot1.incr('hits', 2)
+        result = self.shared_stat.aggregate()
+
+        self.assertEqual(result['endpoint_req'], {'a': 2, 'b': 1})
+        self.assertEqual(result['counters'], {'hits': 3})
+        self.assertEqual(result['endpoint_time_hist']['a'].total_value, 11000)
+
+        # 结果和从头汇总的一致
+        fresh = StatAggregator(self.shared_stat)
+        fresh.update()
+        fresh_result = fresh.result()
+        self.assertEqual(fresh_result['endpoint_req'], result['endpoint_req'])
+        for endpoint, histogram in result['endpoint_time_hist'].items():
+            self.assertEqual(list(fresh_result['endpoint_time_hist'][endpoint].counts), list(histogram.counts))
+
+    def test_skip_unchanged_slot(self):
+        slot0 = StatSlot(self.shared_stat, 0, 100, 1)
+        slot0.add_request('a', 0.001)
+        aggregator = StatAggregator(self.shared_stat)
+        aggregator.update()
+
+        # 不通过StatSlot写入，序号不变，不会被读到
+        values = self.shared_stat.slot_values(0)
+        values[self.shared_stat.endpoint_offset('a')] += 10
+        aggregator.update()
+        self.assertEqual(aggregator.result()['endpoint_req'], {'a': 1})
+
+        slot0.add_request('b', 0.001)
+        aggregator.update()
+        self.assertEqual(aggregator.result()['endpoint_req'], {'a': 11, 'b': 1})
+
+    def test_slot_reuse(self):
+        StatSlot(self.shared_stat, 0, 100, 1).add_request('a', 0.001)
+        self.shared_stat.aggregate()
+
+        # 新的worker复用slot，计数接着累加
+        StatSlot(self.shared_stat, 0, 200, 1).add_request('a', 0.001)
+        self.assertEqual(self.shared_stat.aggregate()['endpoint_req'], {'a': 2})
+
+    def test_iter_update(self):
+        for slot in xrange(4):
+            StatSlot(self.shared_stat, slot, 100 + slot, 1).add_request('a', 0.001)
+
+        aggregator = StatAggregator(self.shared_stat)
+        self.assertEqual(list(aggregator.iter_update(2)), [1, 3])
+        self.assertEqual(aggregator.result()['endpoint_req'], {'a': 4})
+        self.assertEqual(self.shared_stat.aggregate(update=False)['endpoint_req'], {})
+
+    def test_result_is_copy(self):
+        slot0 = StatSlot(self.shared_stat, 0, 100, 1)
+        slot0.add_request('a', 0.001)
+        histogram = self.shared_stat.aggregate()['endpoint_time_hist']['a']
+
+        slot0.add_request('a', 0.001)
+        self.shared_stat.aggregate()
+        self.assertIsInstance(histogram, LatencyHistogram)
+        self.assertEqual(histogram.total_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
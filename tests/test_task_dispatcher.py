@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import unittest
+
+from netkit.box import Box
+from twisted.internet.task import Clock
+
+from burst.share import constants
+from burst.share.task import Task
+from burst.share.log import logger
+from burst.proxy.stat_counter import StatCounter
+from burst.proxy.task_container import TaskContainer
+from burst.proxy import task_dispatcher
+from burst.proxy.task_dispatcher import TaskDispatcher
+
+
+# 通道满了等情况会打错误日志
+logger.addHandler(logging.NullHandler())
+
+
+class FakeApp(object):
+
+    box_class = Box
+
+    def __init__(self, **kwargs):
+        self.config = dict(constants.DEFAULT_CONFIG)
+        self.config.update(kwargs)
+
+
+class FakeProxy(object):
+
+    def __init__(self, **kwargs):
+        self.app = FakeApp(**kwargs)
+        self.stat_counter = StatCounter(self.app.config['TASKS_TIME_BENCHMARK'])
+
+
+class FakeClient(object):
+
+    connected = True
+
+    def __init__(self):
+        self.queued_tasks = set()
+        self.rejected = []
+
+    def reject(self, box, group_id, reason):
+        self.rejected.append(reason)
+
+
+class FakeWorker(object):
+    """
+    与 WorkerConnection 一样申请和完成任务
+    """
+
+    status = None
+    retiring = False
+
+    def __init__(self, task_dispatcher, group_id, prefetch=1):
+        self.task_dispatcher = task_dispatcher
+        self.group_id = group_id
+        self.prefetch = prefetch
+        self.doing = []
+
+    @property
+    def doing_task_count(self):
+        return len(self.doing)
+
+    def connect(self):
+        self.alloc_task()
+        return self
+
+    def alloc_task(self):
+        count = 0
+        while len(self.doing) < self.prefetch:
+            task_container = self.task_dispatcher.alloc_task(self)
+            if not task_container:
+                break
+            self._assign_task(task_container)
+            count += 1
+        return count
+
+    def _assign_task(self, task_container):
+        self.doing.append(task_container)
+        self.task_dispatcher.update_prefetch_worker(self)
+
+    def finish(self, index=0):
+        task_container = self.doing.pop(index)
+        self.task_dispatcher.update_prefetch_worker(self)
+        self.alloc_task()
+        return task_container
+
+
+class TaskDispatcherTestCase(unittest.TestCase):
+
+    group_config = {1: dict(count=2)}
+    config = dict()
+
+    def setUp(self):
+        config = dict(GROUP_CONFIG=self.group_config)
+        config.update(self.config)
+        self.proxy = FakeProxy(**config)
+        self.task_dispatcher = self.proxy.task_dispatcher = TaskDispatcher(self.proxy)
+        # 任务只保存客户端连接的弱引用
+        self.client = FakeClient()
+
+    def make_task(self, name=None, client=None, lane=0, affinity_key=None):
+        task_container = TaskContainer(Task(dict(cmd=constants.CMD_WORKER_TASK_ASSIGN)), client or self.client)
+        task_container.name = name
+        task_container.lane = lane
+        task_container.affinity_key = affinity_key
+        return task_container
+
+    def add_workers(self, group_id, count, prefetch=1):
+        return [FakeWorker(self.task_dispatcher, group_id, prefetch).connect() for _ in xrange(count)]
+
+
+class PrefetchTest(TaskDispatcherTestCase):
+
+    group_config = {1: dict(count=2, prefetch=2)}
+
+    def test_fill_busy_workers_before_queue(self):
+        workers = self.add_workers(1, 2, prefetch=2)
+        for index in xrange(4):
+            self.assertTrue(self.task_dispatcher.add_task(1, self.make_task(name=index)))
+
+        self.assertEqual(sorted(worker.doing_task_count for worker in workers), [2, 2])
+        self.assertTrue(self.task_dispatcher.group_queue.empty(1))
+        self.assertFalse(self.task_dispatcher.prefetch_workers_dict[1])
+
+        # 都满了才排队
+        self.task_dispatcher.add_task(1, self.make_task(name=4))
+        self.assertEqual(self.task_dispatcher.group_queue.qsize(1), 1)
+
+        workers[0].finish()
+        self.assertEqual(workers[0].doing[-1].name, 4)
+        self.assertTrue(self.task_dispatcher.group_queue.empty(1))
+
+    def test_prefetch_workers(self):
+        worker = self.add_workers(1, 1, prefetch=2)[0]
+        self.task_dispatcher.add_task(1, self.make_task())
+        self.assertEqual(self.task_dispatcher.prefetch_workers_dict[1], set([worker]))
+
+        self.task_dispatcher.add_task(1, self.make_task())
+        self.assertEqual(self.task_dispatcher.prefetch_workers_dict[1], set())
+
+        worker.finish()
+        self.assertEqual(self.task_dispatcher.prefetch_workers_dict[1], set([worker]))
+
+        # 全部完成后变成空闲
+        worker.finish()
+        self.assertEqual(worker.status, constants.WORKER_STATUS_IDLE)
+        self.assertEqual(self.task_dispatcher.prefetch_workers_dict[1], set())
+
+    def test_removed_worker(self):
+        worker = self.add_workers(1, 1, prefetch=2)[0]
+        self.task_dispatcher.add_task(1, self.make_task())
+        self.task_dispatcher.remove_worker(worker)
+
+        self.assertEqual(self.task_dispatcher.prefetch_workers_dict[1], set())
+        worker.doing.pop()
+        self.task_dispatcher.update_prefetch_worker(worker)
+        self.assertEqual(self.task_dispatcher.prefetch_workers_dict[1], set())
+
+    def test_no_jump_over_queue(self):
+        worker = self.add_workers(1, 1, prefetch=2)[0]
+        self.task_dispatcher.add_task(1, self.make_task(name='first'))
+        self.task_dispatcher._put_task(1, self.make_task(name='queued'))
+
+        # 队列里还有任务，新任务排在后面
+        self.task_dispatcher.add_task(1, self.make_task(name='new'))
+        self.assertEqual([task.name for task in worker.doing], ['first'])
+        self.assertEqual([task.name for task in self.task_dispatcher.group_queue.drain(1)], ['queued', 'new'])
+
+
+class AffinityTest(TaskDispatcherTestCase):
+
+    group_config = {1: dict(count=2, affinity_wait=1)}
+
+    def setUp(self):
+        super(AffinityTest, self).setUp()
+        # 等待超时由测试控制
+        self.clock = Clock()
+        self._reactor = task_dispatcher.reactor
+        task_dispatcher.reactor = self.clock
+
+        self.workers = self.add_workers(1, 2)
+        self.target = self.task_dispatcher._get_affinity_worker(1, 'a')
+        self.other = [worker for worker in self.workers if worker is not self.target][0]
+
+    def tearDown(self):
+        task_dispatcher.reactor = self._reactor
+
+    def add_waiting_task(self, name):
+        """
+        让目标worker正忙，任务等待它
+        """
+        if not self.target.doing:
+            self.task_dispatcher.add_task(1, self.make_task(name='busy', affinity_key='a'))
+
+        task_container = self.make_task(name=name, affinity_key='a')
+        self.assertTrue(self.task_dispatcher.add_task(1, task_container))
+        self.assertIs(task_container.affinity_worker, self.target)
+        return task_container
+
+    def test_hit(self):
+        for name in ('a1', 'a2'):
+            self.task_dispatcher.add_task(1, self.make_task(name=name, affinity_key='a'))
+            self.target.finish()
+
+        self.assertEqual(self.proxy.stat_counter.affinity_hit_counter[1], 2)
+        self.assertEqual(self.other.doing, [])
+
+    def test_wait(self):
+        self.add_waiting_task('wait')
+        # 另一个worker空闲也不给它
+        self.assertEqual(self.other.doing, [])
+        self.assertEqual(self.task_dispatcher.get_group_load(1)['pending'], 1)
+
+        self.target.finish()
+        self.assertEqual([task.name for task in self.target.doing], ['wait'])
+        self.assertEqual(self.task_dispatcher.get_group_load(1)['pending'], 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_timeout(self):
+        task_container = self.add_waiting_task('wait')
+        task_container.enqueue_time -= 1
+        self.clock.advance(1)
+
+        self.assertEqual([task.name for task in self.other.doing], ['wait'])
+        self.assertIsNone(task_container.affinity_worker)
+        self.assertEqual(self.proxy.stat_counter.affinity_miss_counter[1], 1)
+        self.assertEqual(self.task_dispatcher.affinity_tasks_dict, {})
+
+    def test_timeout_in_order(self):
+        first = self.add_waiting_task('first')
+        self.add_waiting_task('second')
+        first.enqueue_time -= 1
+        self.clock.advance(1)
+
+        # 后面的还没超时，继续等待
+        self.assertEqual([task.name for task in self.other.doing], ['first'])
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+        self.target.finish()
+        self.assertEqual([task.name for task in self.target.doing], ['second'])
+
+    def test_cancel(self):
+        first = self.add_waiting_task('first')
+        second = self.add_waiting_task('second')
+
+        self.task_dispatcher.cancel_tasks([first])
+        self.assertIsNone(first.affinity_worker)
+        self.assertEqual(self.task_dispatcher.get_group_load(1)['pending'], 1)
+        self.assertEqual(self.proxy.stat_counter.disconnected_tasks_counter[1], 1)
+
+        self.target.finish()
+        self.assertEqual([task.name for task in self.target.doing], ['second'])
+
+        # 都取消后，不用再等超时
+        third = self.add_waiting_task('third')
+        self.task_dispatcher.cancel_tasks([third])
+        self.assertEqual(self.task_dispatcher.affinity_tasks_dict, {})
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertIsNone(second.affinity_worker)
+
+    def test_no_jump_over_queue(self):
+        self.target.prefetch = 2
+        self.task_dispatcher.add_task(1, self.make_task(name='first', affinity_key='a'))
+        self.task_dispatcher._put_task(1, self.make_task(name='queued'))
+
+        # 队列里还有任务时，没达到prefetch也要等
+        task_container = self.make_task(name='new', affinity_key='a')
+        self.task_dispatcher.add_task(1, task_container)
+        self.assertEqual([task.name for task in self.target.doing], ['first'])
+        self.assertIs(task_container.affinity_worker, self.target)
+
+    def test_lane_full(self):
+        self.task_dispatcher.group_queue.lane_configs[0]['max_size'] = 1
+        self.add_waiting_task('wait')
+
+        # 等待的任务也占通道的位置，按普通任务分配
+        task_container = self.make_task(name='full', affinity_key='a')
+        self.assertTrue(self.task_dispatcher.add_task(1, task_container))
+        self.assertIsNone(task_container.affinity_worker)
+        self.assertEqual([task.name for task in self.other.doing], ['full'])
+
+        # 排不上时被拒绝
+        self.assertFalse(self.task_dispatcher.add_task(1, self.make_task(affinity_key='a')))
+
+    def test_flush(self):
+        self.add_waiting_task('wait')
+        self.task_dispatcher.remove_worker(self.target)
+
+        self.assertEqual([task.name for task in self.other.doing], ['wait'])
+        self.assertEqual(self.task_dispatcher.affinity_tasks_dict, {})
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+class SpilloverTest(TaskDispatcherTestCase):
+
+    group_config = {
+        1: dict(count=1),
+        2: dict(count=1, spillover_groups=(1,)),
+        3: dict(count=1, spillover_groups=(1,), spillover_min_pending=2),
+    }
+
+    def setUp(self):
+        super(SpilloverTest, self).setUp()
+        self.lender = self.add_workers(1, 1)[0]
+        self.borrower = self.add_workers(2, 1)[0]
+        self.add_workers(3, 1)
+
+        # 先让出借的worker忙起来
+        self.task_dispatcher.add_task(1, self.make_task(name='own'))
+        self.task_dispatcher.add_task(2, self.make_task(name='busy'))
+        self.task_dispatcher.add_task(3, self.make_task(name='busy'))
+
+    def test_borrowers(self):
+        self.assertEqual(sorted(self.task_dispatcher.spillover_borrowers_dict[1]), [(2, 1), (3, 2)])
+        self.assertNotIn(2, self.task_dispatcher.spillover_borrowers_dict)
+
+    def test_help_when_idle(self):
+        self.task_dispatcher.add_task(2, self.make_task(name='borrowed'))
+        self.lender.finish()
+
+        self.assertEqual([task.name for task in self.lender.doing], ['borrowed'])
+        self.assertTrue(self.task_dispatcher.group_queue.empty(2))
+
+    def test_borrow_idle_worker(self):
+        self.lender.finish()
+        self.assertEqual(self.lender.status, constants.WORKER_STATUS_IDLE)
+
+        # 有空闲的worker可以借用，不用排队
+        self.task_dispatcher.add_task(2, self.make_task(name='borrowed'))
+        self.assertEqual([task.name for task in self.lender.doing], ['borrowed'])
+
+    def test_min_pending(self):
+        self.task_dispatcher.add_task(3, self.make_task(name=0))
+        self.lender.finish()
+        self.assertEqual(self.lender.doing, [])
+
+        self.task_dispatcher.add_task(3, self.make_task(name=1))
+        self.assertEqual([task.name for task in self.lender.doing], [0])
+
+    def test_most_pending_first(self):
+        self.task_dispatcher.add_task(2, self.make_task(name=2))
+        for _ in xrange(3):
+            self.task_dispatcher.add_task(3, self.make_task(name=3))
+
+        self.lender.finish()
+        self.assertEqual([task.name for task in self.lender.doing], [3])
+
+    def test_no_borrowers(self):
+        self.task_dispatcher.add_task(1, self.make_task(name='queued'))
+        # 没有分组可以借用它，只处理自己分组的任务
+        self.borrower.finish()
+        self.assertEqual(self.borrower.doing, [])
+        self.assertEqual(self.task_dispatcher.group_queue.qsize(1), 1)
+
+
+class SpilloverReserveTest(TaskDispatcherTestCase):
+
+    group_config = {
+        1: dict(count=2, spillover_reserve=1),
+        2: dict(count=1, spillover_groups=(1,)),
+    }
+
+    def test_reserve(self):
+        lenders = self.add_workers(1, 2)
+        self.add_workers(2, 1)
+        self.task_dispatcher.add_task(2, self.make_task(name='busy'))
+
+        self.task_dispatcher.add_task(2, self.make_task(name=0))
+        self.task_dispatcher.add_task(2, self.make_task(name=1))
+
+        # 要给自己的分组留一个空闲的worker
+        self.assertEqual(sorted(len(worker.doing) for worker in lenders), [0, 1])
+        self.assertEqual(self.task_dispatcher.group_queue.qsize(2), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import signal
+import socket
+import threading
+import unittest
+
+from burst.burst import Burst
+from burst.share import constants
+from burst.share.task import Task
+from burst.worker.worker import Worker
+
+
+class FakeProxy(threading.Thread):
+    """
+    收到退休请求后回应，允许worker退出
+    """
+
+    def __init__(self, sock):
+        super(FakeProxy, self).__init__()
+        self.sock = sock
+        self.cmds = []
+
+    def run(self):
+        buf = ''
+        while 1:
+            chunk = self.sock.recv(4096)
+            if not chunk:
+                return
+            buf += chunk
+
+            task = Task()
+            ret = task.unpack(buf)
+            if ret <= 0:
+                continue
+            buf = buf[ret:]
+
+            self.cmds.append(task.cmd)
+            if task.cmd == constants.CMD_WORKER_RETIRE:
+                self.sock.sendall(Task(dict(cmd=constants.CMD_WORKER_RETIRE)).pack())
+                return
+
+
+class RetireTest(unittest.TestCase):
+
+    signums = (signal.SIGINT, signal.SIGQUIT, signal.SIGTERM, signal.SIGHUP, signal.SIGUSR1, signal.SIGUSR2)
+
+    def setUp(self):
+        self.old_handlers = [(signum, signal.getsignal(signum)) for signum in self.signums]
+
+        self.worker = Worker(Burst(), 1)
+        self.worker._handle_proc_signals()
+
+        # 空闲时读取不会很快超时
+        worker_sock, proxy_sock = socket.socketpair()
+        worker_sock.settimeout(10)
+        self.worker.connection = self.worker.connection_class(self.worker, 'unused', 10)
+        self.worker.connection.client.stream.sock = worker_sock
+
+        self.proxy = FakeProxy(proxy_sock)
+        self.proxy.start()
+
+    def tearDown(self):
+        for signum, handler in self.old_handlers:
+            signal.signal(signum, handler)
+
+        self.worker.connection.close()
+        self.proxy.join()
+        self.proxy.sock.close()
+
+    def test_retire_while_idle(self):
+        pid = os.getpid()
+        threading.Timer(0.1, os.kill, (pid, signal.SIGUSR1)).start()
+
+        begin_time = time.time()
+        self.worker.connection._read_message()
+
+        # 不需要等读取超时
+        self.assertLess(time.time() - begin_time, 2)
+        self.assertEqual(self.proxy.cmds, [constants.CMD_WORKER_RETIRE])
+        self.assertTrue(self.worker.retiring)
+        self.assertFalse(self.worker.enable)
+
+    def test_retire_sent_once(self):
+        self.worker.retiring = True
+        self.worker.connection._send_retire()
+
+        self.worker.connection.on_retire()
+        self.worker.connection._read_message()
+
+        self.assertEqual(self.proxy.cmds, [constants.CMD_WORKER_RETIRE])
+        self.assertFalse(self.worker.enable)
+
+    def test_not_reading(self):
+        # 没有在读取时，可能正在写数据，等回到读取循环中再通知
+        self.worker.connection.on_retire()
+        self.assertFalse(self.worker.connection._retire_sent)
+
+
+if __name__ == '__main__':
+    unittest.main()
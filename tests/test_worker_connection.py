@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import unittest
+
+from burst.share import constants
+from burst.share.log import logger
+from burst.share.task import Task, pack_batch, unpack_batch
+from burst.proxy.stat_counter import StatCounter
+from burst.proxy.task_container import TaskContainer
+from burst.proxy.connection.worker_connection import WorkerConnection
+
+
+# 找不到任务时会打错误日志
+logger.addHandler(logging.NullHandler())
+
+
+class FakeTransport(object):
+
+    def __init__(self):
+        self.data_list = []
+
+    def write(self, data):
+        self.data_list.append(data)
+
+    def writeSequence(self, data_list):
+        self.data_list.extend(data_list)
+
+
+class FakeClientConnection(object):
+
+    connected = True
+
+    def __init__(self):
+        self.transport = FakeTransport()
+
+
+class FakeTaskDispatcher(object):
+
+    reloading = False
+
+    class group_queue(object):
+        lane_names = [None]
+
+    def alloc_task(self, worker):
+        return None
+
+    def update_prefetch_worker(self, worker):
+        pass
+
+
+class FakeAdmission(object):
+
+    def add_queue_time(self, group_id, queue_time):
+        pass
+
+
+class FakeApp(object):
+
+    def __init__(self, prefetch):
+        self.config = dict(GROUP_CONFIG={1: dict(count=1, prefetch=prefetch)})
+
+
+class FakeProxy(object):
+
+    def __init__(self, prefetch):
+        self.app = FakeApp(prefetch)
+        self.stat_counter = StatCounter(constants.DEFAULT_CONFIG['TASKS_TIME_BENCHMARK'])
+        self.task_dispatcher = FakeTaskDispatcher()
+        self.admission = FakeAdmission()
+
+
+class FakeFactory(object):
+
+    def __init__(self, prefetch):
+        self.proxy = FakeProxy(prefetch)
+
+
+def done_data(sn, body):
+    return Task(dict(cmd=constants.CMD_WORKER_TASK_DONE, sn=sn, body=body)).pack()
+
+
+class WorkerConnectionSnTest(unittest.TestCase):
+
+    def setUp(self):
+        self.worker = WorkerConnection(FakeFactory(prefetch=3), None, 1)
+        self.worker.transport = FakeTransport()
+
+        self.client_conns = []
+        self.task_containers = []
+        for index in xrange(3):
+            client_conn = FakeClientConnection()
+            task_container = TaskContainer(Task(dict(
+                cmd=constants.CMD_WORKER_TASK_ASSIGN,
+                body='req%s' % index,
+            )), client_conn)
+            task_container.group_id = 1
+
+            self.client_conns.append(client_conn)
+            self.task_containers.append(task_container)
+            self.worker._assign_task(task_container)
+
+    def _sent_sn_list(self):
+        sn_list = []
+        for data in self.worker.transport.data_list:
+            task = Task()
+            self.assertEqual(task.unpack(data), len(data))
+            sn_list.append(task.sn)
+        return sn_list
+
+    def test_assign_sn(self):
+        sn_list = self._sent_sn_list()
+
+        self.assertEqual(sn_list, [task_container.task.sn for task_container in self.task_containers])
+        self.assertEqual(len(set(sn_list)), 3)
+        self.assertEqual(self.worker.doing_task_count, 3)
+
+    def test_done_out_of_order(self):
+        sn_list = self._sent_sn_list()
+
+        # 一次收到多个回应，顺序和分配的顺序不同
+        self.worker.dataReceived(done_data(sn_list[2], 'rsp2') + done_data(sn_list[0], 'rsp0'))
+        self.worker.dataReceived(done_data(sn_list[1], 'rsp1'))
+
+        for index, client_conn in enumerate(self.client_conns):
+            self.assertEqual(client_conn.transport.data_list, ['rsp%s' % index])
+        self.assertEqual(self.worker.doing_task_count, 0)
+
+    def test_done_split_packet(self):
+        sn_list = self._sent_sn_list()
+
+        data = done_data(sn_list[1], 'rsp1')
+        self.worker.dataReceived(data[:5])
+        self.assertEqual(self.client_conns[1].transport.data_list, [])
+
+        self.worker.dataReceived(data[5:])
+        self.assertEqual(self.client_conns[1].transport.data_list, ['rsp1'])
+        self.assertEqual(self.worker.doing_task_count, 2)
+
+    def test_batch_done(self):
+        sn_list = self._sent_sn_list()
+
+        self.worker.dataReceived(pack_batch(constants.CMD_WORKER_TASK_BATCH_DONE, [
+            done_data(sn_list[1], 'rsp1'),
+            done_data(sn_list[0], 'rsp0'),
+        ]))
+
+        self.assertEqual(self.client_conns[0].transport.data_list, ['rsp0'])
+        self.assertEqual(self.client_conns[1].transport.data_list, ['rsp1'])
+        self.assertEqual(self.client_conns[2].transport.data_list, [])
+        self.assertEqual(self.worker.doing_task_count, 1)
+
+    def test_unknown_sn(self):
+        sn_list = self._sent_sn_list()
+
+        self.worker.dataReceived(done_data(max(sn_list) + 100, 'rsp'))
+        # 重复的回应也找不到任务
+        self.worker.dataReceived(done_data(sn_list[0], 'rsp0'))
+        self.worker.dataReceived(done_data(sn_list[0], 'rsp0'))
+
+        self.assertEqual(self.client_conns[0].transport.data_list, ['rsp0'])
+        self.assertEqual(self.worker.doing_task_count, 2)
+
+    def test_client_disconnected(self):
+        sn_list = self._sent_sn_list()
+        self.client_conns[0].connected = False
+
+        self.worker.dataReceived(done_data(sn_list[0], 'rsp0'))
+        self.assertEqual(self.client_conns[0].transport.data_list, [])
+        self.assertEqual(self.worker.doing_task_count, 2)
+
+    def test_sn_wrap(self):
+        self.worker._task_sn = 0xFFFFFFFF
+
+        task_container = TaskContainer(Task(dict(cmd=constants.CMD_WORKER_TASK_ASSIGN)), FakeClientConnection())
+        task_container.group_id = 1
+        self.worker._assign_task(task_container)
+
+        # sn是32位的，回绕之后从1开始，不会是0
+        self.assertEqual(task_container.task.sn, 1)
+
+
+class BatchTest(unittest.TestCase):
+
+    def test_pack_unpack(self):
+        data_list = [done_data(sn, 'rsp%s' % sn) for sn in xrange(1, 4)]
+        batch = Task()
+        batch.unpack(pack_batch(constants.CMD_WORKER_TASK_BATCH_DONE, data_list))
+
+        self.assertEqual(batch.cmd, constants.CMD_WORKER_TASK_BATCH_DONE)
+        self.assertEqual([(task.sn, task.body) for task in unpack_batch(batch.body)],
+                         [(sn, 'rsp%s' % sn) for sn in xrange(1, 4)])
+
+
+if __name__ == '__main__':
+    unittest.main()